@@ -1,4 +1,5 @@
 #!/usr/bin/bash
 
 pkill -f --signal KILL run_all.sh
+pkill -f --signal KILL telegram_music_host.py
 pkill -f --signal KILL telegram_music_bot.py
@@ -0,0 +1,436 @@
+#!/usr/bin/env python
+"""
+Asyncio runtime of Telegram Music bot.
+Bot API is called with aiohttp over pooled connections, handlers are coroutines,
+CPU heavy search runs in a bounded thread pool. Selected with "runtime: asyncio" in bot yaml.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import re
+import signal
+import time
+from concurrent.futures import ThreadPoolExecutor
+import aiohttp
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram_music_bot import TelegramMusicBot, track_list_message, random_message, get_page_content, get_page_keyboard, upload_command, send_limits, sender, file_id_rejected
+from telegram_music_webhook import WebhookServer
+from telegram_music_outbox import AioOutbox, INTERACTIVE, BACKGROUND
+from telegram_music_metrics import HANDLER_SECONDS, HANDLER_ERRORS, UPLOAD_BYTES, observe_api_call
+
+logger = logging.getLogger(__name__)
+
+
+class AioBotApiError(Exception):
+    """
+    Bot API returned ok: false
+    """
+    def __init__(self, description, error_code=None, retry_after=None):
+        super().__init__(description)
+        self.error_code = error_code
+        self.retry_after = retry_after
+
+
+class AioBotApi:
+    """
+    Minimal non-blocking Bot API client, method arguments are named as in python-telegram-bot
+    """
+    def __init__(self, token, base_url='https://api.telegram.org/bot', connections=100):
+        self.base_url = base_url + token + '/'
+        self.connections = connections
+        self.session = None
+
+    async def open(self):
+        self.session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.connections))
+
+    async def close(self):
+        await self.session.close()
+
+    async def call(self, method, files=None, request_timeout=30, **params):
+        """
+        calls Bot API method, files - dict field: (filename, file object) streamed as multipart body
+        returns result field of response
+        """
+        params = {k: (v.to_json() if hasattr(v, 'to_json') else v) for k, v in params.items() if v is not None}
+        if files:
+            data = aiohttp.FormData()
+            for k, v in params.items():
+                data.add_field(k, str(v))
+            for k, (filename, fileobj) in files.items():
+                data.add_field(k, fileobj, filename=filename, content_type='audio/mpeg')
+            request = self.session.post(self.base_url + method, data=data, timeout=aiohttp.ClientTimeout(total=request_timeout))
+        else:
+            request = self.session.post(self.base_url + method, json=params, timeout=aiohttp.ClientTimeout(total=request_timeout))
+        start = time.perf_counter()
+        try:
+            async with request as response:
+                result = await response.json(content_type=None)
+                if not isinstance(result, dict):
+                    raise ValueError('response is not a json object')
+        except asyncio.TimeoutError:
+            observe_api_call(method, time.perf_counter() - start, 'timeout')
+            raise
+        except aiohttp.ClientError:
+            observe_api_call(method, time.perf_counter() - start, 'network')
+            raise
+        except ValueError as e:
+            # e.g. html error page of a proxy in front of Bot API
+            observe_api_call(method, time.perf_counter() - start, response.status)
+            raise AioBotApiError('Bad response of %s: HTTP %d, %s' % (method, response.status, e), response.status)
+        if not result.get('ok'):
+            observe_api_call(method, time.perf_counter() - start, result.get('error_code'))
+            raise AioBotApiError(result.get('description'), result.get('error_code'), result.get('parameters', {}).get('retry_after'))
+        observe_api_call(method, time.perf_counter() - start)
+        return result['result']
+
+    async def get_updates(self, offset=None, timeout=30):
+        return await self.call('getUpdates', request_timeout=timeout + 10, offset=offset, timeout=timeout, allowed_updates=['message', 'callback_query', 'inline_query'])
+
+    async def send_message(self, chat_id, text, **params):
+        return await self.call('sendMessage', chat_id=chat_id, text=text, **params)
+
+    async def edit_message_text(self, chat_id, message_id, text, **params):
+        return await self.call('editMessageText', chat_id=chat_id, message_id=message_id, text=text, **params)
+
+    async def answer_callback_query(self, callback_query_id, **params):
+        return await self.call('answerCallbackQuery', callback_query_id=callback_query_id, **params)
+
+    async def send_audio(self, chat_id, audio, filename=None, timeout=60, **params):
+        """
+        audio - file_id string or file object, file object is streamed without reading it into memory
+        """
+        if isinstance(audio, str):
+            return await self.call('sendAudio', request_timeout=timeout, chat_id=chat_id, audio=audio, **params)
+        size = os.fstat(audio.fileno()).st_size
+        # aiohttp closes streamed file, it gets another file object of the same descriptor so retries can read audio again
+        with open(audio.fileno(), 'rb', closefd=False) as stream:
+            sent = await self.call('sendAudio', files={'audio': (filename or 'audio.mp3', stream)}, request_timeout=timeout, chat_id=chat_id, **params)
+        UPLOAD_BYTES.inc(size)
+        return sent
+
+
+class QueuedAioBotApi(AioBotApi):
+    """
+    AioBotApi sending messages, edits and audio through AioOutbox, run() of outbox must be running
+    """
+    def __init__(self, token, outbox, **kwargs):
+        super().__init__(token, **kwargs)
+        self.outbox = outbox
+
+    async def send_message(self, chat_id, text, priority=INTERACTIVE, **params):
+        return await self.outbox.call(lambda: AioBotApi.send_message(self, chat_id, text, **params), chat_id, priority)
+
+    async def edit_message_text(self, chat_id, message_id, text, priority=INTERACTIVE, **params):
+        # only the last of edits waiting in queue for the same message is sent
+        return await self.outbox.call(lambda: AioBotApi.edit_message_text(self, chat_id, message_id, text, **params), chat_id, priority,
+                                      key=('edit', chat_id, message_id))
+
+    async def send_audio(self, chat_id, audio, filename=None, timeout=60, priority=INTERACTIVE, **params):
+        def upload():
+            # retried upload is streamed from the start again
+            if hasattr(audio, 'seek'):
+                audio.seek(0)
+            return AioBotApi.send_audio(self, chat_id, audio, filename, timeout, **params)
+        return await self.outbox.call(upload, chat_id, priority)
+
+
+class AioTelegramMusicBot(TelegramMusicBot):
+    """
+    TelegramMusicBot served by asyncio event loop instead of python-telegram-bot Updater threads
+    """
+    def setup_dispatcher(self, bot_parameters):
+        """
+        self.api - AioBotApi
+        self.executor - thread pool for search and other CPU heavy calls
+        self.inflight - semaphore limiting number of concurrently handled updates
+        """
+        if bot_parameters.get("send_queue", True):
+            self.outbox = AioOutbox(**send_limits(bot_parameters))
+            self.api = QueuedAioBotApi(bot_parameters.get("token"), self.outbox, base_url=self.api_base_url, connections=bot_parameters.get("api_connections", 100))
+        else:
+            self.outbox = None
+            self.api = AioBotApi(bot_parameters.get("token"), base_url=self.api_base_url, connections=bot_parameters.get("api_connections", 100))
+        self.executor = ThreadPoolExecutor(bot_parameters.get("search_workers", 4), thread_name_prefix='search')
+        self.inflight_limit = bot_parameters.get("max_inflight_updates", 10000)
+        self.inflight = None
+        self.tasks = set()
+        self.task = None
+        self.loop = None
+
+    def start(self):
+        logging.info('Start %s (asyncio)...', self.update_mode)
+        asyncio.run(self.run())
+
+    def start_task(self):
+        """
+        starts bot on already running event loop shared with other bots
+        """
+        logging.info('Start %s (asyncio task)...', self.update_mode)
+        self.task = asyncio.ensure_future(self.run())
+        return self.task
+
+    def alive(self):
+        return self.task is not None and not self.task.done()
+
+    def stop(self):
+        if self.preloader:
+            self.preloader.stop()
+        if self.task:
+            self.task.cancel()
+        self.executor.shutdown(wait=False)
+        self.close()
+
+    def upload_track(self, index, caption):
+        """
+        uploads track to preload chat from preloader thread through event loop, returns its telegram file id
+        """
+        priority = {'priority': BACKGROUND} if self.outbox else {}
+        with open(str(index.path(caption)), 'rb') as audio_file:
+            upload = self.api.send_audio(chat_id=self.preload_chat_id, audio=audio_file, filename=index.filename(caption), timeout=300, caption=caption,
+                                         title=index.title(caption), performer=index.author(caption), duration=index.length(caption), **priority)
+            sent = asyncio.run_coroutine_threadsafe(upload, self.loop).result()
+        return sent['audio']['file_id']
+
+    async def run(self):
+        loop = self.loop = asyncio.get_running_loop()
+        self.inflight = asyncio.Semaphore(self.inflight_limit)
+        await self.api.open()
+        outbox_task = asyncio.ensure_future(self.outbox.run()) if self.outbox else None
+        if self.watcher:
+            self.watcher.start()
+        # kill -HUP rebuilds collection index without restarting the bot
+        if self.handle_signals:
+            loop.add_signal_handler(signal.SIGHUP, self.collection.reindex_async)
+        # file ids are loaded in background, handlers must not block event loop waiting for them
+        await loop.run_in_executor(None, self.bot_files.loaded.wait)
+        if self.preloader and self.preload_on_start:
+            self.preloader.start()
+        try:
+            if self.update_mode == 'webhook':
+                await self.serve_webhook()
+            else:
+                await self.poll()
+        finally:
+            if outbox_task:
+                outbox_task.cancel()
+            await self.api.close()
+
+    async def serve_webhook(self):
+        """
+        receives updates with shared embedded webhook server, its threads hand them over to event loop
+        """
+        loop = asyncio.get_running_loop()
+        server = WebhookServer.get(self.webhook['listen'], self.webhook['port'])
+        def deliver(updates):
+            asyncio.run_coroutine_threadsafe(self.process_updates(updates), loop)
+        server.add_route(self.webhook['path'], deliver, self.webhook['secret'])
+        try:
+            await self.api.call('setWebhook', url=self.webhook['url'].rstrip('/') + self.webhook['path'], secret_token=self.webhook['secret'],
+                                allowed_updates=['message', 'callback_query', 'inline_query'])
+            await asyncio.Event().wait()
+        finally:
+            server.remove_route(self.webhook['path'], deliver)
+
+    async def process_updates(self, updates):
+        for data in updates:
+            await self.process_update(data)
+
+    async def poll(self):
+        offset = None
+        while True:
+            try:
+                updates = await self.api.get_updates(offset, timeout=30)
+            except (aiohttp.ClientError, asyncio.TimeoutError, AioBotApiError) as e:
+                logging.warning('getUpdates failed: %s', e)
+                await asyncio.sleep(getattr(e, 'retry_after', None) or 1)
+                continue
+            for data in updates:
+                offset = data['update_id'] + 1
+                await self.process_update(data)
+
+    async def process_update(self, data):
+        """
+        starts handling of update given as Bot API json dict, waits only if too many updates are in flight
+        """
+        await self.inflight.acquire()
+        task = asyncio.ensure_future(self.handle(data))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def handle(self, data):
+        handler = None
+        start = time.perf_counter()
+        try:
+            update = Update.de_json(data, None)
+            logging.debug('New update: %s', update)
+            handler = self.route(update)
+            if handler:
+                await handler(update)
+        except Exception as e:
+            if handler:
+                HANDLER_ERRORS.labels(handler.__name__).inc()
+            logging.warning('Update "%s" caused error "%s"', data, e)
+        finally:
+            if handler:
+                HANDLER_SECONDS.labels(handler.__name__).observe(time.perf_counter() - start)
+            self.inflight.release()
+
+    def route(self, update):
+        """
+        returns handler coroutine function of update in the same order python-telegram-bot handlers are registered
+        """
+        if update.callback_query:
+            return self.button_callback
+        if update.inline_query or not update.message or not update.message.text:
+            return None
+        text = update.message.text
+        if not text.startswith('/'):
+            return self.message_handler
+        command = (text[1:].split() or [''])[0].split('@')[0]
+        if command in ('help', 'start'):
+            return self.hello_command_handler
+        if command == 'random':
+            return self.random_command_handler
+        if command == 'mylikes':
+            return self.liked_command_handler
+        if command == 'top100':
+            return self.top100_command_handler
+        if command == 'reindex':
+            return self.reindex_command_handler
+        if command in ('upload', 'stop_upload', 'upload_status'):
+            return self.upload_command_handler
+        if text.startswith('/play'):
+            return self.play_command
+        if text.startswith('/rate'):
+            return self.rate_command
+        return self.hello_command_handler
+
+    async def in_executor(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, lambda: func(*args, **kwargs))
+
+    async def message_handler(self, update):
+        """searching collection with message text"""
+        with self.events.timed('search', *sender(update), query=update.message.text) as event:
+            index = self.collection.snapshot()
+            track_list = await self.in_executor(index.search, update.message.text)
+            event['results'] = len(track_list)
+            content, reply_markup = track_list_message(track_list, index, self.rates)
+            await self.api.send_message(chat_id=update.message.chat_id, reply_to_message_id=update.message.message_id, text=content, parse_mode='HTML', reply_markup=reply_markup)
+
+    async def button_callback(self, update):
+        callback_query = update.callback_query
+        logging.info('Callback data: %s', callback_query.data)
+        index = self.collection.snapshot()
+        if callback_query.data == '/random':
+            with self.events.timed('random', *sender(update)):
+                content, reply_markup = random_message(callback_query.message.chat_id, index)
+                await self.api.edit_message_text(chat_id=callback_query.message.chat_id, message_id=callback_query.message.message_id, text=content, parse_mode='HTML', reply_markup=reply_markup)
+        elif re.search('upd[slt]w', callback_query.data):
+            page_setup = json.loads(callback_query.data)
+            with self.events.timed('page', *sender(update), list=page_setup['q'], page=page_setup['wpos']):
+                content = await self.in_executor(get_page_content, callback_query.message, page_setup, index, self.rates)
+                keyboard = get_page_keyboard(page_setup)
+                await self.api.edit_message_text(chat_id=callback_query.message.chat_id, message_id=callback_query.message.message_id, text=content, parse_mode='HTML', reply_markup=InlineKeyboardMarkup(keyboard))
+        await self.api.answer_callback_query(callback_query.id)
+
+    async def random_command_handler(self, update):
+        with self.events.timed('random', *sender(update)):
+            content, reply_markup = random_message(update.message.chat_id, self.collection.snapshot())
+            await self.api.send_message(chat_id=update.message.chat_id, text=content, parse_mode='HTML', reply_markup=reply_markup)
+
+    async def liked_command_handler(self, update):
+        with self.events.timed('likes', *sender(update)) as event:
+            index = self.collection.snapshot()
+            track_list = [t for t in self.rates.get_liked_tracks(update.message.chat.username) if index.exists(t)]
+            event['results'] = len(track_list)
+            content, reply_markup = track_list_message(track_list, index, self.rates, page_type="likes")
+            await self.api.send_message(chat_id=update.message.chat_id, reply_to_message_id=update.message.message_id, text=content, parse_mode='HTML', reply_markup=reply_markup)
+
+    async def top100_command_handler(self, update):
+        with self.events.timed('top100', *sender(update)) as event:
+            index = self.collection.snapshot()
+            track_list = self.rates.get_top100(track_filter=index.exists)
+            event['results'] = len(track_list)
+            content, reply_markup = track_list_message(track_list, index, self.rates, page_type="top100")
+            await self.api.send_message(chat_id=update.message.chat_id, reply_to_message_id=update.message.message_id, text=content, parse_mode='HTML', reply_markup=reply_markup)
+
+    async def hello_command_handler(self, update):
+        with self.events.timed('start', *sender(update), command=update.message.text.split()[0]):
+            keyboard = [[InlineKeyboardButton(text="I'm feeling lucky", callback_data='/random')]]
+            await self.api.send_message(chat_id=update.message.chat_id, text=self.hello_html, parse_mode='HTML', reply_markup=InlineKeyboardMarkup(keyboard))
+
+    async def reindex_command_handler(self, update):
+        self.events.emit('reindex', chat=update.message.chat_id, user=update.message.chat.username)
+        if update.message.chat.username not in self.admins:
+            return
+        if self.collection.reindex_async():
+            text = 'Reindex started, current index version is %d' % self.collection.version
+        else:
+            text = 'Reindex is already running'
+        await self.api.send_message(chat_id=update.message.chat_id, reply_to_message_id=update.message.message_id, text=text)
+
+    async def upload_command_handler(self, update):
+        self.events.emit('upload', chat=update.message.chat_id, user=update.message.chat.username, command=update.message.text.split()[0])
+        if update.message.chat.username not in self.admins:
+            return
+        await self.api.send_message(chat_id=update.message.chat_id, reply_to_message_id=update.message.message_id, text=upload_command(update.message.text, self.preloader))
+
+    async def rate_command(self, update):
+        if not '/rate_' in update.message.text:
+            return
+        hash = update.message.text.partition('_')[2]
+        with self.events.timed('rate', *sender(update), hash=hash):
+            caption = self.collection.get_by_hash(hash)
+            self.rates.rate(update.message.chat.username, caption)
+        logging.debug("%s rated %s", update.message.chat.username, caption)
+
+    async def play_command(self, update):
+        """plays an audio file on /play_hash command"""
+        if not '/play_' in update.message.text:
+            return
+        hash = update.message.text.partition('_')[2]
+        with self.events.timed('play', *sender(update), hash=hash) as event:
+            event['sent'] = await self.send_audio_file_by_hash(update.message.chat_id, hash, self.collection.snapshot())
+
+    async def send_audio_file_by_hash(self, chat_id, hash, collection):
+        """
+        sends cached file id if there is one, uploads file otherwise or if file id is rejected
+        returns 'file_id' or 'upload' as file was sent, None if it wasn't
+        """
+        caption = collection.get_by_hash(hash)
+        if not collection.exists(caption):
+            return
+        params = dict(chat_id=chat_id, caption=caption, title=collection.title(caption), performer=collection.author(caption), duration=collection.length(caption))
+        file_id = self.bot_files.get(collection.filename(caption))
+        for attempt in range(2 if file_id else 0):
+            try:
+                sent = await self.api.send_audio(audio=file_id, **params)
+                logging.info('File sent, got: %s', sent)
+                return 'file_id'
+            except AioBotApiError as e:
+                if e.error_code == 400 and file_id_rejected(e):
+                    # id is stale or belongs to another bot, file is uploaded again
+                    logging.warning('File id %s of %s is rejected: %s', file_id, caption, e)
+                    self.bot_files.remove(collection.filename(caption))
+                    break
+                # blocked bot, flood limit or server error, file id is still good
+                if not e.retry_after or attempt:
+                    raise
+                logging.warning('Flood limit hit sending %s, retrying in %s seconds', caption, e.retry_after)
+                await asyncio.sleep(e.retry_after)
+        try:
+            audio_file = open(str(collection.path(caption)), 'rb')
+        except FileNotFoundError:
+            logging.warning('File for %s is gone, reindex pending?', caption)
+            return
+        start = time.monotonic()
+        with audio_file:
+            size = os.fstat(audio_file.fileno()).st_size
+            sent = await self.api.send_audio(audio=audio_file, filename=collection.filename(caption), **params)
+        logging.info('Uploaded %s: %d bytes in %.2f s', collection.filename(caption), size, time.monotonic() - start)
+        logging.info('File sent, got: %s', sent)
+        self.bot_files.set(collection.filename(caption), sent['audio']['file_id'])
+        return 'upload'
@@ -0,0 +1,408 @@
+#!/usr/bin/env python
+"""
+Benchmarks for telegram music bot.
+index - compares serial and parallel collection index build on a synthetic mp3 collection
+memory - memory taken by mds_dict as dict per track and as TrackTable
+mmap - startup time and own memory of processes attached to exported index vs building index in process
+paths - latency percentiles of request hot paths (search, random, get_by_hash, top and liked lists, list2text) and index memory
+        on synthetic or real collection, results are written to json file to compare commits
+fuzzy - share of fuzzy search results equal to difflib.get_close_matches over all tracks, and their latency
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+from mutagen.easyid3 import EasyID3
+from difflib import get_close_matches
+from hashlib import md5
+from telegram_music_collection import TelegramMusicCollection, CollectionIndex, TrackTable, ChatShuffle
+from telegram_music_mmap import MmapCollection, export_index
+
+AUTHORS = ['Толстой Лев', 'Чехов Антон', 'Пушкин Александр', 'Гоголь Николай', 'Достоевский Фёдор',
+           'Булгаков Михаил', 'Стругацкие Аркадий и Борис', 'Тургенев Иван', 'Лермонтов Михаил', 'Куприн Александр']
+WORDS = ['война', 'мир', 'мастер', 'маргарита', 'мёртвые', 'души', 'идиот', 'пикник', 'на', 'обочине',
+         'вишнёвый', 'сад', 'шинель', 'отцы', 'дети', 'герой', 'нашего', 'времени', 'поединок', 'бесы']
+
+# MPEG1 layer 3, 128 kbit/s, 44100 Hz frame without padding
+MP3_FRAME = b'\xff\xfb\x90\x64' + b'\x00' * 413
+
+
+def synthetic_captions(count, seed=0):
+    """
+    yields (author, title) pairs shaped like real audiobook collection 'Author - Title (Часть N)'
+    """
+    rnd = random.Random(seed)
+    i = 0
+    while i < count:
+        author = rnd.choice(AUTHORS)
+        title = ' '.join(rnd.choice(WORDS) for _ in range(rnd.randint(1, 4))).capitalize() + ' ' + str(i)
+        parts = rnd.choice([1, 1, 1, 3, 10, 30])
+        for part in range(1, parts + 1):
+            if i == count:
+                return
+            yield author, title if parts == 1 else '%s (Часть %d)' % (title, part)
+            i += 1
+
+
+def make_mp3_collection(path, count, frames=200):
+    """
+    creates count tagged mp3 files in path, returns path
+    """
+    path = Path(path)
+    for n, (author, title) in enumerate(synthetic_captions(count)):
+        directory = path / author
+        directory.mkdir(parents=True, exist_ok=True)
+        p = directory / ('%s - %s.mp3' % (author, title))
+        p.write_bytes(MP3_FRAME * frames)
+        tags = EasyID3()
+        tags['artist'] = author
+        tags['title'] = title
+        tags['album'] = title
+        tags.save(str(p))
+    return path
+
+
+def synthetic_tracks(count, basedir='/music'):
+    """
+    yields (caption, track info dict) of count synthetic tracks shaped like read_track results, files don't exist
+    """
+    for author, title in synthetic_captions(count):
+        caption = '%s - %s' % (author, title)
+        filename = caption + '.mp3'
+        yield caption, {'path': Path(basedir) / author / filename,
+                        'author': author,
+                        'title': title,
+                        'filename': filename,
+                        'length': str(len(caption) * 60),
+                        'hash': md5(caption.encode('utf-8')).hexdigest()[:10]}
+
+
+def synthetic_mds_dict(count, basedir='/music'):
+    return dict(synthetic_tracks(count, basedir))
+
+
+def anonymous_memory():
+    """
+    returns anonymous memory of current process in kB, mapped file pages are page cache and not counted
+    """
+    with open('/proc/self/smaps_rollup') as f:
+        return sum(int(line.split()[1]) for line in f if line.startswith('Anonymous:'))
+
+
+def mmap_worker(export_file, queries, result):
+    base = anonymous_memory()
+    start = time.perf_counter()
+    collection = MmapCollection(export_file, '/music', search_cache_size=0)
+    attached = time.perf_counter() - start
+    start = time.perf_counter()
+    for q in queries:
+        collection.search(q)
+    result.put((attached, (time.perf_counter() - start) / len(queries), anonymous_memory() - base))
+
+
+def index_worker(count, queries, result):
+    mds_dict = synthetic_mds_dict(count)
+    base = anonymous_memory()
+    start = time.perf_counter()
+    index = CollectionIndex({}, mds_dict, 1)
+    built = time.perf_counter() - start
+    start = time.perf_counter()
+    for q in queries:
+        index.search(q)
+    result.put((built, (time.perf_counter() - start) / len(queries), anonymous_memory() - base))
+
+
+def track_table(tracks):
+    table = TrackTable('/music')
+    table.update(tracks)
+    return table
+
+
+def bench_memory(args):
+    for count in args.tracks:
+        for name, make in (('dict', dict), ('TrackTable', track_table)):
+            # strings shared by tracks are made inside traced block too, so both layouts pay for them
+            tracemalloc.start()
+            mds_dict = make(synthetic_tracks(count))
+            memory = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            captions = random.Random(0).sample(list(mds_dict), min(count, 10000))
+            start = time.perf_counter()
+            for caption in captions:
+                track = mds_dict[caption]
+                track['path'], track['hash'], track['length']
+            access = (time.perf_counter() - start) / len(captions)
+            del mds_dict
+            print('tracks: %8d  %-10s  memory: %8.1f MB  per track: %5d bytes  access: %5.2f us' % (count, name, memory / 2 ** 20, memory / count, access * 1e6))
+
+
+def bench_mmap(args):
+    queries = ['толстой', 'мастер и маргарита', 'пикник на обочине', 'чехов сад', 'война 12']
+    # forked workers would copy parent heap pages, so they are spawned
+    context = multiprocessing.get_context('spawn')
+    for count in args.tracks:
+        mds_dict = synthetic_mds_dict(count)
+        with tempfile.TemporaryDirectory() as tmp:
+            export_file = os.path.join(tmp, 'index.mm')
+            export_index(CollectionIndex({}, mds_dict, 1), export_file, '/music')
+            size = os.path.getsize(export_file)
+            for name, worker, worker_args in (('in-process', index_worker, (count,)), ('mmap', mmap_worker, (export_file,))):
+                result = context.Queue()
+                process = context.Process(target=worker, args=worker_args + (queries, result))
+                process.start()
+                startup, search, memory = result.get()
+                process.join()
+                print('tracks: %8d  %-10s  startup: %8.3f s  search: %7.4f s  own memory: %8d kB  file: %6d kB' % (count, name, startup, search, memory, size >> 10))
+
+
+def percentiles(timings):
+    """
+    returns python dict of latency statistics in microseconds
+    """
+    timings = sorted(timings)
+    stats = {'count': len(timings), 'mean': sum(timings) / len(timings) * 1e6, 'max': timings[-1] * 1e6}
+    for p in (50, 90, 99):
+        stats['p%d' % p] = timings[min(len(timings) * p // 100, len(timings) - 1)] * 1e6
+    return stats
+
+
+def timed(func, args_list):
+    """
+    calls func with every args of args_list, returns list of call times
+    """
+    timings = []
+    for args in args_list:
+        start = time.perf_counter()
+        func(*args)
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def search_queries(index, count, seed=0):
+    """
+    returns list of (kind, query) shaped like user queries: author, title words, caption part, typo and miss
+    """
+    rnd = random.Random(seed)
+    captions = rnd.sample(list(index.mds_dict), min(count, len(index.mds_dict)))
+    queries = []
+    for n, caption in enumerate(captions):
+        title = index.title(caption)
+        words = title.split()
+        kind = ('author', 'title', 'caption', 'typo', 'miss')[n % 5]
+        if kind == 'author':
+            query = index.author(caption).split()[0].lower()
+        elif kind == 'title':
+            query = ' '.join(words[:2]).lower()
+        elif kind == 'caption':
+            start = rnd.randrange(max(len(caption) - 12, 1))
+            query = caption[start:start + 12]
+        elif kind == 'typo':
+            word = max(words, key=len)
+            i = rnd.randrange(len(word))
+            query = word[:i] + word[i + 1:] if len(word) > 4 else word + 'а'
+        else:
+            query = 'несуществующее %d' % n
+        queries.append((kind, query))
+    return queries
+
+
+def synthetic_rates(rates, captions, users, likes, seed=0):
+    """
+    fills TrackRates with likes of users, few tracks get most of them as in real bots
+    """
+    rnd = random.Random(seed)
+    now = int(time.time())
+    with rates.lock:
+        for _ in range(likes):
+            caption = captions[min(int(rnd.paretovariate(1.2)) - 1, len(captions) - 1) if rnd.random() < 0.7 else rnd.randrange(len(captions))]
+            rates.apply('user%d' % rnd.randrange(users), caption, now)
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def bench_paths_index(index, name, args, rates_file):
+    """
+    returns python dict operation: latency statistics of hot paths on index
+    """
+    # TrackRates and list2text live in bot module, which needs python-telegram-bot
+    from telegram_music_bot import TrackRates, list2text
+    rnd = random.Random(0)
+    captions = list(index.mds_dict)
+    queries = search_queries(index, args.queries)
+    results = {}
+    for kind in ('author', 'title', 'caption', 'typo', 'miss'):
+        results['search_' + kind] = percentiles(timed(index.search, [(q,) for k, q in queries if k == kind]))
+    results['search'] = percentiles(timed(index.search, [(q,) for _, q in queries]))
+    hashes = [index.hash(rnd.choice(captions)) for _ in range(args.repeat)]
+    results['get_by_hash'] = percentiles(timed(index.get_by_hash, [(h,) for h in hashes]))
+    results['random'] = percentiles(timed(index.random, [() for _ in range(args.repeat)]))
+    shuffle, index.shuffle = index.shuffle, ChatShuffle()
+    results['random_shuffle'] = percentiles(timed(index.random, [(rnd.randrange(1000),) for _ in range(args.repeat)]))
+    index.shuffle = shuffle
+    rates = TrackRates(rates_file)
+    synthetic_rates(rates, captions, args.users, max(len(captions) // 10, 1000))
+    results['get_top100'] = percentiles(timed(rates.get_top100, [(index.exists, rnd.randrange(10) * 10, 10) for _ in range(args.repeat)]))
+    results['get_liked_tracks'] = percentiles(timed(rates.get_liked_tracks, [('user%d' % rnd.randrange(args.users),) for _ in range(args.repeat)]))
+    rates.journal.close()
+    pages = [(index.search(q)[:10],) for _, q in queries]
+    results['list2text'] = percentiles(timed(lambda page: list2text(page, index, rates), pages))
+    for operation, stats in results.items():
+        print('%-10s %-18s p50: %9.1f us  p90: %9.1f us  p99: %9.1f us  max: %9.1f us' % (name, operation, stats['p50'], stats['p90'], stats['p99'], stats['max']))
+    return results
+
+
+def build_index(tracks):
+    """
+    returns (index, build seconds, python dict of index memory)
+    tracemalloc would slow build down many times, so memory is taken from process counters
+    """
+    base = anonymous_memory()
+    start = time.perf_counter()
+    index = CollectionIndex({}, track_table(tracks), 1)
+    elapsed = time.perf_counter() - start
+    return index, elapsed, {'index_kb': anonymous_memory() - base, 'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+
+
+def paths_indexes(args):
+    """
+    yields (name, index, build seconds, python dict of index memory) of collections to benchmark
+    """
+    if args.collection:
+        collection = TelegramMusicCollection(args.collection, id3based=args.id3based, index_file=args.index_file)
+        yield os.path.basename(os.path.abspath(args.collection)), collection.snapshot(), 0.0, {}
+        return
+    for count in args.tracks:
+        # tracks are generated before measuring, only index structures are counted
+        tracks = list(synthetic_tracks(count))
+        index, build, memory = build_index(tracks)
+        del tracks
+        yield str(count), index, build, memory
+        del index
+
+
+def bench_paths(args):
+    report = {'commit': git_commit(), 'time': int(time.time()), 'python': sys.version.split()[0],
+              'machine': platform.machine(), 'cpus': os.cpu_count(), 'runs': []}
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, index, build, memory in paths_indexes(args):
+            print('%-10s tracks: %8d  build: %8.3f s  index memory: %8.1f MB  peak rss: %8.1f MB' % (
+                name, len(index.mds_dict), build, memory.get('index_kb', 0) / 1024, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+            results = bench_paths_index(index, name, args, os.path.join(tmp, 'rates_%s.pickle' % name))
+            report['runs'].append(dict(memory, name=name, tracks=len(index.mds_dict), build_seconds=build, operations=results,
+                                       peak_rss_kb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+            del index
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=1)
+        print('Results are written to %s' % args.output)
+    if args.compare:
+        compare_paths(args.compare, report)
+
+
+def compare_paths(filename, report):
+    """
+    prints p50 and p99 ratios of report to results stored in filename
+    """
+    with open(filename) as f:
+        baseline = json.load(f)
+    base_runs = {run['name']: run for run in baseline['runs']}
+    print('Compared to %s (commit %s)' % (filename, baseline.get('commit')))
+    for run in report['runs']:
+        base = base_runs.get(run['name'])
+        if base is None:
+            continue
+        for operation, stats in run['operations'].items():
+            base_stats = base['operations'].get(operation)
+            if base_stats:
+                print('%-10s %-18s p50: %6.2fx  p99: %6.2fx' % (run['name'], operation, stats['p50'] / max(base_stats['p50'], 1e-3),
+                                                              stats['p99'] / max(base_stats['p99'], 1e-3)))
+
+
+def bench_fuzzy(args):
+    for count in args.tracks:
+        index = build_index(list(synthetic_tracks(count)))[0]
+        captions = list(index.mds_dict)
+        # every track is a possibility, so title or author of several tracks is repeated as in search_diff_title
+        fields = {'caption': captions, 'title': [index.title(c) for c in captions], 'author': [index.author(c) for c in captions]}
+        searches = {'caption': index.search_diff_caption, 'title': index.search_diff_title, 'author': index.search_diff_author}
+        equal = {name: 0 for name in fields}
+        timings = []
+        queries = search_queries(index, args.queries)
+        for _, query in queries:
+            for name, strings in fields.items():
+                matches = set(get_close_matches(query, strings))
+                expected = sorted(c for c, s in zip(captions, strings) if s in matches)
+                start = time.perf_counter()
+                result = searches[name](query)
+                timings.append(time.perf_counter() - start)
+                equal[name] += result == expected
+        stats = percentiles(timings)
+        print('tracks: %8d  %s  p50: %7.1f us  p99: %7.1f us' % (count, '  '.join('%s equal: %5.1f%%' % (name, 100.0 * n / len(queries))
+                                                                                   for name, n in equal.items()), stats['p50'], stats['p99']))
+
+
+def bench_index(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        make_mp3_collection(tmp, args.tracks)
+        print('Collection of %d tracks in %s' % (args.tracks, tmp))
+        for workers in [1] + args.workers:
+            start = time.perf_counter()
+            collection = TelegramMusicCollection(tmp, id3based=args.id3based, index_workers=workers)
+            elapsed = time.perf_counter() - start
+            print('workers: %3d  tracks: %7d  build: %8.3f s' % (workers, len(collection.mds_dict), elapsed))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Telegram music bot benchmarks')
+    subparsers = parser.add_subparsers(dest='bench')
+    index_parser = subparsers.add_parser('index', help='serial vs parallel collection index build')
+    index_parser.add_argument('--tracks', type=int, default=5000)
+    index_parser.add_argument('--workers', type=int, nargs='+', default=[2, 4, os.cpu_count()])
+    index_parser.add_argument('--id3based', action='store_true')
+    index_parser.set_defaults(func=bench_index)
+    memory_parser = subparsers.add_parser('memory', help='mds_dict memory as dicts and as TrackTable')
+    memory_parser.add_argument('--tracks', type=int, nargs='+', default=[10000, 100000, 1000000])
+    memory_parser.set_defaults(func=bench_memory)
+    mmap_parser = subparsers.add_parser('mmap', help='processes attached to exported index vs in-process index')
+    mmap_parser.add_argument('--tracks', type=int, nargs='+', default=[10000, 100000])
+    mmap_parser.set_defaults(func=bench_mmap)
+    paths_parser = subparsers.add_parser('paths', help='latency percentiles of request hot paths')
+    paths_parser.add_argument('--tracks', type=int, nargs='+', default=[1000, 10000, 100000])
+    paths_parser.add_argument('--collection', help='benchmark real collection at this path instead of synthetic ones')
+    paths_parser.add_argument('--index-file', help='index snapshot of real collection')
+    paths_parser.add_argument('--id3based', action='store_true')
+    paths_parser.add_argument('--queries', type=int, default=500)
+    paths_parser.add_argument('--repeat', type=int, default=10000, help='calls of cheap operations')
+    paths_parser.add_argument('--users', type=int, default=1000)
+    paths_parser.add_argument('--output', help='json file to write results to')
+    paths_parser.add_argument('--compare', help='json file of earlier results to compare with')
+    paths_parser.set_defaults(func=bench_paths)
+    fuzzy_parser = subparsers.add_parser('fuzzy', help='fuzzy search results compared with difflib.get_close_matches')
+    fuzzy_parser.add_argument('--tracks', type=int, nargs='+', default=[1000, 5000, 20000])
+    fuzzy_parser.add_argument('--queries', type=int, default=200)
+    fuzzy_parser.set_defaults(func=bench_fuzzy)
+    args = parser.parse_args()
+    if not args.bench:
+        parser.print_help()
+        return
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,22 @@
 #!/usr/bin/env python
 """Telegram Music bot"""
 
-import os, sys, yaml, re, math, json, logging, pickle
+import os, sys, yaml, re, math, json, logging, signal, threading, bisect, itertools
 from telegram.ext import Updater, CommandHandler, MessageHandler, Filters, BaseFilter, CallbackQueryHandler, InlineQueryHandler, run_async
-from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from telegram import Bot, InlineKeyboardButton, InlineKeyboardMarkup, Update
+from telegram.utils.request import Request
+from telegram.error import BadRequest, TelegramError, RetryAfter, Unauthorized, TimedOut
 from pathlib import Path
 from telegram_music_collection import TelegramMusicCollection
+from telegram_music_mmap import MmapCollection
+from telegram_music_watcher import CollectionWatcher
+from telegram_music_journal import PickleJournal
+from telegram_music_webhook import WebhookServer, set_webhook
+from telegram_music_preload import CollectionPreloader
+from telegram_music_outbox import ThreadOutbox, INTERACTIVE, BACKGROUND
+from telegram_music_upload import StreamingUploader, UploadError
+from telegram_music_metrics import MetricsServer, INDEX_VERSION, OUTBOX_QUEUED, measured, observe_api_call
+from telegram_music_events import EventLog
 from functools import partial
 import time
 
@@ -16,27 +27,80 @@ class TelegramMusicBot:
 
         self.nickname = bot_parameters.get("nickname")
         self.hello_html = bot_parameters.get("hello_html")
+        self.admins = bot_parameters.get("admins") or []
+        self.token = bot_parameters.get("token")
+        # Bot API server, changed to run against local fake server in load tests
+        self.api_base_url = bot_parameters.get("api_base_url", 'https://api.telegram.org/bot')
+        self.update_mode = bot_parameters.get("update_mode", "polling")
+        self.webhook = {'url': bot_parameters.get("webhook_url"),
+                        'listen': bot_parameters.get("webhook_listen", "0.0.0.0"),
+                        'port': bot_parameters.get("webhook_port", 8443),
+                        'path': bot_parameters.get("webhook_path", '/' + str(self.nickname)),
+                        'secret': bot_parameters.get("webhook_secret")}
+        self.webhook_server = None
+        self.webhook_deliver = None
         
         logging.info('Collection init')
         self.bot_files = TelegramFileId(bot_parameters.get("telegram_fileid_file"))
         self.rates = TrackRates(bot_parameters.get("track_rates_file"))
-        self.collection = TelegramMusicCollection(bot_parameters.get("collection_path"), bot_parameters.get("id3based"))
+        # collection may be built by the host and shared by several bots
+        self.collection = bot_parameters.get("collection") or make_collection(bot_parameters)
+        self.handle_signals = bot_parameters.get("handle_signals", True)
+        # usage events for telegram_music_stats.py
+        self.events = EventLog(bot_parameters.get("events_file"), self.nickname)
+
+        self.watcher = None
+        # attached collections are watched by the exporting process
+        if bot_parameters.get("watch_collection") and not bot_parameters.get("collection_mmap_file"):
+            self.watcher = CollectionWatcher(self.collection, debounce=bot_parameters.get("watch_debounce", 2.0), poll_interval=bot_parameters.get("watch_poll_interval", 30), persist_interval=bot_parameters.get("watch_persist_interval", 60.0))
+
+        # tracks are uploaded to preload chat in background to get their file ids before users ask for them
+        self.preload_chat_id = bot_parameters.get("preload_chat_id")
+        self.preload_on_start = bot_parameters.get("preload", False)
+        self.preloader = None
+        if self.preload_chat_id:
+            self.preloader = CollectionPreloader(self.collection, self.bot_files, self.rates, self.upload_track,
+                                                 workers=bot_parameters.get("preload_workers", 2), interval=bot_parameters.get("preload_interval", 1.0))
+
+        self.setup_dispatcher(bot_parameters)
+        INDEX_VERSION.labels(self.nickname).set_function(lambda: self.collection.version)
+        if self.outbox:
+            OUTBOX_QUEUED.labels(self.nickname).set_function(lambda: self.outbox.stats()['queued'])
+        # bots of one process share metrics and their endpoint
+        if bot_parameters.get("metrics_port"):
+            MetricsServer.get(bot_parameters.get("metrics_listen", "0.0.0.0"), bot_parameters.get("metrics_port"))
+        logging.info('Init done') 
 
-        self.updater = Updater(token=bot_parameters.get("token"), workers=32)
+    def setup_dispatcher(self, bot_parameters):
+        """
+        creates python-telegram-bot updater and registers threaded handlers
+        messages are sent through rate limited outbox unless send_queue is off
+        """
+        if bot_parameters.get("send_queue", True):
+            outbox_workers = bot_parameters.get("send_workers", 8)
+            self.outbox = ThreadOutbox(outbox_workers, bot_parameters.get("upload_workers", 4), **send_limits(bot_parameters))
+            bot = QueuedBot(bot_parameters.get("token"), self.outbox, base_url=self.api_base_url, request=InstrumentedRequest(con_pool_size=32 + outbox_workers + 4))
+        else:
+            self.outbox = None
+            bot = Bot(bot_parameters.get("token"), base_url=self.api_base_url, request=InstrumentedRequest(con_pool_size=32 + 4))
+        self.updater = Updater(bot=bot, workers=32)
+        self.uploader = StreamingUploader(bot_parameters.get("token"), self.api_base_url)
         self.dispatcher = self.updater.dispatcher
 
         
         logging.info('Registering handlers...') 
 
-        hlo_ch = partial(hello_command_handler, hello_html=self.hello_html)
-        unkn_ch = partial(unknown_command, hello_html=self.hello_html)
-        som_ch = partial(message_handler,collection=self.collection, rates=self.rates)
-        rndm_ch = partial(random_command_handler, collection=self.collection, rates=self.rates)
-        lks_ch = partial(liked_command_handler, collection=self.collection, rates=self.rates)
-        t100_ch = partial(top100_command_handler, collection=self.collection, rates=self.rates)
-        ply_ch = partial(play_command, collection=self.collection, bot_files=self.bot_files)
-        rate_ch = partial(rate_command, collection=self.collection, bot_files=self.bot_files, rates=self.rates)
-        btn_ch = partial(button_callback, collection=self.collection, bot_files=self.bot_files, rates=self.rates)
+        hlo_ch = partial(hello_command_handler, hello_html=self.hello_html, events=self.events)
+        unkn_ch = partial(unknown_command, hello_html=self.hello_html, events=self.events)
+        som_ch = partial(message_handler,collection=self.collection, rates=self.rates, events=self.events)
+        rndm_ch = partial(random_command_handler, collection=self.collection, rates=self.rates, events=self.events)
+        lks_ch = partial(liked_command_handler, collection=self.collection, rates=self.rates, events=self.events)
+        t100_ch = partial(top100_command_handler, collection=self.collection, rates=self.rates, events=self.events)
+        ply_ch = partial(play_command, collection=self.collection, bot_files=self.bot_files, uploader=self.uploader, events=self.events)
+        rate_ch = partial(rate_command, collection=self.collection, bot_files=self.bot_files, rates=self.rates, events=self.events)
+        btn_ch = partial(button_callback, collection=self.collection, bot_files=self.bot_files, rates=self.rates, events=self.events)
+        rndx_ch = partial(reindex_command_handler, collection=self.collection, admins=self.admins, events=self.events)
+        upld_ch = partial(upload_command_handler, preloader=self.preloader, admins=self.admins, events=self.events)
         play_command_filter = PlayCommandsFilter()
         rate_command_filter = RateCommandsFilter()
 
@@ -46,6 +110,8 @@ class TelegramMusicBot:
         self.dispatcher.add_handler(CommandHandler('random', rndm_ch))
         self.dispatcher.add_handler(CommandHandler('mylikes', lks_ch))
         self.dispatcher.add_handler(CommandHandler('top100', t100_ch))
+        self.dispatcher.add_handler(CommandHandler('reindex', rndx_ch))
+        self.dispatcher.add_handler(CommandHandler(['upload', 'stop_upload', 'upload_status'], upld_ch))
         self.dispatcher.add_handler(MessageHandler(play_command_filter, ply_ch))
         self.dispatcher.add_handler(MessageHandler(rate_command_filter, rate_ch))
 
@@ -56,43 +122,196 @@ class TelegramMusicBot:
         
         # log all errors
         self.dispatcher.add_error_handler(error)
-        logging.info('Init done') 
 
     def start(self):
         #Start the bot
-        logging.info('Start polling...') 
-        self.updater.start_polling()
+        if self.update_mode == 'webhook':
+            self.start_webhook()
+        else:
+            logging.info('Start polling...') 
+            self.updater.start_polling()
+        if self.watcher:
+            self.watcher.start()
+        if self.preloader and self.preload_on_start:
+            self.preloader.start()
+        # kill -HUP rebuilds collection index without restarting the bot
+        if self.handle_signals:
+            signal.signal(signal.SIGHUP, lambda signum, frame: self.collection.reindex_async())
+
+    def alive(self):
+        """
+        returns False if bot stopped receiving or handling updates
+        """
+        if self.update_mode == 'webhook':
+            # updater is not started in webhook mode, updates come from the shared server
+            return self.dispatcher.running and self.webhook_server is not None and self.webhook_server.alive()
+        return self.updater.running and self.dispatcher.running
+
+    def stop(self):
+        if self.preloader:
+            self.preloader.stop()
+        if self.webhook_server:
+            self.webhook_server.remove_route(self.webhook['path'], self.webhook_deliver)
+        self.updater.stop()
+        self.dispatcher.stop()
+        if self.outbox:
+            self.outbox.close()
+        self.uploader.close()
+        self.close()
+
+    def close(self):
+        """
+        closes stores and watcher of stopped bot, so bot started again opens the same files alone
+        """
+        if self.watcher:
+            self.watcher.stop()
+        self.bot_files.close()
+        self.rates.close()
+        self.events.close()
+
+    def upload_track(self, index, caption):
+        """
+        uploads track to preload chat, returns its telegram file id
+        """
+        # uploads wait for interactive replies in outbox
+        sent = upload_audio(self.updater.bot, self.uploader, self.preload_chat_id, index, caption, BACKGROUND, timeout=300)
+        return sent['audio']['file_id']
+
+    def start_webhook(self):
+        """
+        receives updates with shared embedded webhook server and puts them to dispatcher queue
+        """
+        logging.info('Start webhook on %s:%d%s...', self.webhook['listen'], self.webhook['port'], self.webhook['path'])
+        server = self.webhook_server = WebhookServer.get(self.webhook['listen'], self.webhook['port'])
+        bot = self.updater.bot
+        def deliver(updates):
+            for data in updates:
+                self.dispatcher.update_queue.put(Update.de_json(data, bot))
+        self.webhook_deliver = deliver
+        server.add_route(self.webhook['path'], deliver, self.webhook['secret'])
+        threading.Thread(target=self.dispatcher.start, name='dispatcher').start()
+        set_webhook(self.token, self.webhook['url'].rstrip('/') + self.webhook['path'], self.webhook['secret'], self.api_base_url)
+
+
+
+class QueuedBot(Bot):
+    """
+    python-telegram-bot Bot sending messages, edits and audio through Outbox
+    calls wait in outbox and return result as usual, priority keyword argument sets their priority class
+    """
+    def __init__(self, token, outbox, **kwargs):
+        super().__init__(token, **kwargs)
+        self.outbox = outbox
+
+    def send_message(self, chat_id, text, priority=INTERACTIVE, **kwargs):
+        return self.outbox.call(partial(Bot.send_message, self, chat_id, text, **kwargs), chat_id, priority)
+
+    def edit_message_text(self, text, chat_id=None, message_id=None, priority=INTERACTIVE, **kwargs):
+        # only the last of edits waiting in queue for the same message is sent
+        return self.outbox.call(partial(Bot.edit_message_text, self, text, chat_id=chat_id, message_id=message_id, **kwargs), chat_id, priority,
+                                key=('edit', chat_id, message_id) if message_id else None)
+
+    def send_audio(self, chat_id, audio, priority=INTERACTIVE, **kwargs):
+        def upload():
+            # retried upload is read from the start again
+            if hasattr(audio, 'seek'):
+                audio.seek(0)
+            return Bot.send_audio(self, chat_id, audio, **kwargs)
+        # cached file id is sent as quickly as a message
+        return self.outbox.call(upload, chat_id, priority, upload=not isinstance(audio, str))
+
+
+class InstrumentedRequest(Request):
+    """
+    python-telegram-bot Request recording time and errors of every Bot API call to metrics
+    """
+    def post(self, url, data, timeout=None):
+        method = url.rsplit('/', 1)[-1]
+        start = time.perf_counter()
+        try:
+            result = super().post(url, data, timeout=timeout)
+        except TelegramError as e:
+            observe_api_call(method, time.perf_counter() - start, api_error_code(e))
+            raise
+        observe_api_call(method, time.perf_counter() - start)
+        return result
+
 
+def api_error_code(e):
+    """
+    returns Bot API error code of python-telegram-bot exception, network errors have none
+    """
+    if isinstance(e, RetryAfter):
+        return 429
+    if isinstance(e, Unauthorized):
+        return 401
+    if isinstance(e, BadRequest):
+        return 400
+    if isinstance(e, TimedOut):
+        return 'timeout'
+    return 'network'
+
+
+def send_limits(bot_parameters):
+    """
+    returns Outbox limits from bot yaml parameters, defaults follow telegram flood limits
+    """
+    return {'rate': bot_parameters.get("send_rate", 30),
+            'burst': bot_parameters.get("send_burst", 30),
+            'chat_rate': bot_parameters.get("chat_send_rate", 1),
+            'chat_burst': bot_parameters.get("chat_send_burst", 3)}
+
+
+def make_collection(bot_parameters):
+    """
+    builds TelegramMusicCollection configured by bot yaml parameters
+    or attaches to index exported by another process if collection_mmap_file is set
+    """
+    if bot_parameters.get("collection_mmap_file"):
+        return MmapCollection(bot_parameters.get("collection_mmap_file"), bot_parameters.get("collection_path"),
+                              bot_parameters.get("search_cache_size", 1024), bot_parameters.get("search_cache_ttl", 600), bot_parameters.get("random_shuffle"))
+    index_workers = (bot_parameters.get("index_workers") or os.cpu_count()) if bot_parameters.get("parallel_indexing") else 1
+    return TelegramMusicCollection(bot_parameters.get("collection_path"), bot_parameters.get("id3based"), bot_parameters.get("collection_index_file"), index_workers,
+                                   bot_parameters.get("search_cache_size", 1024), bot_parameters.get("search_cache_ttl", 600), bot_parameters.get("random_shuffle"),
+                                   bot_parameters.get("collection_export_file"))
 
 
 @run_async
 def search_on_message_handler(bot, update, collection, bot_files):
-    logging.info('New update: %s', update) 
+    logging.debug('New update: %s', update) 
     send_search_result_message(bot=bot, chat_id=update.message.chat_id, message_id=update.message.message_id, search_str=update.message.text, collection=collection, bot_files=bot_files)
 
 @run_async
-def message_handler(bot, update, collection,  rates):
+@measured
+def message_handler(bot, update, collection,  rates, events):
     """searching collection with message text"""
-    logging.info('New update: %s', update)
-    track_list = collection.search(update.message.text)
-    show_track_list(bot=bot, chat_id=update.message.chat_id, message_id=update.message.message_id, track_list=track_list, collection=collection, rates=rates)
+    logging.debug('New update: %s', update)
+    with events.timed('search', *sender(update), query=update.message.text) as event:
+        index = collection.snapshot()
+        track_list = index.search(update.message.text)
+        event['results'] = len(track_list)
+        show_track_list(bot=bot, chat_id=update.message.chat_id, message_id=update.message.message_id, track_list=track_list, collection=index, rates=rates)
     
 @run_async
-def button_callback(bot, update, collection, bot_files, rates):
-    logging.info('New update: %s', update)
+@measured
+def button_callback(bot, update, collection, bot_files, rates, events):
+    logging.debug('New update: %s', update)
     logging.info('Callback data: %s', update.callback_query.data)
+    index = collection.snapshot()
     if (update.callback_query.data == '/random'):
-        random(bot, update.callback_query.message.chat_id, update.callback_query.message.message_id, collection, update.callback_query)
+        with events.timed('random', *sender(update)):
+            random(bot, update.callback_query.message.chat_id, update.callback_query.message.message_id, index, update.callback_query)
         update.callback_query.answer()
         return()
     if re.search('upd[slt]w', update.callback_query.data):
         page_setup = json.loads(update.callback_query.data)
-        update_page(bot=bot, 
-                    chat_id=update.callback_query.message.chat_id, 
-                    message=update.callback_query.message, 
-                    page_setup=page_setup,
-                    collection=collection, 
-                    rates=rates) 
+        with events.timed('page', *sender(update), list=page_setup['q'], page=page_setup['wpos']):
+            update_page(bot=bot, 
+                        chat_id=update.callback_query.message.chat_id, 
+                        message=update.callback_query.message, 
+                        page_setup=page_setup,
+                        collection=index, 
+                        rates=rates) 
         update.callback_query.answer()
         return()
     if (update.callback_query.data == '_useless_button_'):
@@ -119,11 +338,18 @@ def show_track_list(bot, chat_id, message_id, track_list, collection, rates, hig
     """
     Sends track list without keyboard if results are short or send it with keyboard otherwise
     """
+    content, reply_markup = track_list_message(track_list, collection, rates, page_type)
+    bot.send_message(chat_id=chat_id, reply_to_message_id=message_id,  text=content, parse_mode='HTML', reply_markup=reply_markup)
+ 
+
+def track_list_message(track_list, collection, rates, page_type="search"):
+    """
+    Returns (content, reply markup) of track list message, reply markup is None if results fit one page
+    """
     page_size = 6
     pages = math.ceil(len(track_list)/page_size)
     if pages <= 1:
-        content = list2text(track_list, collection, rates)
-        bot.send_message(chat_id=chat_id, reply_to_message_id=message_id,  text=content, parse_mode='HTML')
+        return list2text(track_list, collection, rates), None
     else:
         if page_type == "search":
             current_page_setup = {'q': 'updsw', 'wsz': page_size, 'wpos': 1, 'now': pages}
@@ -137,7 +363,7 @@ def show_track_list(bot, chat_id, message_id, track_list, collection, rates, hig
         keyboard = get_page_keyboard(current_page_setup)
         logging.debug(str(track_list[:page_size]))
         content = list2text(track_list[:page_size], collection, rates=rates)
-        bot.send_message(chat_id=chat_id, reply_to_message_id=message_id,  text=content, parse_mode='HTML', reply_markup=InlineKeyboardMarkup(keyboard))
+        return content, InlineKeyboardMarkup(keyboard)
  
 
 
@@ -158,11 +384,9 @@ def get_page_content(message, page_setup, collection, rates, highlight_rated=Fal
         to_index = page_setup['wpos'] * page_setup['wsz']
         return list2text(track_list[from_index:to_index], collection, rates, highlight_rated, hide_rate)
     elif page_setup["q"] == "updtw":
-        track_list = rates.get_top100()
-        track_list = [t for t in track_list if collection.exists(t)]
         from_index = (page_setup['wpos'] - 1) * page_setup['wsz']
-        to_index = page_setup['wpos'] * page_setup['wsz']
-        return list2text(track_list[from_index:to_index], collection, rates, highlight_rated, hide_rate)
+        track_list = rates.get_top100(track_filter=collection.exists, offset=from_index, count=page_setup['wsz'])
+        return list2text(track_list, collection, rates, highlight_rated, hide_rate)
 
 def get_page_keyboard(page_setup):
     """
@@ -209,114 +433,215 @@ def random(bot, chat_id, message_id, collection, callback_query=None):
     """
     returns a message with 3 random tracks
     """
+    text_html, reply_markup = random_message(chat_id, collection)
+    if callback_query:
+        bot.edit_message_text(chat_id=chat_id, message_id=message_id, text=text_html, parse_mode='HTML', reply_markup=reply_markup)
+    else:
+        bot.send_message(chat_id=chat_id, reply_to=message_id,  text=text_html, parse_mode='HTML', reply_markup=reply_markup)
+
+def random_message(chat_id, collection):
+    """
+    Returns (content, reply markup) of a message with 3 random tracks
+    """
     text_html = '<b>Random tracks:</b>\n'
     for i in range(3):
-        caption = collection.random()
+        caption = collection.random(chat_id)
         play_command = '/play_' + collection.hash(caption)
         rate_command = '/rate_' + collection.hash(caption)
         text_html += '%s\n<i>Download: </i>%s\n👍 %s\n\n' % (caption, play_command,rate_command)
     keyboard = [[InlineKeyboardButton(text="↻", callback_data="/random")]]
-    if callback_query:
-        bot.edit_message_text(chat_id=chat_id, message_id=message_id, text=text_html, parse_mode='HTML', reply_markup=InlineKeyboardMarkup(keyboard))
-    else:
-        bot.send_message(chat_id=chat_id, reply_to=message_id,  text=text_html, parse_mode='HTML', reply_markup=InlineKeyboardMarkup(keyboard))
+    return text_html, InlineKeyboardMarkup(keyboard)
 
 @run_async       
-def random_command_handler(bot, update, collection, rates):
-    logging.info('New update: %s', update)
-    random(bot, update.message.chat_id, update.message.message_id, collection)
+@measured
+def random_command_handler(bot, update, collection, rates, events):
+    logging.debug('New update: %s', update)
+    with events.timed('random', *sender(update)):
+        random(bot, update.message.chat_id, update.message.message_id, collection.snapshot())
 
 @run_async       
-def liked_command_handler(bot, update, collection, rates):
-    logging.info('New update: %s', update)
-    track_list = rates.get_liked_tracks(update.message.chat.username)
-    track_list = [t for t in track_list if collection.exists(t)]
-    show_track_list(bot=bot, chat_id=update.message.chat_id, message_id=update.message.message_id, track_list=track_list, collection=collection, rates=rates, page_type="likes")    
+@measured
+def liked_command_handler(bot, update, collection, rates, events):
+    logging.debug('New update: %s', update)
+    with events.timed('likes', *sender(update)) as event:
+        index = collection.snapshot()
+        track_list = rates.get_liked_tracks(update.message.chat.username)
+        track_list = [t for t in track_list if index.exists(t)]
+        event['results'] = len(track_list)
+        show_track_list(bot=bot, chat_id=update.message.chat_id, message_id=update.message.message_id, track_list=track_list, collection=index, rates=rates, page_type="likes")    
     
 @run_async       
-def top100_command_handler(bot, update, collection, rates):
-    logging.info('New update: %s', update)
-    track_list = rates.get_top100()
-    logging.debug(str(track_list))
-    track_list = [t for t in track_list if collection.exists(t)]
-    logging.debug(str(track_list))
-    show_track_list(bot=bot, chat_id=update.message.chat_id, message_id=update.message.message_id, track_list=track_list, collection=collection, rates=rates, page_type="top100")    
+@measured
+def top100_command_handler(bot, update, collection, rates, events):
+    logging.debug('New update: %s', update)
+    with events.timed('top100', *sender(update)) as event:
+        index = collection.snapshot()
+        track_list = rates.get_top100(track_filter=index.exists)
+        logging.debug(str(track_list))
+        event['results'] = len(track_list)
+        show_track_list(bot=bot, chat_id=update.message.chat_id, message_id=update.message.message_id, track_list=track_list, collection=index, rates=rates, page_type="top100")    
+
+def file_id_rejected(description):
+    """
+    returns True if Bot API error description says that file id itself can't be sent, e.g. it's stale or belongs to another bot
+    """
+    return bool(re.search(r'file identifier|file_id|file reference|type of file mismatch', str(description), re.IGNORECASE))
 
-def send_audio_file_by_hash(bot, update, chat_id, hash, collection, bot_files):
+def send_audio_file_by_hash(bot, update, chat_id, hash, collection, bot_files, uploader):
     """
     sends file associated with caption in mds collection
-    """ 
-    
+    cached file id is sent if there is one, file is opened and uploaded only if there is no id or it's rejected
+    returns 'file_id' or 'upload' as file was sent, None if it wasn't
+    """
     caption = collection.get_by_hash(hash)
-    
-    if collection.exists(caption):
-        audio_file = open(str(collection.path(caption)) , 'rb')
-    else:
+    if not collection.exists(caption):
         return
 
     file_id = bot_files.get(collection.filename(caption))
-    
-    logging.info('Will send file %s with id %s' % (str(audio_file), str(file_id)))
-    if file_id: 
+    logging.info('Will send %s with id %s', caption, file_id)
+    if file_id:
         try:
             sent = bot.send_audio(chat_id=chat_id, audio=file_id, caption=caption, title=collection.title(caption), performer=collection.author(caption), duration=collection.length(caption), timeout=60)
             logging.info('File sent, got: %s', sent)
-        except TelegramError:
-            sent = bot.send_audio(chat_id=chat_id, audio=audio_file, caption=caption, title=collection.title(caption), performer=collection.author(caption), duration=collection.length(caption), timeout=60)
-            logging.info('File sent, got: %s', sent)
-            bot_files.set(collection.filename(caption), sent['audio']['file_id'])
-    else:
-        sent = bot.send_audio(chat_id=chat_id, audio=audio_file, caption=caption, title=collection.title(caption), performer=collection.author(caption), duration=collection.length(caption), timeout=60)
-        logging.info('File sent, got: %s', sent)
-        bot_files.set(collection.filename(caption), sent['audio']['file_id'])
-    
-    audio_file.close()
+            return 'file_id'
+        except BadRequest as e:
+            if not file_id_rejected(e.message):
+                # e.g. chat not found, file id is still good
+                logging.error('Can not send %s: %s', caption, e)
+                return
+            # id is stale or belongs to another bot, file is uploaded again
+            logging.warning('File id %s of %s is rejected: %s', file_id, caption, e)
+            bot_files.remove(collection.filename(caption))
+        except TelegramError as e:
+            logging.error('Can not send %s: %s', caption, e)
+            return
+
+    try:
+        sent = upload_audio(bot, uploader, chat_id, collection, caption, INTERACTIVE)
+    except FileNotFoundError:
+        # file was merged or split after the index snapshot was taken
+        logging.warning('File for %s is gone, reindex pending?', caption)
+        return
+    except (UploadError, OSError, TelegramError) as e:
+        logging.error('Can not upload %s: %s', caption, e)
+        return
+    logging.info('File sent, got: %s', sent)
+    bot_files.set(collection.filename(caption), sent['audio']['file_id'])
+    return 'upload'
+
+def upload_audio(bot, uploader, chat_id, collection, caption, priority, timeout=120):
+    """
+    streams file of caption to chat, goes through outbox if bot is queued,
+    where it is rate limited with other calls but runs on upload threads
+    returns sent message as Bot API json dict
+    """
+    with open(str(collection.path(caption)), 'rb') as audio_file:
+        upload = partial(uploader.send_audio, chat_id, audio_file, collection.filename(caption), timeout=timeout, caption=caption,
+                         title=collection.title(caption), performer=collection.author(caption), duration=collection.length(caption))
+        if isinstance(bot, QueuedBot):
+            return bot.outbox.call(upload, chat_id, priority, upload=True)
+        return upload()
 
 def inline_handler(bot, update):
     """
     inline query handler
     """
-    logging.info('New update: %s', update) 
+    logging.debug('New update: %s', update) 
     
 
 
 
 @run_async    
-def hello_command_handler(bot,update,hello_html):
+@measured
+def hello_command_handler(bot,update,hello_html, events):
     """Send a message when /start received
     """
     
-    logging.info('New update: %s', update) 
-    keyboard = [[InlineKeyboardButton(text="I'm feeling lucky", callback_data='/random')]]
-    bot.send_message(chat_id=update.message.chat_id, text=hello_html, parse_mode='HTML', reply_markup=InlineKeyboardMarkup(keyboard))
+    logging.debug('New update: %s', update) 
+    with events.timed('start', *sender(update), command=update.message.text.split()[0] if update.message.text else None):
+        keyboard = [[InlineKeyboardButton(text="I'm feeling lucky", callback_data='/random')]]
+        bot.send_message(chat_id=update.message.chat_id, text=hello_html, parse_mode='HTML', reply_markup=InlineKeyboardMarkup(keyboard))
 
 @run_async
-def play_command(bot, update, collection, bot_files):
+@measured
+def play_command(bot, update, collection, bot_files, uploader, events):
     """plays an audio file on /play_hash command
     """
-    logging.info('New update: %s', update) 
+    logging.debug('New update: %s', update) 
     if not '/play_' in update.message.text:
         return()
     mds_track_hash = update.message.text.partition('_')[2]
-    send_audio_file_by_hash(bot, update, update.message.chat_id, mds_track_hash, collection, bot_files)
+    with events.timed('play', *sender(update), hash=mds_track_hash) as event:
+        event['sent'] = send_audio_file_by_hash(bot, update, update.message.chat_id, mds_track_hash, collection.snapshot(), bot_files, uploader)
         
 @run_async
-def rate_command(bot, update, collection, bot_files, rates):
+@measured
+def rate_command(bot, update, collection, bot_files, rates, events):
     """plays an audio file on /play_hash command
     """
-    logging.info('New update: %s', update) 
+    logging.debug('New update: %s', update) 
     if not '/rate_' in update.message.text:
         return()
     mds_track_hash = update.message.text.partition('_')[2]
-    rates.rate(update.message.chat.username, collection.get_by_hash(mds_track_hash))
-    print("%s rated %s!" % (update.message.chat.username, collection.get_by_hash(mds_track_hash)))
+    with events.timed('rate', *sender(update), hash=mds_track_hash):
+        caption = collection.get_by_hash(mds_track_hash)
+        rates.rate(update.message.chat.username, caption)
+    logging.debug("%s rated %s", update.message.chat.username, caption)
 
      
 
-def unknown_command(bot, update, hello_html):
+@run_async
+@measured
+def reindex_command_handler(bot, update, collection, admins, events):
+    """rebuilds collection index in background on /reindex from bot admins
+    """
+    logging.debug('New update: %s', update)
+    events.emit('reindex', chat=update.message.chat_id, user=update.message.chat.username)
+    if update.message.chat.username not in admins:
+        return()
+    if collection.reindex_async():
+        text = 'Reindex started, current index version is %d' % collection.version
+    else:
+        text = 'Reindex is already running'
+    bot.send_message(chat_id=update.message.chat_id, reply_to_message_id=update.message.message_id, text=text)
+
+@run_async
+@measured
+def upload_command_handler(bot, update, preloader, admins, events):
+    """starts or stops background upload of collection on /upload and /stop_upload from bot admins
+    """
+    logging.debug('New update: %s', update)
+    events.emit('upload', chat=update.message.chat_id, user=update.message.chat.username, command=update.message.text.split()[0])
+    if update.message.chat.username not in admins:
+        return()
+    bot.send_message(chat_id=update.message.chat_id, reply_to_message_id=update.message.message_id, text=upload_command(update.message.text, preloader))
+
+def upload_command(text, preloader):
+    """
+    applies /upload, /stop_upload or /upload_status to preloader, returns reply text
+    """
+    if preloader is None:
+        return 'Preloading is not configured, set preload_chat_id'
+    command = text[1:].split()[0].split('@')[0]
+    if command == 'upload' and not preloader.start():
+        return 'Preloading is already running'
+    if command == 'stop_upload':
+        preloader.stop()
+    return preloader.status()
+
+@measured
+def unknown_command(bot, update, hello_html, events):
     """Logs unknown command"""
-    logging.info('New update: %s', update) 
-    hello_command_handler(bot, update, hello_html)
+    logging.debug('New update: %s', update) 
+    hello_command_handler(bot, update, hello_html, events)
+
+def sender(update):
+    """
+    returns (chat id, username) of update for events
+    """
+    chat = update.effective_chat
+    user = update.effective_user
+    return (chat.id if chat else None), (user.username if user else None)
 
 def error(bot, update, error):
     """Log Errors caused by Updates."""
@@ -325,75 +650,153 @@ def error(bot, update, error):
 class TelegramFileId:
     """
     TelegramFileId represents telegram bot filename: id dictionary
+    Changes are kept in memory and written behind to telegram_fileid_file.log, see PickleJournal
     """
     def __init__(self, pickle_filename):
         """
-        if pickle_filename exists - reads dictionary from it
+        if pickle_filename exists - reads dictionary from it in background, get() waits for it
         if file not exists - creates it and dumps to it
         """
         self.file = Path(pickle_filename)
-        if self.file.exists():
-            self.idict = pickle.load(open(self.file, 'rb'))
-        else:
-            self.idict = {}
-            pickle.dump(self.idict, open(self.file, 'wb'))
+        self.lock = threading.Lock()
+        self.loaded = threading.Event()
+        self.idict = {}
+        self.journal = PickleJournal(self.file, lambda: self.idict, self.lock, flush_interval=5.0)
+        threading.Thread(target=self.load, name='load-' + self.file.name, daemon=True).start()
 
-    
+    def load(self):
+        """
+        file ids are only a cache of uploaded files, so unreadable file is logged and bot starts with empty dictionary
+        """
+        try:
+            try:
+                snapshot, records = self.journal.load()
+            except Exception as e:
+                logging.error('Can not load file ids from %s, starting with empty ones: %s', str(self.file), e)
+                snapshot, records = None, []
+            with self.lock:
+                # ids set before loading finished are newer than stored ones
+                idict = snapshot or {}
+                for record in records:
+                    self.apply(idict, *record)
+                idict.update(self.idict)
+                self.idict = idict
+            self.journal.start()
+            logging.info('Loaded %d file ids from %s', len(idict), str(self.file))
+        except Exception as e:
+            logging.error('Can not start file ids journal %s: %s', str(self.file), e)
+        finally:
+            self.loaded.set()
+
+    def apply(self, idict, filename, id=None):
+        if id is None:
+            idict.pop(filename, None)
+        else:
+            idict[filename] = id
 
     def dump(self):
         """
         Serializing to file
         """
-        pickle.dump(self.idict, open(self.file, 'wb'))
+        self.loaded.wait()
+        self.journal.compact()
+
+    def close(self):
+        """
+        writes pending changes and stops journal writer
+        """
+        self.loaded.wait()
+        self.journal.close()
 
     def set(self, filename, id):
-        self.idict[filename] = id
-        self.dump()
+        with self.lock:
+            self.idict[filename] = id
+            self.journal.append([filename, id])
     
 
     def remove(self, filename):
-        if filename in self.idict.keys():
-            del(self.idict[filename])
-            self.dump()
+        self.loaded.wait()
+        with self.lock:
+            if filename in self.idict.keys():
+                del(self.idict[filename])
+                self.journal.append([filename])
 
     def __str__(self):
         return str(self.idict)
     
     def get(self, name):
-        if name in self.idict.keys():
-            return self.idict[name]
-        else:
-            return None
+        self.loaded.wait()
+        return self.idict.get(name)
 
 class TrackRates:
     """
     Stores track rates idict[track_name][user_name] = int(time.time())
+    Likes are appended to track_rates_file.log and compacted into track_rates_file pickle from time to time
+    Keeps tracks grouped by number of likes and user: liked tracks index, so top and likes lists don't scan all rates
     """
     def __init__(self, pickle_filename):
         """
-        if pickle_filename exists - reads dictionary from it
+        if pickle_filename exists - reads dictionary from it and replays likes logged after it
         if file not exists - creates it and dumps to it
+        pickles written by older versions are read as is
+        self.buckets - a python dict number of likes: {track_name: None} in order tracks got that number
+        self.bucket_sizes - sorted list of self.buckets keys
+        self.user_likes - a python dict user_name: {track_name: None} in order of likes
         """
         self.file = Path(pickle_filename)
-        if self.file.exists():
-            self.idict = pickle.load(open(self.file, 'rb'))
-        else:
-            self.idict = {}
-            pickle.dump(self.idict, open(self.file, 'wb'))
-
-    
+        self.lock = threading.Lock()
+        self.journal = PickleJournal(self.file, lambda: self.idict, self.lock)
+        snapshot, records = self.journal.load()
+        self.idict = {}
+        self.buckets = {}
+        self.bucket_sizes = []
+        self.user_likes = {}
+        for track_name, users in (snapshot or {}).items():
+            for user_name, rate_time in users.items():
+                self.apply(user_name, track_name, rate_time)
+        for user_name, track_name, rate_time in records:
+            self.apply(user_name, track_name, rate_time)
+        self.journal.start()
 
     def dump(self):
         """
         Serializing to file
         """
-        pickle.dump(self.idict, open(self.file, 'wb'))
+        self.journal.compact()
+
+    def close(self):
+        """
+        writes pending changes and stops journal writer
+        """
+        self.journal.close()
+
+    def apply(self, user_name, track_name, rate_time):
+        if track_name not in self.idict.keys(): self.idict[track_name] = {}
+        users = self.idict[track_name]
+        if user_name not in users:
+            self.move(track_name, len(users), len(users) + 1)
+            self.user_likes.setdefault(user_name, {})[track_name] = None
+        users[user_name] = rate_time
+
+    def move(self, track_name, likes, new_likes):
+        """moves track between like buckets"""
+        if likes:
+            bucket = self.buckets[likes]
+            del bucket[track_name]
+            if not bucket:
+                del self.buckets[likes]
+                del self.bucket_sizes[bisect.bisect_left(self.bucket_sizes, likes)]
+        if new_likes not in self.buckets:
+            self.buckets[new_likes] = {}
+            bisect.insort(self.bucket_sizes, new_likes)
+        self.buckets[new_likes][track_name] = None
 
     def rate(self, user_name, track_name):
         """rates track_name by user_name. idict keeps last "like" of song by user. """
-        if track_name not in self.idict.keys(): self.idict[track_name] = {}
-        self.idict[track_name][user_name] = int(time.time())
-        self.dump()
+        rate_time = int(time.time())
+        with self.lock:
+            self.apply(user_name, track_name, rate_time)
+            self.journal.append([user_name, track_name, rate_time])
     
     def __str__(self):
         return str(self.idict)
@@ -406,46 +809,27 @@ class TrackRates:
 
     def get_liked_tracks(self, user_name):
         """Returns list of user liked tracks"""
-        l= [t for t in self.idict.keys() if user_name in self.idict[t].keys()]
-        print("likes: " + str(l))
-        return l
+        with self.lock:
+            return list(self.user_likes.get(user_name, ()))
+
+    def iter_top(self):
+        """Yields tracks from most liked to least liked, self.lock must be held"""
+        for likes in reversed(self.bucket_sizes):
+            yield from self.buckets[likes]
     
-    def get_top100(self):
-        """Returns list of top 100 rated tracks"""
-        top_list = sorted(self.idict.keys(),key=lambda t: len(self.idict[t]), reverse=True)[:101]
+    def get_top100(self, track_filter=None, offset=0, count=None):
+        """
+        Returns list of top 100 rated tracks
+        track_filter - tracks it returns False for are skipped, offset and count select a page of the list
+        """
+        with self.lock:
+            tracks = filter(track_filter, itertools.islice(self.iter_top(), 101))
+            top_list = list(itertools.islice(tracks, offset, None if count is None else offset + count))
         logging.debug(str(top_list))
         return top_list
         
 
 
-def upload_collection(bot, update):
-    """
-    uploads full MDS collection. the purpose is to update telegram file ids for quick upload in future.
-    """
-    
-    logging.info('New update: %s', update) 
-    global bot_files
-    global mds    
-    global ok_to_upload_collection 
-    
-    ok_to_upload_collection = True
-    
-    for caption in collection.mds_dict:
-        logging.info('Uploading %s', caption) 
-        if not ok_to_upload_collection: return
-        send_audio_file_by_hash(bot, update, update.message.chat_id, collection.hash(caption))
-
-def stop_uploading_collection(bot, update):
-    """
-    stops collection upload
-    """
-    logging.info('New update: %s', update)
-    global ok_to_upload_collection 
-    logging.info('ok_to_upload_collection = %s', ok_to_upload_collection)
-    ok_to_upload_collection = False
-    logging.info('ok_to_upload_collection = %s', ok_to_upload_collection)
-    
-    
 class PlayCommandsFilter(BaseFilter):
     """
     filter for /play_hash commands
@@ -461,10 +845,6 @@ class RateCommandsFilter(BaseFilter):
         return bool(message.text and message.text.startswith('/rate'))
 
 
-
-ok_to_upload_collection = True
-
-
 def main():
     try:
         bot_params = yaml.load(open(sys.argv[1]))
@@ -480,7 +860,13 @@ def main():
     logging.getLogger('').addHandler(lfh)
     
     if 'id3based' not in bot_params.keys(): bot_params['id3based'] = False
-    mds_bot = TelegramMusicBot(**bot_params)
+    bot_params.setdefault('events_file', 'bots/log/' + bot_params['nickname'] + '.events.jsonl')
+    if bot_params.get('runtime') == 'asyncio':
+        # aiohttp is needed for asyncio runtime only
+        from telegram_music_aio import AioTelegramMusicBot
+        mds_bot = AioTelegramMusicBot(**bot_params)
+    else:
+        mds_bot = TelegramMusicBot(**bot_params)
     
     mds_bot.start()
 
@@ -8,18 +8,54 @@ prepare for telegram bot usage
 """
 
 import logging
+import os
+import pickle
 from pathlib import Path
-from difflib import get_close_matches
+from difflib import SequenceMatcher
+from array import array
+from collections import Counter, OrderedDict
+from collections.abc import Mapping, MutableMapping, Sequence, Set
+from concurrent.futures import ProcessPoolExecutor
+import heapq
+import itertools
+import math
+import multiprocessing
 import re
 import random
+import threading
+import time
 from hashlib import md5
 from mutagen.mp3 import MP3
 from mutagen.easyid3 import EasyID3
 from base64 import b64encode
+from telegram_music_metrics import SEARCH_RESULTS, EXACT_CANDIDATES, FUZZY_CANDIDATES, CACHE_HITS, CACHE_MISSES
 
 logging.basicConfig(format='%(asctime)s %(name)s %(funcName)s %(levelname)s %(message)s', level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# bump when format of mds_dict or index snapshot changes
+INDEX_SNAPSHOT_VERSION = 2
+
+# track hash is 10 hex digits
+HASH_BYTES = 5
+
+# captions of book parts and chapters, they are not offered as random tracks
+PART_PATTERN = re.compile('\(часть \d+\)|\(глава \d+\)|\(глава \d+\-\d+\)|\(часть \d+, глава \d+\)', flags=re.IGNORECASE)
+
+# n-grams found in more than this share of indexed strings, like ' - ', don't select fuzzy search candidates
+STOP_GRAM_SHARE = 0.2
+STOP_GRAM_MIN = 1000
+
+# fuzzy search counts n-grams shared with the query in postings holding up to that many strings
+FUZZY_POSTINGS_MAX = 5000
+# and compares with difflib only that many strings which share most of them
+FUZZY_CANDIDATES_MAX = 200
+
+# index updated with that many changed tracks copies its layered structures into plain ones
+LAYERED_CHANGES = 1000
+# posting set changed by less than 1/LAYERED_SHARE of its size stays layered after compaction
+LAYERED_SHARE = 16
+
 def get_author(filename):
     """extracts author from filename 'Author - title'"""
     separator = ' - '
@@ -37,63 +73,888 @@ def get_title(filename):
         return filename
 
 
+def read_track(p, id3based = False):
+    """
+    args: p - Path object of mp3 file
+    returns (caption, track info dict) for given file
+    mp3 file is opened once, only id3 tag and first frame headers are read
+    """
+    if (id3based):
+        audio = MP3(str(p), ID3=EasyID3)
+        file_id3 = audio.tags or {}
+        # EasyID3.keys() walks over all frames, so tags are looked up directly
+        author = (file_id3.get('artist') or [""])[0]
+        album = (file_id3.get('album') or [""])[0]
+        title = (file_id3.get('title') or [""])[0]
+        return author + ' - '*int(bool(author)) + title, {'path' : p, 
+                                                        'author': author,
+                                                        'title': title,
+                                                        'album': album,
+                                                        'filename': p.name, 
+                                                        'length': str(int(audio.info.length)), 
+                                                        'hash': md5(bytes(re.sub('\s+', ' ', p.name.strip('.mp3')), 'utf-8')).hexdigest()[:10]}
 
-class TelegramMusicCollection:
-    def __init__(self, path, id3based = False):
+    return re.sub('\s+', ' ', p.name.strip('.mp3')), {'path' : p, 
+                                                      'author' : get_author(p.name.strip('.mp3')) , 
+                                                      'title' : get_title(p.name.strip('.mp3')), 
+                                                      'filename': p.name, 
+                                                      'length': str(int(MP3(str(p)).info.length)), 
+                                                      'hash': md5(bytes(re.sub('\s+', ' ', p.name.strip('.mp3')), 'utf-8')).hexdigest()[:10]}
+
+def read_tracks(paths, id3based = False):
+    """
+    returns list of read_track results for given paths, used as a unit of work in parallel indexing
+    """
+    return [read_track(p, id3based) for p in paths]
+
+
+# marks key removed by LayeredDict changes
+REMOVED = object()
+
+
+class LayeredDict(MutableMapping):
+    """
+    Dict made of a shared base dict, which is never changed, and own changes over it.
+    Lets a new index snapshot change its dicts without copying entries of the previous one.
+    """
+    __slots__ = ('base', 'changes', 'size')
+
+    def __init__(self, base, changes=None, size=None):
         """
-        self.mds_basedir - Path object refering to base directory of mds collection
-        self.mds_dict - a python dict containing information about files in mds collection
+        self.changes - a python dict key: new value or REMOVED
         """
-        self.mds_basedir = Path(path)
-        if (self.mds_basedir.exists() and self.mds_basedir.is_dir()):
-            self.mds_dict = self.make_index(self.mds_basedir, id3based)
-            logger.info('New music collection instance created for tracks in %s' % (path)) 
+        self.base = base
+        self.changes = changes if changes is not None else {}
+        self.size = len(base) if size is None else size
+
+    def derived(self):
+        """
+        returns dict with the same items whose changes don't affect this one
+        """
+        return LayeredDict(self.base, dict(self.changes), self.size)
+
+    def __getitem__(self, key):
+        value = self.changes.get(key, self)
+        if value is self:
+            return self.base[key]
+        if value is REMOVED:
+            raise KeyError(key)
+        return value
+
+    def get(self, key, default=None):
+        value = self.changes.get(key, self)
+        if value is self:
+            return self.base.get(key, default)
+        return default if value is REMOVED else value
+
+    def __contains__(self, key):
+        value = self.changes.get(key, self)
+        if value is self:
+            return key in self.base
+        return value is not REMOVED
+
+    def __setitem__(self, key, value):
+        if key not in self:
+            self.size += 1
+        self.changes[key] = value
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self.size -= 1
+        if key in self.base:
+            self.changes[key] = REMOVED
         else:
-            raise FileNotFoundError('%s is not valid directory' % path)
+            del self.changes[key]
+
+    def __iter__(self):
+        changes = self.changes
+        for key in self.base:
+            if key not in changes:
+                yield key
+        for key, value in changes.items():
+            if value is not REMOVED:
+                yield key
+
+    def __len__(self):
+        return self.size
+
+
+class LayeredSet(Set):
+    """
+    Set made of a shared base set, which is never changed, and own added and removed elements.
+    """
+    __slots__ = ('base', 'added', 'removed')
 
-    def make_index(self, path, id3based = False):
+    def __init__(self, base, added=None, removed=None):
         """
-        args: path - Path object of base directory
-        returns dictionary with files in path directory and subdirectories
+        self.added - elements missing in base, self.removed - elements of base
         """
-        logger.info('Building index for collection in %s', str(path))
-        if (id3based):
-            index_dict = {}
-            for p in path.glob('**/*.mp3'):
-                file_id3 = EasyID3(p)
-                author = file_id3['artist'][0] if 'artist' in file_id3.keys() and file_id3['artist'] else ""
-                album = file_id3['album'][0] if 'album' in file_id3.keys() and file_id3['album'] else ""
-                title = file_id3['title'][0] if 'title' in file_id3.keys() and file_id3['title'] else ""
-                index_dict[author + ' - '*int(bool(author)) + title] = {'path' : p, 
-                                                                'author': author,
-                                                                'title': title,
-                                                                'album': album,
-                                                                'filename': p.name, 
-                                                                'length': str(int(MP3(str(p)).info.length)), 
-                                                                'hash': md5(bytes(re.sub('\s+', ' ', p.name.strip('.mp3')), 'utf-8')).hexdigest()[:10]}
-            return index_dict
-
-        return {re.sub('\s+', ' ', p.name.strip('.mp3')) : {'path' : p, 
-                                                            'author' : get_author(p.name.strip('.mp3')) , 
-                                                            'title' : get_title(p.name.strip('.mp3')), 
-                                                            'filename': p.name, 
-                                                            'length': str(int(MP3(str(p)).info.length)), 
-                                                            'hash': md5(bytes(re.sub('\s+', ' ', p.name.strip('.mp3')), 'utf-8')).hexdigest()[:10]} for p in path.glob('**/*.mp3')}
+        self.base = base
+        self.added = added if added is not None else set()
+        self.removed = removed if removed is not None else set()
+
+    @classmethod
+    def _from_iterable(cls, iterable):
+        return set(iterable)
+
+    def derived(self):
+        return LayeredSet(self.base, set(self.added), set(self.removed))
+
+    def __contains__(self, s):
+        return s in self.added or (s in self.base and s not in self.removed)
+
+    def __iter__(self):
+        if not self.removed:
+            return itertools.chain(self.base, self.added)
+        return itertools.chain(self.base - self.removed, self.added)
+
+    def __len__(self):
+        return len(self.base) - len(self.removed) + len(self.added)
+
+    def add(self, s):
+        if s in self.base:
+            self.removed.discard(s)
+        else:
+            self.added.add(s)
+
+    def discard(self, s):
+        if s in self.base:
+            self.removed.add(s)
+        else:
+            self.added.discard(s)
+
+    # set operations with python sets don't iterate over the base
+    def __and__(self, other):
+        if not isinstance(other, (set, frozenset)):
+            return Set.__and__(self, other)
+        return ((other & self.base) - self.removed) | (other & self.added)
+
+    __rand__ = __and__
+
+    def __rsub__(self, other):
+        if not isinstance(other, (set, frozenset)):
+            return Set.__rsub__(self, other)
+        return ((other - self.base) | (other & self.removed)) - self.added
+
+
+class LayeredList(Sequence):
+    """
+    List made of a shared base list, which is never changed, and own changed positions over it
+    """
+    __slots__ = ('base', 'changes', 'size')
+
+    def __init__(self, base, changes=None, size=None):
+        """
+        self.changes - a python dict position: new value
+        """
+        self.base = base
+        self.changes = changes if changes is not None else {}
+        self.size = len(base) if size is None else size
+
+    def derived(self):
+        return LayeredList(self.base, dict(self.changes), self.size)
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self.size
+        if not 0 <= i < self.size:
+            raise IndexError(i)
+        value = self.changes.get(i, self)
+        return self.base[i] if value is self else value
+
+    def __setitem__(self, i, value):
+        if i < 0:
+            i += self.size
+        if not 0 <= i < self.size:
+            raise IndexError(i)
+        self.changes[i] = value
+
+    def __len__(self):
+        return self.size
+
+    def append(self, value):
+        self.changes[self.size] = value
+        self.size += 1
+
+    def pop(self):
+        value = self[-1]
+        self.size -= 1
+        self.changes.pop(self.size, None)
+        return value
+
+
+def layered(collection):
+    """
+    returns changeable copy of dict, set, list or TrackTable of a published index, sharing unchanged data with it
+    """
+    if hasattr(collection, 'derived'):
+        return collection.derived()
+    if isinstance(collection, dict):
+        return LayeredDict(collection)
+    if isinstance(collection, (set, frozenset)):
+        return LayeredSet(collection)
+    return LayeredList(collection)
+
+
+def compacted(collection):
+    """
+    returns copy of collection made by layered() without layers
+    """
+    if hasattr(collection, 'compacted'):
+        return collection.compacted()
+    if type(collection) is LayeredDict:
+        result = dict(collection.base)
+        for key, value in collection.changes.items():
+            if value is REMOVED:
+                del result[key]
+            else:
+                result[key] = value
+        return result
+    if type(collection) is LayeredSet:
+        result = collection.base - collection.removed
+        result |= collection.added
+        return result
+    if type(collection) is LayeredList:
+        result = collection.base[:collection.size]
+        result.extend(itertools.repeat(None, collection.size - len(result)))
+        for i, value in collection.changes.items():
+            if i < collection.size:
+                result[i] = value
+        return result
+    return collection
+
+
+class Track(Mapping):
+    """
+    Read-only view of TrackTable row, behaves as track info dict returned by read_track
+    """
+    __slots__ = ('table', 'row')
+
+    def __init__(self, table, row):
+        self.table = table
+        self.row = row
+
+    def __getitem__(self, key):
+        return self.table.field(self.row, key)
+
+    def __iter__(self):
+        return iter(self.table.fields(self.row))
+
+    def __len__(self):
+        return len(self.table.fields(self.row))
+
+    def __repr__(self):
+        return repr(dict(self))
+
+
+class TrackTable(MutableMapping):
+    """
+    Compact mds_dict - caption: Track view mapping keeping tracks in columns instead of dict per track.
+    Directories, authors and albums are stored once in a string table, lengths and hashes in arrays,
+    filename is kept only if it differs from caption + '.mp3'.
+    Removed rows are reused by new tracks. Tables made by derived() share columns with the table they are made of,
+    so they don't reuse rows of their own removed or changed tracks until compacted().
+    """
+    # columns are shared with other tables
+    shared = False
+    def __init__(self, basedir='.'):
+        """
+        self.basedir - Path object, track directories are stored relative to it
+        self.rows - a python dict caption: row number, LayeredDict in derived tables
+        self.strings - string table, string 0 is None and marks track without album
+        self.directory_paths - a python dict string id: Path object of directory, not pickled,
+                               so basedir of loaded table can be changed before its tracks are read
+        """
+        self.basedir = Path(basedir)
+        self.directory_paths = {}
+        self.rows = {}
+        self.free_rows = []
+        self.strings = [None]
+        self.string_ids = {None: 0}
+        self.captions = []
+        self.titles = []
+        self.filenames = []
+        self.directories = array('I')
+        self.authors = array('I')
+        self.albums = array('I')
+        self.lengths = array('I')
+        self.hashes = bytearray()
+
+    def string_id(self, s):
+        i = self.string_ids.get(s)
+        if i is None:
+            i = self.string_ids[s] = len(self.strings)
+            self.strings.append(s)
+        return i
+
+    def new_row(self):
+        if self.free_rows:
+            return self.free_rows.pop()
+        self.captions.append(None)
+        self.titles.append(None)
+        self.filenames.append(None)
+        for column in (self.directories, self.authors, self.albums, self.lengths):
+            column.append(0)
+        self.hashes.extend(bytes(HASH_BYTES))
+        return len(self.captions) - 1
+
+    def field(self, row, key):
+        if key == 'path':
+            directory = self.directory_paths.get(self.directories[row])
+            if directory is None:
+                directory = self.directory_paths[self.directories[row]] = self.basedir / self.strings[self.directories[row]]
+            return directory / self.field(row, 'filename')
+        if key == 'filename':
+            return self.filenames[row] or self.captions[row] + '.mp3'
+        if key == 'author':
+            return self.strings[self.authors[row]]
+        if key == 'title':
+            return self.titles[row]
+        if key == 'length':
+            return str(self.lengths[row])
+        if key == 'hash':
+            return self.hashes[row * HASH_BYTES:(row + 1) * HASH_BYTES].hex()
+        if key == 'album' and self.albums[row]:
+            return self.strings[self.albums[row]]
+        raise KeyError(key)
+
+    def fields(self, row):
+        if self.albums[row]:
+            return ('path', 'author', 'title', 'album', 'filename', 'length', 'hash')
+        return ('path', 'author', 'title', 'filename', 'length', 'hash')
+
+    def __getstate__(self):
+        table = self.compacted() if self.shared else self
+        return dict(table.__dict__, directory_paths={})
+
+    def __getitem__(self, caption):
+        return Track(self, self.rows[caption])
+
+    def __setitem__(self, caption, track):
+        path = Path(track['path'])
+        try:
+            directory = str(path.parent.relative_to(self.basedir))
+        except ValueError:
+            directory = str(path.parent)
+        # values are read before row is taken, track may be a view of this table
+        values = (self.string_id(directory), self.string_id(track['author']), self.string_id(track.get('album')),
+                  int(track['length']), bytes.fromhex(track['hash']), track['title'], track['filename'])
+        row = self.rows.get(caption)
+        if row is None or self.shared:
+            # rows of shared columns may be read by other tables
+            row = self.rows[caption] = self.new_row()
+        self.directories[row], self.authors[row], self.albums[row], self.lengths[row], hash, title, filename = values
+        self.hashes[row * HASH_BYTES:(row + 1) * HASH_BYTES] = hash
+        self.captions[row] = caption
+        self.titles[row] = title
+        self.filenames[row] = None if filename == caption + '.mp3' else filename
+
+    def __delitem__(self, caption):
+        row = self.rows.pop(caption)
+        if self.shared:
+            return
+        self.captions[row] = None
+        self.titles[row] = None
+        self.filenames[row] = None
+        self.free_rows.append(row)
+
+    def pop(self, caption, *default):
+        """
+        removes track and returns its info as dict, view of a removed row would change when row is reused
+        """
+        if caption not in self.rows:
+            if default:
+                return default[0]
+            raise KeyError(caption)
+        track = dict(self[caption])
+        del self[caption]
+        return track
+
+    def __contains__(self, caption):
+        return caption in self.rows
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def copy(self):
+        table = TrackTable(self.basedir)
+        for name in ('rows', 'free_rows', 'strings', 'string_ids', 'captions', 'titles', 'filenames', 'hashes'):
+            setattr(table, name, getattr(self, name).copy())
+        for name in ('directories', 'authors', 'albums', 'lengths'):
+            setattr(table, name, array('I', getattr(self, name)))
+        return table
+
+    def derived(self):
+        """
+        returns table with the same tracks whose changes don't affect this one, columns are shared with
+        this table and new rows are appended to them, so this table must not be changed any more
+        """
+        table = TrackTable.__new__(TrackTable)
+        table.__dict__.update(self.__dict__)
+        table.rows = layered(self.rows)
+        # rows free in this table are not read by any table, they are handed over to one derived table only
+        table.free_rows, self.free_rows = self.free_rows, []
+        table.shared = True
+        return table
+
+    def compacted(self):
+        """
+        returns table with own columns, rows not used by its tracks are free
+        """
+        table = TrackTable(self.basedir)
+        for name in ('strings', 'string_ids', 'captions', 'titles', 'filenames', 'hashes'):
+            setattr(table, name, getattr(self, name).copy())
+        for name in ('directories', 'authors', 'albums', 'lengths'):
+            setattr(table, name, array('I', getattr(self, name)))
+        table.rows = compacted(self.rows)
+        used = set(table.rows.values())
+        table.free_rows = [row for row in range(len(table.captions)) if row not in used]
+        for row in table.free_rows:
+            table.captions[row] = table.titles[row] = table.filenames[row] = None
+        return table
+
+
+def length_window(length, threshold):
+    """
+    returns (min, max) length of strings whose difflib real_quick_ratio with a string of length reaches threshold
+    """
+    if threshold <= 0:
+        return 0, math.inf
+    low = length
+    while low > 0 and 2.0 * (low - 1) / (low - 1 + length) >= threshold:
+        low -= 1
+    high = length
+    while 2.0 * length / (high + 1 + length) >= threshold:
+        high += 1
+    return low, high
+
+
+def best_matches(word, candidates, n=3, cutoff=0.6, count=None):
+    """
+    returns difflib.get_close_matches(word, possibilities, n, cutoff) without repeated strings,
+    possibilities hold every candidate count(candidate) times, or once if count is None
+    """
+    count = count or (lambda s: 1)
+    matcher = SequenceMatcher()
+    matcher.set_seq2(word)
+    # min heap of best (ratio, string), strings beyond n best possibilities are dropped
+    best = []
+    held = 0
+    # a string can't get in once n possibilities are held, unless it scores at least as the worst of them
+    threshold = cutoff
+    # upper bounds of ratio are checked first as in difflib, length window is real_quick_ratio
+    low, high = length_window(len(word), threshold)
+    for s in candidates:
+        if not low <= len(s) <= high:
+            continue
+        matcher.set_seq1(s)
+        if matcher.quick_ratio() < threshold:
+            continue
+        ratio = matcher.ratio()
+        if ratio < threshold:
+            continue
+        heapq.heappush(best, (ratio, s))
+        held += count(s)
+        while held - count(best[0][1]) >= n:
+            held -= count(heapq.heappop(best)[1])
+        if held >= n and best[0][0] > threshold:
+            threshold = best[0][0]
+            low, high = length_window(len(word), threshold)
+    return [s for _, s in sorted(best, reverse=True)]
+
+
+def shared_gram_candidates(postings, strings_count, word_length, cutoff=0.6, n=3, length=len):
+    """
+    args: postings - posting sets of n-grams of a word, strings_count - number of indexed strings,
+          length - function returning length of a posting element
+    returns list of at most FUZZY_CANDIDATES_MAX strings with the best difflib ratio estimated from shared n-grams,
+    strings whose length can't reach cutoff are dropped
+    postings of n-grams too common to tell strings apart are skipped, unless there are no other ones,
+    the rarest postings are counted while they hold up to FUZZY_POSTINGS_MAX strings, so cost doesn't grow with collection
+    """
+    postings = sorted((p for p in postings if len(p)), key=len)
+    limit = max(STOP_GRAM_MIN, strings_count * STOP_GRAM_SHARE)
+    postings = [p for p in postings if len(p) <= limit] or postings[:1]
+    counted = 0
+    for i, posting in enumerate(postings):
+        if counted + len(posting) > FUZZY_POSTINGS_MAX:
+            # only part of the rarest posting is taken if it alone is too large
+            postings = postings[:i] or [itertools.islice(posting, FUZZY_POSTINGS_MAX)]
+            break
+        counted += len(posting)
+    counts = Counter(itertools.chain.from_iterable(postings))
+    low, high = length_window(word_length, cutoff)
+    # matching block of k characters shares k - n + 1 n-grams, difflib ratio is 2 * matched characters / sum of lengths,
+    # equal estimates are ordered by string, so strings and ids of exported strings sorted the same way give the same result
+    lengths = ((s, c, length(s)) for s, c in counts.items())
+    ranked = ((-(c + n - 1) / (l + word_length), s) for s, c, l in lengths if low <= l <= high)
+    return [s for _, s in heapq.nsmallest(FUZZY_CANDIDATES_MAX, ranked)]
+
+
+class NgramIndex:
+    """
+    Inverted n-gram index over a set of strings.
+    Narrows substring and difflib searches down to a small candidate set.
+    """
+    def __init__(self, strings=(), n=3):
+        """
+        self.postings - a python dict gram: set of indexed strings
+        """
+        self.n = n
+        self.postings = {}
+        self.strings = set()
+        # grams whose posting sets belong to this index and not shared with its copies
+        self.owned = None
+        for s in strings:
+            self.add(s)
+
+    def copy(self):
+        """
+        returns copy of the index to be changed, this index must not be changed any more
+        postings and strings of the copy are layered over ones of this index, so copying doesn't depend on their size
+        """
+        index = NgramIndex(n=self.n)
+        index.postings = layered(self.postings)
+        index.strings = layered(self.strings)
+        index.owned = set()
+        return index
+
+    def compact(self):
+        """
+        replaces layered postings dict and strings with plain ones, posting sets too unless they are
+        changed by a small share of their size, like large postings of common grams
+        """
+        self.postings = compacted(self.postings)
+        for g, posting in self.postings.items():
+            if type(posting) is LayeredSet and len(posting.added) + len(posting.removed) > len(posting.base) // LAYERED_SHARE:
+                self.postings[g] = compacted(posting)
+        self.strings = compacted(self.strings)
+        self.owned = set()
+
+    def posting(self, g):
+        """
+        returns posting set of gram g which is safe to change
+        """
+        if self.owned is None:
+            return self.postings.setdefault(g, set())
+        if g not in self.owned:
+            posting = self.postings.get(g)
+            self.postings[g] = set() if posting is None else layered(posting)
+            self.owned.add(g)
+        return self.postings[g]
+
+    def grams(self, s):
+        """
+        returns set of lowercased n-grams of s, short strings are grams themselves
+        """
+        s = s.lower()
+        if len(s) <= self.n:
+            return {s} if s else set()
+        return {s[i:i + self.n] for i in range(len(s) - self.n + 1)}
+
+    def add(self, s):
+        if s in self.strings:
+            return
+        self.strings.add(s)
+        for g in self.grams(s):
+            self.posting(g).add(s)
+
+    def remove(self, s):
+        if s not in self.strings:
+            return
+        self.strings.discard(s)
+        for g in self.grams(s):
+            if g in self.postings:
+                posting = self.posting(g)
+                posting.discard(s)
+                if not posting:
+                    del self.postings[g]
+                    if self.owned is not None:
+                        self.owned.discard(g)
+
+    def containing(self, substring):
+        """
+        returns list of indexed strings containing substring, case insensitive
+        """
+        substring = substring.lower()
+        if len(substring) < self.n:
+            return [s for s in self.strings if substring in s.lower()]
+        postings = sorted((self.postings.get(g, set()) for g in self.grams(substring)), key=len)
+        candidates = set(postings[0])
+        for posting in postings[1:]:
+            if not candidates:
+                break
+            candidates &= posting
+        EXACT_CANDIDATES.observe(len(candidates))
+        return [s for s in candidates if substring in s.lower()]
+
+    def fuzzy_candidates(self, word, cutoff=0.6):
+        """
+        returns list of indexed strings sharing most n-grams with word, see shared_gram_candidates()
+        """
+        postings = [self.postings[g] for g in self.grams(word) if g in self.postings]
+        return shared_gram_candidates(postings, len(self.strings), len(word), cutoff, self.n)
 
+    def close_matches(self, word, n=3, cutoff=0.6, count=None):
+        """
+        returns what difflib.get_close_matches(word, strings, n, cutoff) returns for the strings of fuzzy_candidates(word),
+        other strings are never compared, so results may differ from comparing all indexed strings:
+        strings sharing no n-gram with word or only n-grams too common to tell strings apart are not found,
+        unless word has no other n-grams, n-grams of word are counted only in its rarest postings holding up to
+        FUZZY_POSTINGS_MAX strings, and strings sharing few n-grams lose to FUZZY_CANDIDATES_MAX better ones
+        count - function returning how many times a string is repeated in possibilities, like title of several tracks
+        """
+        candidates = self.fuzzy_candidates(word, cutoff)
+        FUZZY_CANDIDATES.observe(len(candidates))
+        return best_matches(word, candidates, n, cutoff, count)
+
+
+class SearchCache:
+    """
+    Thread safe LRU cache of search results with time to live
+    """
+    def __init__(self, size=1024, ttl=600):
+        self.size = size
+        self.ttl = ttl
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """
+        returns cached value or None if key is missing or expired
+        """
+        with self.lock:
+            entry = self.cache.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self.cache.move_to_end(key)
+                self.hits += 1
+                CACHE_HITS.inc()
+                return entry[1]
+            if entry is not None:
+                del self.cache[key]
+            self.misses += 1
+            CACHE_MISSES.inc()
+            return None
+
+    def set(self, key, value):
+        with self.lock:
+            self.cache[key] = (time.monotonic() + self.ttl, value)
+            self.cache.move_to_end(key)
+            while len(self.cache) > self.size:
+                self.cache.popitem(last=False)
+
+    def stats(self):
+        return {'size': len(self.cache), 'hits': self.hits, 'misses': self.misses}
+
+
+class ChatShuffle:
+    """
+    Per chat cursors over random pool, a chat gets every track once before any track repeats.
+    Cursor keeps only random permutation parameters, not the permutation itself.
+    """
+    def __init__(self, size=10000):
+        """
+        self.cursors - LRU python dict chat_id: [index version, pool size, multiplier, offset, position]
+        """
+        self.size = size
+        self.cursors = OrderedDict()
+        self.lock = threading.Lock()
+
+    def next(self, chat_id, version, pool_size):
+        """
+        returns next position in the pool for chat_id, cursor restarts when index version changes
+        """
+        with self.lock:
+            cursor = self.cursors.get(chat_id)
+            if cursor is None or cursor[:2] != [version, pool_size] or cursor[4] >= pool_size:
+                # i -> (a * i + b) mod n is a permutation if a and n are coprime
+                a = random.randrange(1, pool_size) if pool_size > 1 else 1
+                while math.gcd(a, pool_size) != 1:
+                    a = random.randrange(1, pool_size)
+                cursor = [version, pool_size, a, random.randrange(pool_size), 0]
+            self.cursors[chat_id] = cursor
+            self.cursors.move_to_end(chat_id)
+            while len(self.cursors) > self.size:
+                self.cursors.popitem(last=False)
+            position = (cursor[2] * cursor[4] + cursor[3]) % pool_size
+            cursor[4] += 1
+            return position
+
+
+class CollectionIndex:
+    """
+    Immutable snapshot of collection index.
+    TelegramMusicCollection builds a new one on reindex and publishes it with single assignment,
+    so request handlers should take one with TelegramMusicCollection.snapshot() and use it till the end of request.
+    """
+    def __init__(self, files, mds_dict, version, search_cache=None, shuffle=None):
+        """
+        self.files - a python dict relative path: (size, mtime_ns, caption) of indexed files
+        self.mds_dict - a python dict containing information about files in mds collection
+        self.version - number of the snapshot, increases with every published index
+        self.search_cache - SearchCache shared by all versions of index, results are keyed by version
+        self.shuffle - ChatShuffle shared by all versions of index
+        """
+        self.files = files
+        self.mds_dict = mds_dict
+        self.version = version
+        self.search_cache = search_cache
+        self.shuffle = shuffle
+        # tracks changed by updated() since the index was built or compacted
+        self.layered_changes = 0
+        self.make_search_index()
+        self.make_lookup_index()
+        self.make_random_pool()
+
+    def make_search_index(self):
+        """
+        builds n-gram indexes of captions, authors and titles used by search
+        """
+        self.caption_index = NgramIndex(self.mds_dict.keys())
+        self.author_index = NgramIndex(v['author'] for v in self.mds_dict.values())
+        self.title_index = NgramIndex(v['title'] for v in self.mds_dict.values())
     
-    def reindex(self):
+    def make_lookup_index(self):
         """
-        makes new mds_dict for mds_base_dir
-        """        
-        self.mds_dict = self.make_index(self.mds_basedir)
+        builds hash: caption, author: captions and title: captions dicts
+        hash collisions are logged, first caption keeps the hash as get_by_hash always did
+        """
+        self.hash_dict = {}
+        self.author_dict = {}
+        self.title_dict = {}
+        self.hash_collisions = {}
+        for caption, track in self.mds_dict.items():
+            if track['hash'] in self.hash_dict:
+                self.hash_collisions.setdefault(track['hash'], [self.hash_dict[track['hash']]]).append(caption)
+            else:
+                self.hash_dict[track['hash']] = caption
+            self.author_dict.setdefault(track['author'], []).append(caption)
+            self.title_dict.setdefault(track['title'], []).append(caption)
+        for hash, captions in self.hash_collisions.items():
+            logger.error('Hash %s collision, only first track is reachable by hash: %s', hash, captions)
+
+    def make_random_pool(self):
+        """
+        builds list of captions which are not parts or chapters and caption: position in that list dict
+        """
+        self.random_pool = [caption for caption in self.mds_dict.keys() if not PART_PATTERN.search(caption)]
+        self.random_positions = {caption: i for i, caption in enumerate(self.random_pool)}
+
+    def updated(self, files, tracks, removed, version):
+        """
+        args: files - new files dict, tracks - dict caption: track info of new and changed tracks,
+              removed - captions of deleted tracks
+        returns new CollectionIndex, this one stays unchanged
+        tables, dicts and postings of the new index are layered over ones of this index, so only entries
+        of changed tracks are copied, layers are compacted once LAYERED_CHANGES tracks are changed over them
+        """
+        index = CollectionIndex.__new__(CollectionIndex)
+        index.files = files
+        index.mds_dict = layered(self.mds_dict)
+        index.version = version
+        index.search_cache = self.search_cache
+        index.shuffle = self.shuffle
+        index.random_pool = layered(self.random_pool)
+        index.random_positions = layered(self.random_positions)
+        index.caption_index = self.caption_index.copy()
+        index.author_index = self.author_index.copy()
+        index.title_index = self.title_index.copy()
+        index.hash_dict = layered(self.hash_dict)
+        # caption lists are replaced, not changed in place, so they can be shared
+        index.author_dict = layered(self.author_dict)
+        index.title_dict = layered(self.title_dict)
+        index.hash_collisions = dict(self.hash_collisions)
+        for caption in removed:
+            index.remove_track(caption)
+        for caption, track in tracks.items():
+            index.remove_track(caption)
+            index.add_track(caption, track)
+        index.layered_changes = self.layered_changes + len(removed) + len(tracks)
+        if index.layered_changes > LAYERED_CHANGES:
+            index.compact()
+        return index
+
+    def compact(self):
+        """
+        replaces layered tables, dicts and postings of index being built by updated() with plain ones
+        it costs as much as copying the whole index, so it is done once in a while
+        """
+        self.files = compacted(self.files)
+        self.mds_dict = compacted(self.mds_dict)
+        self.random_pool = compacted(self.random_pool)
+        for name in ('random_positions', 'hash_dict', 'author_dict', 'title_dict'):
+            setattr(self, name, compacted(getattr(self, name)))
+        for ngram_index in (self.caption_index, self.author_index, self.title_index):
+            ngram_index.compact()
+        self.layered_changes = 0
+
+    def add_track(self, caption, track):
+        """
+        adds track to index being built by updated()
+        """
+        self.mds_dict[caption] = track
+        self.caption_index.add(caption)
+        self.author_index.add(track['author'])
+        self.title_index.add(track['title'])
+        self.author_dict[track['author']] = self.author_dict.get(track['author'], []) + [caption]
+        self.title_dict[track['title']] = self.title_dict.get(track['title'], []) + [caption]
+        if not PART_PATTERN.search(caption):
+            self.random_positions[caption] = len(self.random_pool)
+            self.random_pool.append(caption)
+        if track['hash'] in self.hash_dict:
+            self.hash_collisions[track['hash']] = self.hash_collisions.get(track['hash'], [self.hash_dict[track['hash']]]) + [caption]
+            logger.error('Hash %s collision, only first track is reachable by hash: %s', track['hash'], self.hash_collisions[track['hash']])
+        else:
+            self.hash_dict[track['hash']] = caption
+
+    def remove_track(self, caption):
+        """
+        removes track from index being built by updated()
+        """
+        track = self.mds_dict.pop(caption, None)
+        if track is None:
+            return
+        self.caption_index.remove(caption)
+        position = self.random_positions.pop(caption, None)
+        if position is not None:
+            # last caption takes place of removed one
+            last = self.random_pool.pop()
+            if last != caption:
+                self.random_pool[position] = last
+                self.random_positions[last] = position
+        for key, lookup_dict, ngram_index in ((track['author'], self.author_dict, self.author_index),
+                                              (track['title'], self.title_dict, self.title_index)):
+            captions = [c for c in lookup_dict.get(key, []) if c != caption]
+            if captions:
+                lookup_dict[key] = captions
+            else:
+                lookup_dict.pop(key, None)
+                ngram_index.remove(key)
+        colliding = [c for c in self.hash_collisions.pop(track['hash'], []) if c != caption]
+        if len(colliding) > 1:
+            self.hash_collisions[track['hash']] = colliding
+        if self.hash_dict.get(track['hash']) == caption:
+            if colliding:
+                self.hash_dict[track['hash']] = colliding[0]
+            else:
+                del self.hash_dict[track['hash']]
 
-    def random(self):
+    def random(self, chat_id=None):
         """
-        returns caption: {path, author, title}
-        returns random title 
+        returns random title, parts and chapters are skipped
+        if chat_id is given and index has shuffle, titles don't repeat for the chat until all of them are shown
         """
-        pattern = '\(часть \d+\)|\(глава \d+\)|\(глава \d+\-\d+\)|\(часть \d+, глава \d+\)'
-        return random.choice([caption for caption in self.mds_dict.keys() if not re.search(pattern, caption, flags=re.IGNORECASE)])
+        if not self.random_pool:
+            return None
+        if chat_id is None or self.shuffle is None:
+            return random.choice(self.random_pool)
+        return self.random_pool[self.shuffle.next(chat_id, self.version, len(self.random_pool))]
 
 
 
@@ -131,10 +992,7 @@ class TelegramMusicCollection:
         """
         returns caption by singe argument - hash
         """
-        try:
-            return [caption for caption in self.mds_dict.keys() if self.mds_dict[caption]['hash'] == hash][0]
-        except:
-            return None
+        return self.hash_dict.get(hash)
    
     def hash(self, caption):
         """
@@ -182,25 +1040,323 @@ class TelegramMusicCollection:
         if len(search_string) > 100:
             search_string = search_string[:100]
 
-        return list(sorted(set(self.search_exact(search_string) + self.search_diff_author(search_string) + self.search_diff_title(search_string) + self.search_diff_caption(search_string))))
+        # cached list is shared between requests and must not be changed
+        if self.search_cache is not None:
+            found = self.search_cache.get((search_string, self.version))
+            if found is not None:
+                return found
+
+        found = list(sorted(set(self.search_exact(search_string) + self.search_diff_author(search_string) + self.search_diff_title(search_string) + self.search_diff_caption(search_string))))
+        SEARCH_RESULTS.observe(len(found))
+        if self.search_cache is not None:
+            self.search_cache.set((search_string, self.version), found)
+        return found
 
     def search_diff_caption(self, search_string):
-        return sorted(get_close_matches(search_string, self.mds_dict.keys()))
+        return sorted(self.caption_index.close_matches(search_string))
 
     def search_diff_title(self, search_string):
-        junk_pattern = '\(часть \d+\)|\(глава \d+\)|\(глава \d+\-\d+\)|\(часть \d+, глава \d+\)'
-        titles = get_close_matches(search_string, [v['title'] for v in self.mds_dict.values()])
-        return sorted([caption for caption in self.mds_dict.keys() if self.mds_dict[caption]['title'] in titles ])
+        # title of several tracks takes several of the best matches, as if every track was compared
+        titles = self.title_index.close_matches(search_string, count=lambda title: len(self.title_dict[title]))
+        return sorted([caption for title in titles for caption in self.title_dict.get(title, [])])
 
     def search_diff_author(self, search_string):
-        authors = get_close_matches(search_string, [v['author'] for v in self.mds_dict.values()])
-        return sorted([caption for caption in self.mds_dict.keys() if self.mds_dict[caption]['author'] in authors ])
+        authors = self.author_index.close_matches(search_string, count=lambda author: len(self.author_dict[author]))
+        return sorted([caption for author in authors for caption in self.author_dict.get(author, [])])
 
     def search_exact(self, search_string):
-        return sorted([caption for caption in self.mds_dict.keys() if search_string.lower() in caption.lower()])
+        return sorted(self.caption_index.containing(search_string))
 
         
 
+
+def process_pool(workers):
+    """
+    returns process pool with workers started by a fork server or spawned,
+    forking the bot process could copy locks held by its other threads into workers
+    """
+    if 'forkserver' not in multiprocessing.get_all_start_methods():
+        return ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn'))
+    context = multiprocessing.get_context('forkserver')
+    # workers are forked from the server with mutagen and this module already imported
+    context.set_forkserver_preload([__name__])
+    return ProcessPoolExecutor(workers, mp_context=context)
+
+
+class TelegramMusicCollection:
+    def __init__(self, path, id3based = False, index_file = None, index_workers = 1, search_cache_size = 1024, search_cache_ttl = 600, random_shuffle = False, export_file = None):
+        """
+        self.mds_basedir - Path object refering to base directory of mds collection
+        self.index - current CollectionIndex, replaced as a whole on reindex
+        self.index_file - Path object of index snapshot file, snapshot is not used if None
+        self.index_workers - number of processes parsing mp3 files, files are parsed serially if 1
+        self.search_cache - SearchCache of search results, search is not cached if search_cache_size is 0
+        self.shuffle - ChatShuffle making random() non-repeating per chat if random_shuffle is set
+        self.export_file - Path object of memory mapped index file for other processes, index is not exported if None
+        """
+        self.mds_basedir = Path(path)
+        self.id3based = id3based
+        self.index_file = Path(index_file) if index_file else None
+        self.index_workers = index_workers
+        self.index_batch_size = 64
+        self.reindex_lock = threading.Lock()
+        self.reindex_thread = None
+        self.search_cache = SearchCache(search_cache_size, search_cache_ttl) if search_cache_size else None
+        self.shuffle = ChatShuffle() if random_shuffle else None
+        self.export_file = Path(export_file) if export_file else None
+        # version of the last saved and exported index
+        self.persisted_version = None
+        if (self.mds_basedir.exists() and self.mds_basedir.is_dir()):
+            self.index = CollectionIndex({}, {}, 0, self.search_cache, self.shuffle)
+            self.reindex(*self.load_index())
+            logger.info('New music collection instance created for tracks in %s' % (path)) 
+        else:
+            raise FileNotFoundError('%s is not valid directory' % path)
+
+    @property
+    def mds_dict(self):
+        return self.index.mds_dict
+
+    @property
+    def files(self):
+        return self.index.files
+
+    @property
+    def version(self):
+        return self.index.version
+
+    def snapshot(self):
+        """
+        returns current CollectionIndex, it is never changed after publishing
+        """
+        return self.index
+
+    def make_index(self, path, id3based = False, files = None, mds_dict = None):
+        """
+        args: path - Path object of base directory
+              files, mds_dict - previous index, files with unchanged size and mtime are not parsed again
+        returns (files, mds_dict) for files in path directory and subdirectories
+        new and changed files are parsed in a process pool if self.index_workers > 1
+        """
+        logger.info('Building index for collection in %s', str(path))
+        files = files or {}
+        mds_dict = mds_dict or {}
+        executor = None
+        entries = []
+        jobs = []
+        batch = []
+        parsed = 0
+        try:
+            for p in path.glob('**/*.mp3'):
+                st = p.stat()
+                key = str(p.relative_to(path))
+                known = files.get(key)
+                if known and known[:2] == (st.st_size, st.st_mtime_ns) and known[2] in mds_dict:
+                    entries.append((key, st, (known[2], mds_dict[known[2]]), None, None))
+                    continue
+                parsed += 1
+                if self.index_workers <= 1:
+                    entries.append((key, st, read_track(p, id3based), None, None))
+                    continue
+                # paths are streamed to workers in batches while glob is still running
+                entries.append((key, st, None, len(jobs), len(batch)))
+                batch.append(p)
+                if len(batch) == self.index_batch_size:
+                    executor = executor or process_pool(self.index_workers)
+                    jobs.append(executor.submit(read_tracks, batch, id3based))
+                    batch = []
+            if batch:
+                executor = executor or process_pool(self.index_workers)
+                jobs.append(executor.submit(read_tracks, batch, id3based))
+
+            # results are merged in glob order, so the last file wins on equal captions as before
+            results = [job.result() for job in jobs]
+            new_files = {}
+            index_dict = TrackTable(path)
+            for key, st, result, job, pos in entries:
+                caption, track = result or results[job][pos]
+                new_files[key] = (st.st_size, st.st_mtime_ns, caption)
+                index_dict[caption] = track
+        finally:
+            if executor:
+                executor.shutdown()
+        logger.info('Indexed %d files, %d of them parsed', len(new_files), parsed)
+        return new_files, index_dict
+
+    def load_index(self):
+        """
+        returns (files, mds_dict) saved in self.index_file or empty index if snapshot can't be used
+        """
+        if not (self.index_file and self.index_file.exists()):
+            return {}, {}
+        try:
+            with open(self.index_file, 'rb') as f:
+                snapshot = pickle.load(f)
+        except Exception as e:
+            logger.warning('Can not load index snapshot %s: %s', str(self.index_file), e)
+            return {}, {}
+        if snapshot.get('version') != INDEX_SNAPSHOT_VERSION or snapshot.get('id3based') != bool(self.id3based):
+            logger.info('Index snapshot %s is outdated, ignoring it', str(self.index_file))
+            return {}, {}
+        mds_dict = snapshot['mds_dict']
+        mds_dict.basedir = self.mds_basedir
+        logger.info('Loaded index snapshot with %d tracks from %s', len(mds_dict), str(self.index_file))
+        return snapshot['files'], mds_dict
+
+    def save_index(self, index):
+        """
+        saves CollectionIndex to self.index_file, TrackTable keeps paths relative to self.mds_basedir
+        """
+        if not self.index_file:
+            return
+        snapshot = {'version': INDEX_SNAPSHOT_VERSION,
+                    'id3based': bool(self.id3based),
+                    'files': compacted(index.files),
+                    'mds_dict': index.mds_dict}
+        tmp_file = self.index_file.with_name(self.index_file.name + '.tmp')
+        with open(tmp_file, 'wb') as f:
+            pickle.dump(snapshot, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(str(tmp_file), str(self.index_file))
+
+    def export_index(self, index):
+        """
+        exports CollectionIndex to self.export_file for processes attached with MmapCollection
+        """
+        if not self.export_file:
+            return
+        from telegram_music_mmap import export_index
+        try:
+            export_index(index, self.export_file, self.mds_basedir)
+        except Exception as e:
+            logger.error('Can not export index to %s: %s', str(self.export_file), e)
+
+    def reindex(self, files = None, mds_dict = None):
+        """
+        builds new index for mds_base_dir aside and publishes it, parses only new and changed files
+        files, mds_dict - previous index, current one is used if not given
+        readers keep using current index until new one is ready
+        """        
+        with self.reindex_lock:
+            current = self.index
+            if files is None:
+                files, mds_dict = current.files, current.mds_dict
+            files, mds_dict = self.make_index(self.mds_basedir, self.id3based, files, mds_dict)
+            index = CollectionIndex(files, mds_dict, current.version + 1, self.search_cache, self.shuffle)
+            self.index = index
+            logger.info('Published index version %d with %d tracks', index.version, len(mds_dict))
+            self.persist_index(index)
+
+    def persist_index(self, index):
+        """
+        saves and exports index unless it is already done, self.reindex_lock must be held
+        """
+        if index.version == self.persisted_version:
+            return
+        self.save_index(index)
+        self.export_index(index)
+        self.persisted_version = index.version
+
+    def persist(self):
+        """
+        saves and exports current index if it was published by update_files without persisting
+        """
+        with self.reindex_lock:
+            self.persist_index(self.index)
+
+    def update_files(self, paths, persist=True):
+        """
+        args: paths - iterable of changed, created or deleted files and directories inside self.mds_basedir
+              persist - save and export new index, both rewrite the whole index, so frequent callers
+                        pass False and call persist() later
+        reads only given files and publishes index with their entries updated
+        """
+        with self.reindex_lock:
+            current = self.index
+            files = layered(current.files)
+            tracks = {}
+            removed = set()
+            keys = set()
+            for p in paths:
+                p = Path(p)
+                try:
+                    key = str(p.relative_to(self.mds_basedir))
+                except ValueError:
+                    continue
+                keys.add(key)
+                if p.suffix != '.mp3':
+                    # directory was created, moved or removed
+                    keys.update(k for k in current.files if k.startswith(key + os.sep))
+                    if p.is_dir():
+                        keys.update(str(f.relative_to(self.mds_basedir)) for f in p.glob('**/*.mp3'))
+            for key in keys:
+                p = self.mds_basedir / key
+                known = files.pop(key, None)
+                if known and known[2] in current.mds_dict and current.mds_dict[known[2]]['path'] == p:
+                    removed.add(known[2])
+                if p.suffix != '.mp3' or not p.is_file():
+                    continue
+                try:
+                    st = p.stat()
+                    caption, track = read_track(p, self.id3based)
+                except Exception as e:
+                    # file may be still written, it will be read on the next event
+                    logger.warning('Can not read %s: %s', str(p), e)
+                    continue
+                files[key] = (st.st_size, st.st_mtime_ns, caption)
+                tracks[caption] = track
+            if not (tracks or removed):
+                return
+            index = current.updated(files, tracks, removed - set(tracks), current.version + 1)
+            self.index = index
+            logger.info('Published index version %d: %d tracks updated, %d removed', index.version, len(tracks), len(removed - set(tracks)))
+            if persist:
+                self.persist_index(index)
+
+    def reindex_async(self):
+        """
+        starts reindex in background thread, returns False if reindex is already running
+        """
+        if self.reindex_thread and self.reindex_thread.is_alive():
+            return False
+        self.reindex_thread = threading.Thread(target=self.reindex, name='reindex', daemon=True)
+        self.reindex_thread.start()
+        return True
+
+    def random(self, chat_id=None):
+        return self.index.random(chat_id)
+
+    def dump(self):
+        self.index.dump()
+
+    def path(self, caption):
+        return self.index.path(caption)
+
+    def filename(self, caption):
+        return self.index.filename(caption)
+
+    def exists(self, caption):
+        return self.index.exists(caption)
+
+    def get_by_hash(self, hash):
+        return self.index.get_by_hash(hash)
+
+    def hash(self, caption):
+        return self.index.hash(caption)
+
+    def author(self, caption):
+        return self.index.author(caption)
+
+    def title(self, caption):
+        return self.index.title(caption)
+
+    def length(self, caption):
+        return self.index.length(caption)
+
+    def search(self, search_string):
+        return self.index.search(search_string)
+
+
+
 def main():
     mds = TelegramMusicCollection('bots/content/music/', id3based=True)
     mds.dump()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+"""
+Structured usage events of Telegram Music bots.
+Handlers put events to an in-memory queue and return, a listener thread writes them as json lines,
+one file per bot. telegram_music_stats.py reads these files instead of parsing logged updates.
+
+Event fields:
+    t - unix time, bot - bot nickname, type - search, page, play, rate, random, top100, likes, start, reindex, upload, unknown
+    chat, user - chat id and username, latency - handling time in milliseconds, error - set if handler raised
+    query, results, hash, sent, page, list, command - set by handlers where they apply
+"""
+
+import json
+import logging
+import queue
+import threading
+import time
+from logging.handlers import QueueListener, WatchedFileHandler
+
+
+class EventQueueListener(QueueListener):
+    def prepare(self, event):
+        # handlers only queue event dicts, log records are made and serialized by listener thread
+        return logging.makeLogRecord({'msg': event, 'levelno': logging.INFO, 'levelname': 'INFO'})
+
+
+class EventFormatter(logging.Formatter):
+    def format(self, record):
+        return json.dumps(record.msg, ensure_ascii=False, separators=(',', ':'))
+
+
+class EventLog:
+    """
+    Json lines event file of a bot, filename None disables events
+    A bot restarted by the host replaces its previous event log
+    """
+    logs = {}
+    logs_lock = threading.Lock()
+
+    def __init__(self, filename, bot_name):
+        self.bot_name = bot_name
+        self.queue = None
+        if not filename:
+            return
+        # rotated file is reopened, so logrotate can move it away
+        file_handler = WatchedFileHandler(filename, encoding='utf-8')
+        file_handler.setFormatter(EventFormatter())
+        with self.logs_lock:
+            previous = self.logs.get(bot_name)
+            self.logs[bot_name] = self
+        if previous:
+            previous.close()
+        self.queue = queue.SimpleQueue()
+        self.listener = EventQueueListener(self.queue, file_handler)
+        self.listener.start()
+
+    def emit(self, type, **fields):
+        """
+        queues event, never blocks
+        """
+        events = self.queue
+        if events is None:
+            return
+        event = {'t': round(time.time(), 3), 'bot': self.bot_name, 'type': type}
+        event.update((k, v) for k, v in fields.items() if v is not None)
+        events.put(event)
+
+    def timed(self, type, chat=None, user=None, **fields):
+        """
+        returns context manager emitting event with handling time on exit, its event dict takes more fields
+        """
+        return EventTimer(self, type, dict(fields, chat=chat, user=user))
+
+    def close(self):
+        """
+        writes queued events and closes the file
+        """
+        if self.queue is None:
+            return
+        self.queue = None
+        self.listener.stop()
+        for handler in self.listener.handlers:
+            handler.close()
+
+
+class EventTimer:
+    def __init__(self, log, type, event):
+        self.log = log
+        self.type = type
+        self.event = event
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self.event
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.event['latency'] = round((time.perf_counter() - self.start) * 1000, 1)
+        if exc_type is not None:
+            self.event['error'] = exc_type.__name__
+        self.log.emit(self.type, **self.event)
+
+
+def read_events(lines):
+    """
+    yields event dicts of json lines, broken lines are skipped
+    """
+    for line in lines:
+        try:
+            event = json.loads(line)
+        except ValueError:
+            continue
+        if isinstance(event, dict) and 'type' in event:
+            yield event
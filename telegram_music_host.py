@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+"""
+Runs all Telegram Music bots in one process.
+Bots serving the same collection share one index, each bot keeps its own rates and file id stores.
+Crashed bots are restarted in process.
+"""
+
+import asyncio
+import glob
+import logging
+import os
+import signal
+import sys
+import yaml
+from telegram_music_bot import TelegramMusicBot, make_collection
+from telegram_music_watcher import CollectionWatcher
+
+logger = logging.getLogger(__name__)
+
+# bot parameters of collection and its watcher, bots share a collection only if all of them are equal
+COLLECTION_PARAMS = ('id3based', 'collection_index_file', 'collection_export_file', 'collection_mmap_file', 'search_cache_size',
+                     'search_cache_ttl', 'random_shuffle', 'parallel_indexing', 'index_workers', 'watch_collection', 'watch_debounce',
+                     'watch_poll_interval', 'watch_persist_interval')
+# parameters naming files written by collection
+COLLECTION_FILES = ('collection_index_file', 'collection_export_file')
+
+
+class TelegramMusicHost:
+    """
+    Builds each distinct collection once and supervises bots using it
+    """
+    def __init__(self, config_files, check_interval=5, restart_delay=10):
+        """
+        self.collections - a python dict (collection path, collection parameters): TelegramMusicCollection
+        self.bots - a python dict config file: running bot, None if it failed to start or RESTART_PENDING
+        """
+        self.config_files = config_files
+        self.check_interval = check_interval
+        self.restart_delay = restart_delay
+        self.collections = {}
+        self.watchers = []
+        self.bots = {}
+        self.configs = {}
+        self.stopping = None
+        for config_file in config_files:
+            with open(config_file) as f:
+                self.configs[config_file] = yaml.safe_load(f)
+
+    def collection(self, bot_params):
+        """
+        returns shared collection for bot parameters, builds it on first request
+        raises ValueError if collection with other parameters already writes the same index or export file
+        """
+        params = {name: bot_params.get(name) for name in COLLECTION_PARAMS}
+        params['id3based'] = bool(params['id3based'])
+        for name in COLLECTION_FILES:
+            if params[name]:
+                params[name] = os.path.realpath(params[name])
+        key = (os.path.realpath(bot_params['collection_path']), tuple(sorted(params.items())))
+        if key not in self.collections:
+            for other_path, other_params in self.collections:
+                for name in COLLECTION_FILES:
+                    if params[name] and params[name] == dict(other_params)[name]:
+                        raise ValueError('%s %s is already written by collection of %s with other parameters' % (name, params[name], other_path))
+            logger.info('Building collection %s for %s', key[0], bot_params['nickname'])
+            collection = self.collections[key] = make_collection(bot_params)
+            if bot_params.get('watch_collection') and not bot_params.get('collection_mmap_file'):
+                watcher = CollectionWatcher(collection, debounce=bot_params.get('watch_debounce', 2.0), poll_interval=bot_params.get('watch_poll_interval', 30), persist_interval=bot_params.get('watch_persist_interval', 60.0))
+                watcher.start()
+                self.watchers.append(watcher)
+        return self.collections[key]
+
+    def start_bot(self, config_file):
+        bot_params = dict(self.configs[config_file])
+        bot_params.setdefault('id3based', False)
+        bot_params.setdefault('events_file', 'bots/log/%s.events.jsonl' % bot_params['nickname'])
+        bot_params['collection'] = self.collection(bot_params)
+        # watchers and signals belong to the host
+        bot_params['watch_collection'] = False
+        bot_params['handle_signals'] = False
+        if bot_params.get('runtime') == 'asyncio':
+            from telegram_music_aio import AioTelegramMusicBot
+            bot = AioTelegramMusicBot(**bot_params)
+            bot.start_task()
+        else:
+            bot = TelegramMusicBot(**bot_params)
+            bot.start()
+        self.bots[config_file] = bot
+        logger.info('Bot %s started from %s', bot_params['nickname'], config_file)
+
+    def try_start_bot(self, config_file):
+        try:
+            self.start_bot(config_file)
+        except Exception as e:
+            logger.error('Bot from %s failed to start: %s', config_file, e)
+            self.bots[config_file] = None
+
+    def reindex(self):
+        for collection in self.collections.values():
+            collection.reindex_async()
+
+    def stop(self):
+        """
+        stops bots and watchers, watchers save changes applied since last save
+        """
+        for config_file, bot in self.bots.items():
+            if bot is None or bot is RESTART_PENDING:
+                continue
+            try:
+                bot.stop()
+            except Exception as e:
+                logger.warning('Can not stop bot from %s: %s', config_file, e)
+        for watcher in self.watchers:
+            watcher.stop()
+        logger.info('Host stopped')
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        # kill -HUP rebuilds all collection indexes
+        loop.add_signal_handler(signal.SIGHUP, self.reindex)
+        self.stopping = asyncio.Event()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(signum, self.stopping.set)
+        for config_file in self.config_files:
+            self.try_start_bot(config_file)
+        try:
+            await self.supervise(loop)
+        finally:
+            self.stop()
+
+    async def supervise(self, loop):
+        """
+        restarts bots which are not alive until host is stopped
+        """
+        while not self.stopping.is_set():
+            for config_file, bot in list(self.bots.items()):
+                if bot is RESTART_PENDING or (bot is not None and bot.alive()):
+                    continue
+                logger.error('Bot from %s is not running, restarting in %d seconds', config_file, self.restart_delay)
+                if bot is not None:
+                    try:
+                        bot.stop()
+                    except Exception as e:
+                        logger.warning('Can not stop bot from %s: %s', config_file, e)
+                self.bots[config_file] = RESTART_PENDING
+                loop.call_later(self.restart_delay, self.try_start_bot, config_file)
+            try:
+                await asyncio.wait_for(self.stopping.wait(), self.check_interval)
+            except asyncio.TimeoutError:
+                pass
+
+
+# marks bot waiting for restart in TelegramMusicHost.bots
+RESTART_PENDING = object()
+
+
+def main():
+    config_files = sys.argv[1:] or sorted(glob.glob('bots/enabled/*.yaml'))
+    if not config_files:
+        print("Usage: %s [bot_config.yaml ...]" % (sys.argv[0]))
+        sys.exit()
+
+    lfh = logging.FileHandler('bots/log/host.log')
+    lfh.setLevel(logging.INFO)
+    lfh.setFormatter(logging.Formatter(fmt='%(asctime)s %(threadName)s %(funcName)s %(levelname)s %(message)s'))
+    logging.getLogger('').addHandler(lfh)
+
+    host = TelegramMusicHost(config_files)
+    asyncio.run(host.run())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+"""
+PickleJournal keeps bot state as pickled snapshot plus append-only log of changes.
+Changes are written by background thread in groups and fsynced once per group,
+log is compacted into snapshot when it grows large.
+"""
+
+import atexit
+import json
+import logging
+import os
+import pickle
+import queue
+import threading
+import time
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+
+class PickleJournal:
+    """
+    Snapshot file pickle_filename and log file pickle_filename.log with one json record per line.
+    Records must be idempotent - replaying a record already included in snapshot must not change state.
+    """
+    def __init__(self, pickle_filename, state, lock, flush_interval=1.0, flush_records=1000, compact_records=10000):
+        """
+        state - callable returning picklable state, called with lock held during compaction
+        lock - lock held by owner while changing state and calling append()
+        flush_interval - max seconds record waits in memory before it is written and fsynced
+        flush_records - records are written without waiting for flush_interval when this many are queued
+        compact_records - log is compacted into snapshot after this many records
+        """
+        self.file = Path(pickle_filename)
+        self.log_file = self.file.with_name(self.file.name + '.log')
+        self.state = state
+        self.lock = lock
+        self.flush_interval = flush_interval
+        self.flush_records = flush_records
+        self.compact_records = compact_records
+        self.queue = queue.Queue()
+        # held while log is written or compacted, so records can't be written between taking state and truncation
+        self.write_lock = threading.Lock()
+        self.log = None
+        self.log_records = 0
+        self.thread = None
+        self.closed = False
+
+    def load(self):
+        """
+        returns (snapshot or None if there is no snapshot file, list of log records)
+        torn records at the end of log left by crash are cut off
+        """
+        snapshot = None
+        if self.file.exists():
+            with open(self.file, 'rb') as f:
+                snapshot = pickle.load(f)
+        records = []
+        good_size = 0
+        if self.log_file.exists():
+            with open(self.log_file, 'rb') as f:
+                for line in f:
+                    try:
+                        if not line.endswith(b'\n'):
+                            raise ValueError('incomplete record')
+                        records.append(json.loads(line.decode('utf-8')))
+                    except ValueError as e:
+                        logger.warning('%s is damaged after %d records (%s), cutting it', str(self.log_file), len(records), e)
+                        break
+                    good_size += len(line)
+            if good_size != self.log_file.stat().st_size:
+                os.truncate(str(self.log_file), good_size)
+        self.log_records = len(records)
+        return snapshot, records
+
+    def start(self):
+        """
+        opens log for appending and starts writer thread
+        """
+        if self.log_records >= self.compact_records or not self.file.exists():
+            self.compact()
+        self.log = open(self.log_file, 'ab')
+        self.thread = threading.Thread(target=self.run, name='journal-' + self.file.name, daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def append(self, record):
+        """
+        queues json-serializable record, should be called with lock held right after state change
+        """
+        self.queue.put(record)
+
+    def run(self):
+        while True:
+            records = [self.queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            # group commit - everything queued within flush_interval goes with one write and fsync
+            while records[-1] is not None and len(records) < self.flush_records:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    records.append(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            stop = records[-1] is None
+            records = [r for r in records if r is not None]
+            try:
+                self.write(records)
+                if self.log_records >= self.compact_records:
+                    self.compact()
+            except Exception as e:
+                logger.error('Can not write %s: %s', str(self.log_file), e)
+            if stop:
+                return
+
+    def write(self, records):
+        if not records:
+            return
+        with self.write_lock:
+            self.log.write(b''.join(json.dumps(r, ensure_ascii=False).encode('utf-8') + b'\n' for r in records))
+            self.log.flush()
+            os.fsync(self.log.fileno())
+            self.log_records += len(records)
+
+    def compact(self):
+        """
+        writes current state to snapshot and truncates log
+        records queued after state is taken stay in queue and go to the new log
+        """
+        with self.write_lock:
+            with self.lock:
+                data = pickle.dumps(self.state(), protocol=pickle.HIGHEST_PROTOCOL)
+            tmp_file = self.file.with_name(self.file.name + '.tmp')
+            with open(tmp_file, 'wb') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(str(tmp_file), str(self.file))
+            # crash before truncation only replays records already in snapshot
+            if self.log:
+                self.log.truncate(0)
+            elif self.log_file.exists():
+                os.truncate(str(self.log_file), 0)
+            self.log_records = 0
+        logger.info('Compacted %s', str(self.file))
+
+    def close(self):
+        """
+        writes queued records and stops writer thread
+        """
+        if self.closed or not self.thread:
+            return
+        self.closed = True
+        self.queue.put(None)
+        self.thread.join()
+        self.log.close()
@@ -0,0 +1,554 @@
+#!/usr/bin/env python
+"""
+Offline load test of Telegram Music bot.
+serve - runs local stand-in of Bot API server only, bots are pointed to it with api_base_url
+run - starts fake server and a real TelegramMusicBot on synthetic mp3 collection and drives it with virtual users
+      (search, page, /play, /rate) or replays recorded updates, then reports handler latency and throughput
+"""
+
+import argparse
+import itertools
+import json
+import logging
+import queue
+import random
+import re
+import tempfile
+import threading
+import time
+import urllib.parse
+import urllib.request
+from collections import Counter, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+TOKEN = '123456:LOADTEST'
+SEARCH_WORDS = ['война', 'мир', 'мастер', 'маргарита', 'души', 'идиот', 'пикник', 'сад', 'шинель', 'герой',
+                'толстой', 'чехов', 'пушкин', 'гоголь', 'булгаков', 'стругацкие', 'тургенев', 'куприн']
+
+
+def parse_multipart(body, content_type):
+    """
+    returns python dict field: value of multipart body, files are given as their size in bytes
+    """
+    boundary = re.search('boundary="?([^";]+)"?', content_type).group(1).encode('utf-8')
+    fields = {}
+    for part in body.split(b'--' + boundary)[1:-1]:
+        headers, _, value = part.partition(b'\r\n\r\n')
+        value = value[:-2] if value.endswith(b'\r\n') else value
+        name = re.search(b'name="([^"]*)"', headers).group(1).decode('utf-8')
+        fields[name] = len(value) if b'filename=' in headers else value.decode('utf-8')
+    return fields
+
+
+class FakeBotApiHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.answer(body)
+
+    def do_GET(self):
+        self.answer(urllib.parse.urlsplit(self.path).query.encode('utf-8'), 'application/x-www-form-urlencoded')
+
+    def answer(self, body, content_type=None):
+        match = re.match('/bot([^/]+)/(\\w+)', self.path)
+        if not match:
+            self.reply(404, {'ok': False, 'error_code': 404, 'description': 'Not Found'})
+            return
+        content_type = content_type or self.headers.get('Content-Type', '')
+        if content_type.startswith('multipart/form-data'):
+            params = parse_multipart(body, content_type)
+        elif content_type.startswith('application/json'):
+            params = json.loads(body.decode('utf-8') or '{}')
+        else:
+            params = {k: v[0] for k, v in urllib.parse.parse_qs(body.decode('utf-8')).items()}
+        status, response = self.server.api.call(match.group(1), match.group(2), params)
+        self.reply(status, response)
+
+    def reply(self, status, response):
+        data = json.dumps(response, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+class FakeBotApi:
+    """
+    Local stand-in of Telegram Bot API server.
+    Updates put with put_update() are given to bot by getUpdates or pushed to its webhook.
+    Answers after latency + random jitter seconds, returns 429 when a chat gets more than chat_limit calls
+    per second or randomly with flood_rate probability.
+    """
+    def __init__(self, listen='127.0.0.1', port=8081, latency=0.0, jitter=0.0, chat_limit=None, flood_rate=0.0, retry_after=1):
+        """
+        self.queues - a python dict token: deque of (update, delivered callback) waiting for bot
+        self.webhooks - a python dict token: (url, secret)
+        self.listeners - callables(token, method, params, result) called after every answered call
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.chat_limit = chat_limit
+        self.flood_rate = flood_rate
+        self.retry_after = retry_after
+        self.queues = {}
+        self.webhooks = {}
+        self.ready = {}
+        self.cond = threading.Condition()
+        self.update_ids = itertools.count(1)
+        self.message_ids = itertools.count(1)
+        self.file_ids = set()
+        self.chat_calls = {}
+        self.listeners = []
+        self.calls = Counter()
+        self.floods = 0
+        self.uploaded_bytes = 0
+        self.lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer((listen, port), FakeBotApiHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.api = self
+
+    @property
+    def base_url(self):
+        return 'http://%s:%d/bot' % self.httpd.server_address[:2]
+
+    def start(self):
+        threading.Thread(target=self.httpd.serve_forever, name='fake-bot-api', daemon=True).start()
+        logger.info('Fake Bot API listening on %s', self.base_url)
+
+    def stop(self):
+        self.httpd.shutdown()
+
+    def bot_ready(self, token):
+        """
+        returns Event set when bot polls for updates or registers webhook
+        """
+        with self.cond:
+            return self.ready.setdefault(token, threading.Event())
+
+    def put_update(self, token, update, delivered=None):
+        """
+        queues update for bot, delivered is called with monotonic time when bot takes it
+        """
+        update = dict(update, update_id=next(self.update_ids))
+        with self.cond:
+            self.queues.setdefault(token, deque()).append((update, delivered))
+            self.cond.notify_all()
+
+    def call(self, token, method, params):
+        """
+        returns (http status, response dict) of Bot API method
+        """
+        with self.lock:
+            self.calls[method] += 1
+        if method == 'getUpdates':
+            return 200, {'ok': True, 'result': self.get_updates(token, float(params.get('timeout') or 0))}
+        if method == 'getMe':
+            return 200, {'ok': True, 'result': {'id': 1, 'is_bot': True, 'first_name': 'Load test', 'username': 'loadtest_bot'}}
+        if method == 'setWebhook':
+            self.set_webhook(token, params['url'], params.get('secret_token'))
+            return 200, {'ok': True, 'result': True}
+        if method == 'deleteWebhook':
+            with self.cond:
+                self.webhooks.pop(token, None)
+                self.cond.notify_all()
+            return 200, {'ok': True, 'result': True}
+        handler = getattr(self, 'api_' + method, None)
+        if handler is None:
+            return 404, {'ok': False, 'error_code': 404, 'description': 'Not Found: method %s' % method}
+        time.sleep(self.latency + random.uniform(0, self.jitter))
+        if self.flooded(params.get('chat_id')):
+            return 429, {'ok': False, 'error_code': 429, 'description': 'Too Many Requests: retry after %d' % self.retry_after,
+                         'parameters': {'retry_after': self.retry_after}}
+        try:
+            result = handler(params)
+        except KeyError as e:
+            return 400, {'ok': False, 'error_code': 400, 'description': 'Bad Request: %s is required' % e}
+        except ValueError as e:
+            return 400, {'ok': False, 'error_code': 400, 'description': 'Bad Request: %s' % e}
+        for listener in self.listeners:
+            listener(token, method, params, result)
+        return 200, {'ok': True, 'result': result}
+
+    def flooded(self, chat_id):
+        if self.flood_rate and random.random() < self.flood_rate:
+            self.floods += 1
+            return True
+        if not self.chat_limit or chat_id is None:
+            return False
+        now = time.monotonic()
+        with self.lock:
+            calls = self.chat_calls.setdefault(str(chat_id), deque())
+            while calls and calls[0] < now - 1:
+                calls.popleft()
+            if len(calls) >= self.chat_limit:
+                self.floods += 1
+                return True
+            calls.append(now)
+        return False
+
+    def get_updates(self, token, timeout):
+        self.bot_ready(token).set()
+        deadline = time.monotonic() + timeout
+        with self.cond:
+            updates = self.queues.setdefault(token, deque())
+            while not updates and time.monotonic() < deadline:
+                self.cond.wait(deadline - time.monotonic())
+            taken = [updates.popleft() for _ in range(min(len(updates), 100))]
+        now = time.monotonic()
+        for _, delivered in taken:
+            if delivered:
+                delivered(now)
+        return [update for update, _ in taken]
+
+    def set_webhook(self, token, url, secret):
+        with self.cond:
+            pushing = token in self.webhooks
+            self.webhooks[token] = (url, secret)
+        if not pushing:
+            threading.Thread(target=self.push, args=(token,), name='fake-webhook-push', daemon=True).start()
+        self.bot_ready(token).set()
+
+    def push(self, token):
+        """
+        posts queued updates to webhook of token one by one, as telegram does
+        """
+        while True:
+            with self.cond:
+                updates = self.queues.setdefault(token, deque())
+                while not updates and token in self.webhooks:
+                    self.cond.wait()
+                if token not in self.webhooks:
+                    return
+                url, secret = self.webhooks[token]
+                update, delivered = updates.popleft()
+            headers = {'Content-Type': 'application/json'}
+            if secret:
+                headers['X-Telegram-Bot-Api-Secret-Token'] = secret
+            request = urllib.request.Request(url, data=json.dumps(update).encode('utf-8'), headers=headers)
+            try:
+                urllib.request.urlopen(request, timeout=10).read()
+            except OSError as e:
+                logger.warning('Can not push update to %s: %s', url, e)
+                continue
+            if delivered:
+                delivered(time.monotonic())
+
+    def message(self, params, message_id=None):
+        chat_id = int(params['chat_id'])
+        message = {'message_id': message_id or next(self.message_ids), 'date': int(time.time()),
+                   'chat': {'id': chat_id, 'type': 'private'}}
+        if 'text' in params:
+            message['text'] = params['text']
+        if params.get('reply_markup'):
+            reply_markup = params['reply_markup']
+            message['reply_markup'] = json.loads(reply_markup) if isinstance(reply_markup, str) else reply_markup
+        return message
+
+    def api_sendMessage(self, params):
+        return self.message(params)
+
+    def api_editMessageText(self, params):
+        return self.message(params, int(params['message_id']))
+
+    def api_answerCallbackQuery(self, params):
+        return True
+
+    def api_sendAudio(self, params):
+        audio = params.get('audio')
+        if isinstance(audio, int):
+            with self.lock:
+                file_id = 'fake-%d' % len(self.file_ids)
+                self.file_ids.add(file_id)
+                self.uploaded_bytes += audio
+        elif audio in self.file_ids:
+            file_id = audio
+        else:
+            raise ValueError('wrong file identifier/HTTP URL specified')
+        message = self.message(params)
+        message['audio'] = {'file_id': file_id, 'duration': int(float(params.get('duration') or 0)),
+                            'title': params.get('title'), 'performer': params.get('performer')}
+        return message
+
+
+class LatencyStats:
+    """
+    Latencies of handled updates by kind
+    """
+    def __init__(self):
+        self.latencies = {}
+        self.errors = Counter()
+        self.lock = threading.Lock()
+
+    def add(self, kind, latency):
+        with self.lock:
+            self.latencies.setdefault(kind, []).append(latency)
+
+    def error(self, kind):
+        with self.lock:
+            self.errors[kind] += 1
+
+    def report(self, duration):
+        lines = ['%-8s %8s %7s %10s %10s %10s' % ('kind', 'count', 'errors', 'p50 ms', 'p99 ms', 'per sec')]
+        for kind in sorted(set(self.latencies) | set(self.errors)):
+            values = sorted(self.latencies.get(kind, []))
+            p50 = values[int(len(values) * 0.50)] * 1000 if values else float('nan')
+            p99 = values[min(int(len(values) * 0.99), len(values) - 1)] * 1000 if values else float('nan')
+            lines.append('%-8s %8d %7d %10.1f %10.1f %10.1f' % (kind, len(values), self.errors[kind], p50, p99, len(values) / duration))
+        return '\n'.join(lines)
+
+
+class LoadGenerator:
+    """
+    Drives bot behind FakeBotApi.
+    Virtual users repeat search, next page, /play and /rate of a found track, each step waits for bot reply.
+    Latency is measured from putting update to bot call answering it, /rate has no reply, so it's measured till delivery.
+    """
+    def __init__(self, api, token=TOKEN, users=10, duration=30, timeout=30):
+        """
+        self.inboxes - a python dict chat_id: Queue of (method, params, result, time) of bot calls to the chat
+        """
+        self.api = api
+        self.token = token
+        self.users = users
+        self.duration = duration
+        self.timeout = timeout
+        self.stats = LatencyStats()
+        self.inboxes = {}
+        self.pending = {}
+        self.lock = threading.Lock()
+        api.listeners.append(self.on_call)
+
+    def on_call(self, token, method, params, result):
+        if token != self.token or 'chat_id' not in params:
+            return
+        now = time.monotonic()
+        chat_id = int(params['chat_id'])
+        inbox = self.inboxes.get(chat_id)
+        if inbox is not None:
+            inbox.put((method, params, result, now))
+        with self.lock:
+            pending = self.pending.get(chat_id)
+            entry = pending.popleft() if pending else None
+        if entry:
+            self.stats.add(entry[0], now - entry[1])
+
+    def wait(self, chat_id, method, start, kind):
+        """
+        returns (params, result) of bot call with method to chat or None if bot didn't answer in time
+        """
+        deadline = start + self.timeout
+        while True:
+            try:
+                call_method, params, result, now = self.inboxes[chat_id].get(timeout=max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                self.stats.error(kind)
+                return None
+            if call_method == method:
+                self.stats.add(kind, now - start)
+                return params, result
+
+    def delivery(self, kind, start, done):
+        def delivered(now):
+            self.stats.add(kind, now - start)
+            done.set()
+        return delivered
+
+    def run(self):
+        """
+        runs virtual users for duration seconds, returns LatencyStats
+        """
+        threads = [threading.Thread(target=self.user, args=(1000000 + n,), name='user-%d' % n, daemon=True) for n in range(self.users)]
+        self.started = time.monotonic()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return self.stats
+
+    def user(self, chat_id):
+        self.inboxes[chat_id] = queue.Queue()
+        rnd = random.Random(chat_id)
+        user = {'id': chat_id, 'is_bot': False, 'first_name': 'User', 'username': 'user%d' % chat_id}
+        chat = {'id': chat_id, 'type': 'private', 'username': user['username']}
+        message_ids = itertools.count(1)
+
+        def message(text):
+            message = {'message_id': next(message_ids), 'date': int(time.time()), 'chat': chat, 'from': user, 'text': text}
+            if text.startswith('/'):
+                message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+            return message
+
+        while time.monotonic() - self.started < self.duration:
+            query = message(' '.join(rnd.sample(SEARCH_WORDS, rnd.randint(1, 2))))
+            start = time.monotonic()
+            self.api.put_update(self.token, {'message': query})
+            reply = self.wait(chat_id, 'sendMessage', start, 'search')
+            if reply is None:
+                continue
+            params, result = reply
+            buttons = [b for row in (result.get('reply_markup') or {}).get('inline_keyboard', []) for b in row]
+            next_page = [b['callback_data'] for b in buttons if b.get('text') == '>']
+            if next_page:
+                callback_message = dict(result, reply_to_message=query)
+                start = time.monotonic()
+                self.api.put_update(self.token, {'callback_query': {'id': str(rnd.getrandbits(32)), 'from': user, 'chat_instance': str(chat_id),
+                                                                    'message': callback_message, 'data': next_page[0]}})
+                self.wait(chat_id, 'editMessageText', start, 'page')
+            hashes = re.findall('/play_(\\w+)', result.get('text', ''))
+            if not hashes:
+                continue
+            hash = rnd.choice(hashes)
+            start = time.monotonic()
+            self.api.put_update(self.token, {'message': message('/play_' + hash)})
+            self.wait(chat_id, 'sendAudio', start, 'play')
+            done = threading.Event()
+            start = time.monotonic()
+            self.api.put_update(self.token, {'message': message('/rate_' + hash)}, self.delivery('rate', start, done))
+            if not done.wait(self.timeout):
+                self.stats.error('rate')
+
+    def replay(self, updates, rate):
+        """
+        puts recorded updates at rate per second without waiting for replies, returns LatencyStats
+        every bot call to a chat answers the oldest unanswered update of that chat
+        """
+        self.started = time.monotonic()
+        for n, update in enumerate(updates):
+            time.sleep(max(self.started + n / rate - time.monotonic(), 0))
+            kind = update_kind(update)
+            start = time.monotonic()
+            if kind == 'rate':
+                self.api.put_update(self.token, update, self.delivery(kind, start, threading.Event()))
+                continue
+            chat_id = update_chat(update)
+            with self.lock:
+                self.pending.setdefault(chat_id, deque()).append((kind, start))
+            self.api.put_update(self.token, update)
+        time.sleep(min(self.timeout, 5))
+        with self.lock:
+            for pending in self.pending.values():
+                for kind, _ in pending:
+                    self.stats.error(kind)
+        return self.stats
+
+
+def update_chat(update):
+    if 'callback_query' in update:
+        return update['callback_query']['message']['chat']['id']
+    return update['message']['chat']['id']
+
+
+def update_kind(update):
+    if 'callback_query' in update:
+        return 'page'
+    text = update.get('message', {}).get('text', '')
+    if text.startswith('/play'):
+        return 'play'
+    if text.startswith('/rate'):
+        return 'rate'
+    if text.startswith('/'):
+        return 'command'
+    return 'search'
+
+
+def read_updates(filename):
+    """
+    reads json lines file of Bot API updates, lines may also be {"update": update}
+    """
+    with open(filename) as f:
+        updates = [json.loads(line) for line in f if line.strip()]
+    return [u.get('update', u) for u in updates]
+
+
+def start_bot(args, api, tmp):
+    """
+    starts TelegramMusicBot on synthetic collection in tmp, returns it
+    """
+    from telegram_music_bench import make_mp3_collection
+    collection_path = make_mp3_collection(tmp + '/collection', args.tracks, frames=args.frames)
+    bot_params = {'nickname': 'loadtest', 'token': TOKEN, 'hello_html': 'Load test bot',
+                  'collection_path': str(collection_path), 'id3based': False,
+                  'telegram_fileid_file': tmp + '/fileid.pickle', 'track_rates_file': tmp + '/rates.pickle',
+                  'api_base_url': api.base_url, 'handle_signals': False, 'update_mode': args.mode,
+                  'webhook_url': 'http://127.0.0.1:%d' % args.webhook_port, 'webhook_listen': '127.0.0.1', 'webhook_port': args.webhook_port,
+                  'send_queue': not args.no_send_queue}
+    if args.runtime == 'asyncio':
+        from telegram_music_aio import AioTelegramMusicBot
+        bot = AioTelegramMusicBot(**bot_params)
+        threading.Thread(target=bot.start, name='bot', daemon=True).start()
+    else:
+        from telegram_music_bot import TelegramMusicBot
+        bot = TelegramMusicBot(**bot_params)
+        bot.start()
+    return bot
+
+
+def serve(args):
+    api = FakeBotApi(args.listen, args.port, args.latency, args.jitter, args.chat_limit, args.flood_rate)
+    api.start()
+    print('Fake Bot API is listening on %s, use it as api_base_url' % api.base_url)
+    threading.Event().wait()
+
+
+def run(args):
+    api = FakeBotApi('127.0.0.1', args.port, args.latency, args.jitter, args.chat_limit, args.flood_rate)
+    api.start()
+    with tempfile.TemporaryDirectory() as tmp:
+        bot = start_bot(args, api, tmp)
+        if not api.bot_ready(TOKEN).wait(60):
+            raise RuntimeError('Bot did not connect to fake Bot API')
+        generator = LoadGenerator(api, TOKEN, args.users, args.duration, args.timeout)
+        start = time.monotonic()
+        if args.updates:
+            stats = generator.replay(read_updates(args.updates), args.rate)
+        else:
+            stats = generator.run()
+        elapsed = time.monotonic() - start
+        print('runtime: %s  mode: %s  users: %d  tracks: %d  duration: %.1f s' % (args.runtime, args.mode, args.users, args.tracks, elapsed))
+        print(stats.report(elapsed))
+        print('api calls: %s  429 answers: %d  uploaded: %.1f MB' % (dict(api.calls), api.floods, api.uploaded_bytes / 2 ** 20))
+        bot.stop()
+    api.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline load test of Telegram Music bot')
+    subparsers = parser.add_subparsers(dest='command')
+    for name, func, help in (('serve', serve, 'run fake Bot API server only'), ('run', run, 'load test a bot against fake Bot API server')):
+        subparser = subparsers.add_parser(name, help=help)
+        subparser.add_argument('--port', type=int, default=8081)
+        subparser.add_argument('--latency', type=float, default=0.05, help='seconds fake server takes to answer')
+        subparser.add_argument('--jitter', type=float, default=0.02, help='random extra latency up to this many seconds')
+        subparser.add_argument('--chat-limit', type=int, default=None, help='calls per second to a chat before 429')
+        subparser.add_argument('--flood-rate', type=float, default=0.0, help='probability of 429 for any call')
+        subparser.set_defaults(func=func)
+    subparsers.choices['serve'].add_argument('--listen', default='127.0.0.1')
+    run_parser = subparsers.choices['run']
+    run_parser.add_argument('--runtime', choices=['threads', 'asyncio'], default='threads')
+    run_parser.add_argument('--mode', choices=['polling', 'webhook'], default='polling')
+    run_parser.add_argument('--webhook-port', type=int, default=8443)
+    run_parser.add_argument('--tracks', type=int, default=2000)
+    run_parser.add_argument('--frames', type=int, default=50, help='mp3 frames per synthetic track')
+    run_parser.add_argument('--users', type=int, default=20)
+    run_parser.add_argument('--duration', type=float, default=30)
+    run_parser.add_argument('--timeout', type=float, default=30)
+    run_parser.add_argument('--updates', help='json lines file of recorded updates to replay instead of virtual users')
+    run_parser.add_argument('--rate', type=float, default=50, help='updates per second of replay')
+    run_parser.add_argument('--no-send-queue', action='store_true', help='send without outbox rate limits')
+    args = parser.parse_args()
+    if not args.command:
+        parser.print_help()
+        return
+    logging.getLogger().setLevel(logging.WARNING)
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,313 @@
+#!/usr/bin/env python
+"""
+In-process metrics of Telegram Music bots in Prometheus text format.
+Counters and histograms keep a cell per writing thread, so recording takes no lock and no update is lost,
+cells are summed when metrics are scraped. Histogram buckets are fixed when metric is created.
+"""
+
+import bisect
+import functools
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+# seconds, from cached search to slow uploads
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+SIZE_BUCKETS = (0, 1, 3, 10, 30, 100, 300, 1000, 3000, 10000, 30000, 100000)
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, escape(value)) for name, value in pairs)
+
+
+class ThreadCells:
+    """
+    Per thread lists of numbers, a thread changes only its own list
+    cells of finished threads are added to self.retired and dropped, so threads coming and going don't grow memory
+    """
+    def __init__(self, size):
+        """
+        self.cells - a python list of (thread, its cell)
+        """
+        self.size = size
+        self.local = threading.local()
+        self.cells = []
+        self.retired = [0] * size
+        # cells are checked for finished threads when there are this many
+        self.retire_at = 64
+        self.lock = threading.Lock()
+
+    def cell(self):
+        try:
+            return self.local.cell
+        except AttributeError:
+            cell = self.local.cell = [0] * self.size
+            with self.lock:
+                self.cells.append((threading.current_thread(), cell))
+                if len(self.cells) >= self.retire_at:
+                    self.retire()
+                    self.retire_at = max(64, 2 * len(self.cells))
+            return cell
+
+    def retire(self):
+        """
+        moves counts of finished threads to self.retired, self.lock must be held
+        """
+        alive = []
+        for thread, cell in self.cells:
+            if thread.is_alive():
+                alive.append((thread, cell))
+            else:
+                # finished thread doesn't write its cell anymore
+                for i, value in enumerate(cell):
+                    self.retired[i] += value
+        self.cells = alive
+
+    def totals(self):
+        with self.lock:
+            self.retire()
+            cells = [cell for thread, cell in self.cells]
+            totals = list(self.retired)
+        for cell in cells:
+            for i, value in enumerate(cell):
+                totals[i] += value
+        return totals
+
+
+class CounterChild:
+    def __init__(self):
+        self.cells = ThreadCells(1)
+
+    def inc(self, value=1):
+        self.cells.cell()[0] += value
+
+    def value(self):
+        return self.cells.totals()[0]
+
+
+class HistogramChild:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # counts of buckets, count of values above last bucket, sum of values
+        self.cells = ThreadCells(len(buckets) + 2)
+
+    def observe(self, value):
+        cell = self.cells.cell()
+        cell[bisect.bisect_left(self.buckets, value)] += 1
+        cell[-1] += value
+
+    def time(self):
+        return Timer(self)
+
+    def value(self):
+        """
+        returns (cumulative bucket counts including +Inf, sum)
+        """
+        totals = self.cells.totals()
+        cumulative = []
+        count = 0
+        for n in totals[:-1]:
+            count += n
+            cumulative.append(count)
+        return cumulative, totals[-1]
+
+
+class GaugeChild:
+    """
+    Gauge read from a function when metrics are scraped
+    """
+    def __init__(self):
+        self.func = None
+
+    def set_function(self, func):
+        self.func = func
+
+    def value(self):
+        return self.func() if self.func else 0
+
+
+class Timer:
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.start)
+
+
+class Metric:
+    """
+    Named metric with a child per label values, metric without labels has one child of no values
+    """
+    def __init__(self, kind, name, help, labels, make_child):
+        self.kind = kind
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self.make_child = make_child
+        self.children = {}
+        self.lock = threading.Lock()
+
+    def labels(self, *values):
+        """
+        returns child of label values, hot paths should keep it instead of looking it up every time
+        """
+        values = tuple(str(v) for v in values)
+        child = self.children.get(values)
+        if child is None:
+            with self.lock:
+                child = self.children.setdefault(values, self.make_child())
+        return child
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s %s' % (self.name, self.kind)]
+        with self.lock:
+            children = sorted(self.children.items())
+        for values, child in children:
+            if self.kind == 'histogram':
+                counts, total = child.value()
+                for bound, count in zip(list(child.buckets) + ['+Inf'], counts):
+                    lines.append('%s_bucket%s %s' % (self.name, format_labels(self.label_names, values, [('le', bound)]), count))
+                lines.append('%s_sum%s %s' % (self.name, format_labels(self.label_names, values), total))
+                lines.append('%s_count%s %s' % (self.name, format_labels(self.label_names, values), counts[-1]))
+            else:
+                try:
+                    value = child.value()
+                except Exception as e:
+                    logger.warning('Can not read %s%s: %s', self.name, values, e)
+                    continue
+                lines.append('%s%s %s' % (self.name, format_labels(self.label_names, values), value))
+        return '\n'.join(lines)
+
+
+class Metrics:
+    """
+    Registry of metrics of the process
+    """
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def register(self, kind, name, help, labels, make_child):
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = Metric(kind, name, help, labels, make_child)
+            return metric
+
+    def counter(self, name, help, labels=()):
+        return self.register('counter', name, help, labels, CounterChild)
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        return self.register('histogram', name, help, labels, lambda: HistogramChild(buckets))
+
+    def gauge(self, name, help, labels=()):
+        return self.register('gauge', name, help, labels, GaugeChild)
+
+    def render(self):
+        with self.lock:
+            metrics = list(self.metrics.values())
+        return '\n'.join(metric.render() for metric in metrics) + '\n'
+
+
+REGISTRY = Metrics()
+
+HANDLER_SECONDS = REGISTRY.histogram('telegram_music_handler_seconds', 'Time spent handling updates', ['handler'])
+HANDLER_ERRORS = REGISTRY.counter('telegram_music_handler_errors_total', 'Updates whose handler raised', ['handler'])
+API_SECONDS = REGISTRY.histogram('telegram_music_api_call_seconds', 'Bot API call time', ['method'])
+API_ERRORS = REGISTRY.counter('telegram_music_api_errors_total', 'Failed Bot API calls', ['method', 'code'])
+SEARCH_RESULTS = REGISTRY.histogram('telegram_music_search_results', 'Tracks found by not cached searches', buckets=SIZE_BUCKETS).labels()
+SEARCH_CANDIDATES = REGISTRY.histogram('telegram_music_search_candidates', 'Strings checked by n-gram index lookups', ['lookup'], buckets=SIZE_BUCKETS)
+SEARCH_CACHE = REGISTRY.counter('telegram_music_search_cache_total', 'Search cache lookups', ['result'])
+UPLOAD_BYTES = REGISTRY.counter('telegram_music_upload_bytes_total', 'Bytes of uploaded audio files').labels()
+# children used on every search are looked up once
+EXACT_CANDIDATES = SEARCH_CANDIDATES.labels('exact')
+FUZZY_CANDIDATES = SEARCH_CANDIDATES.labels('fuzzy')
+CACHE_HITS = SEARCH_CACHE.labels('hit')
+CACHE_MISSES = SEARCH_CACHE.labels('miss')
+OUTBOX_QUEUED = REGISTRY.gauge('telegram_music_outbox_queued', 'Calls waiting in outbox', ['bot'])
+INDEX_VERSION = REGISTRY.gauge('telegram_music_index_version', 'Version of collection index used by bot', ['bot'])
+
+
+def measured(handler):
+    """
+    decorator recording time and errors of handler under its name, goes below @run_async to time the handling itself
+    """
+    seconds = HANDLER_SECONDS.labels(handler.__name__)
+    errors = HANDLER_ERRORS.labels(handler.__name__)
+
+    @functools.wraps(handler)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return handler(*args, **kwargs)
+        except Exception:
+            errors.inc()
+            raise
+        finally:
+            seconds.observe(time.perf_counter() - start)
+    return wrapper
+
+
+def observe_api_call(method, seconds, error_code=None):
+    API_SECONDS.labels(method).observe(seconds)
+    if error_code is not None:
+        API_ERRORS.labels(method, error_code).inc()
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.server.registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+class MetricsServer:
+    """
+    HTTP server of /metrics, bots of one process share it
+    """
+    servers = {}
+    servers_lock = threading.Lock()
+
+    @classmethod
+    def get(cls, listen='0.0.0.0', port=9464, registry=REGISTRY):
+        """
+        returns server for listen address, creating and starting it on first use
+        """
+        with cls.servers_lock:
+            server = cls.servers.get((listen, port))
+            if server is None:
+                server = cls.servers[(listen, port)] = MetricsServer(listen, port, registry)
+                server.start()
+            return server
+
+    def __init__(self, listen, port, registry):
+        self.httpd = ThreadingHTTPServer((listen, port), MetricsRequestHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.registry = registry
+
+    def start(self):
+        threading.Thread(target=self.httpd.serve_forever, name='metrics-http', daemon=True).start()
+        logger.info('Metrics are served on %s:%d/metrics', *self.httpd.server_address[:2])
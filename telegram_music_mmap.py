@@ -0,0 +1,465 @@
+#!/usr/bin/env python
+"""
+Read-only memory mapped collection index.
+TelegramMusicCollection exports its index into one file, other bot processes attach to it without parsing
+the collection and share its pages through the page cache, so memory used by an extra process
+doesn't grow with collection size.
+
+File layout: 8 bytes magic, 8 bytes header size, json header, then 8-byte aligned sections.
+Header keeps offsets of sections, sections are arrays of native unsigned ints or raw bytes.
+All strings are stored once in a string table and referenced by number, string ids of every sorted
+table are ordered by utf-8 bytes of strings, so tables are searched by bisection right in the mapped file.
+"""
+
+import json
+import logging
+import mmap
+import os
+import random
+import struct
+import sys
+import threading
+import time
+from array import array
+from pathlib import Path
+from telegram_music_collection import NgramIndex, SearchCache, ChatShuffle, best_matches, shared_gram_candidates
+from telegram_music_metrics import SEARCH_RESULTS, EXACT_CANDIDATES, FUZZY_CANDIDATES
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'TMMIDX01'
+# bump when layout of sections changes
+EXPORT_VERSION = 1
+HASH_SIZE = 10
+ENCODING = ('utf-8', 'surrogateescape')
+
+
+def encode(s):
+    return s.encode(*ENCODING)
+
+
+def export_index(index, filename, basedir):
+    """
+    writes CollectionIndex to filename, paths are stored relative to basedir
+    file is replaced atomically, processes attached to the old file keep using it until they reattach
+    """
+    strings = {}
+    string_data = bytearray()
+    string_offsets = array('Q', [0])
+
+    def sid(s):
+        """returns id of string s in string table"""
+        if s not in strings:
+            strings[s] = len(string_offsets) - 1
+            string_data.extend(encode(s))
+            string_offsets.append(len(string_data))
+        return strings[s]
+
+    sections = {}
+    captions = sorted(index.mds_dict, key=encode)
+    track_ids = {caption: i for i, caption in enumerate(captions)}
+    columns = {name: array('I') for name in ('caption', 'path', 'filename', 'author', 'title', 'length')}
+    track_hashes = bytearray()
+    for caption in captions:
+        track = index.mds_dict[caption]
+        columns['caption'].append(sid(caption))
+        columns['path'].append(sid(str(Path(track['path']).relative_to(basedir))))
+        columns['filename'].append(sid(track['filename']))
+        columns['author'].append(sid(track['author']))
+        columns['title'].append(sid(track['title']))
+        columns['length'].append(int(track['length']))
+        track_hashes.extend(encode(track['hash']).ljust(HASH_SIZE, b'\0')[:HASH_SIZE])
+    for name, column in columns.items():
+        sections['track_' + name] = column
+    sections['track_hash'] = track_hashes
+
+    hashes = sorted((encode(hash).ljust(HASH_SIZE, b'\0')[:HASH_SIZE], track_ids[caption]) for hash, caption in index.hash_dict.items())
+    sections['hash_keys'] = b''.join(hash for hash, _ in hashes)
+    sections['hash_tracks'] = array('I', (i for _, i in hashes))
+
+    entity_ids = {'caption': track_ids}
+    for name, lookup_dict in (('author', index.author_dict), ('title', index.title_dict)):
+        keys = sorted(lookup_dict, key=encode)
+        entity_ids[name] = {key: i for i, key in enumerate(keys)}
+        offsets = array('I', [0])
+        tracks = array('I')
+        for key in keys:
+            tracks.extend(track_ids[caption] for caption in lookup_dict[key])
+            offsets.append(len(tracks))
+        sections[name + '_strings'] = array('I', (sid(key) for key in keys))
+        sections[name + '_offsets'] = offsets
+        sections[name + '_tracks'] = tracks
+
+    grams = {}
+    for name, ngram_index in (('caption', index.caption_index), ('author', index.author_index), ('title', index.title_index)):
+        ids = entity_ids[name]
+        gram_keys = sorted(ngram_index.postings, key=encode)
+        offsets = array('I', [0])
+        postings = array('I')
+        for g in gram_keys:
+            postings.extend(sorted(ids[s] for s in ngram_index.postings[g]))
+            offsets.append(len(postings))
+        sections[name + '_grams'] = array('I', (sid(g) for g in gram_keys))
+        sections[name + '_gram_offsets'] = offsets
+        sections[name + '_postings'] = postings
+        sections[name + '_lengths'] = array('I', (len(s) for s in sorted(ids, key=ids.get)))
+        grams[name] = ngram_index.n
+
+    sections['random_pool'] = array('I', (track_ids[caption] for caption in index.random_pool))
+    sections['string_offsets'] = string_offsets
+    sections['string_data'] = string_data
+
+    layout = {}
+    offset = 0
+    for name, data in sections.items():
+        typecode = data.typecode if isinstance(data, array) else 'B'
+        size = len(data) * (data.itemsize if isinstance(data, array) else 1)
+        layout[name] = [offset, size, typecode]
+        offset += size + (-size) % 8
+    header = json.dumps({'export_version': EXPORT_VERSION,
+                         'byteorder': sys.byteorder,
+                         'version': index.version,
+                         'tracks': len(captions),
+                         'grams': grams,
+                         'sections': layout}).encode('utf-8')
+    header += b' ' * (-(len(header) + 16) % 8)
+
+    filename = Path(filename)
+    tmp_file = filename.with_name(filename.name + '.tmp')
+    with open(tmp_file, 'wb') as f:
+        f.write(MAGIC + struct.pack('<Q', len(header)) + header)
+        for name, data in sections.items():
+            size = layout[name][1]
+            f.write(data.tobytes() if isinstance(data, array) else data)
+            f.write(b'\0' * ((-size) % 8))
+    os.replace(str(tmp_file), str(filename))
+    logger.info('Exported index version %d with %d tracks to %s', index.version, len(captions), str(filename))
+
+
+class MmapNgramIndex:
+    """
+    NgramIndex stored in mapped file, works with ids of indexed strings
+    """
+    grams = NgramIndex.grams
+
+    def __init__(self, index, name, n):
+        self.index = index
+        self.n = n
+        self.strings = index.section(name + '_strings') if name != 'caption' else index.section('track_caption')
+        self.gram_strings = index.section(name + '_grams')
+        self.offsets = index.section(name + '_gram_offsets')
+        self.postings = index.section(name + '_postings')
+        self.lengths = index.section(name + '_lengths')
+
+    def string(self, i):
+        return self.index.string(self.strings[i])
+
+    def posting(self, g):
+        """
+        returns ids of strings containing gram g
+        """
+        i = self.index.find(self.gram_strings, encode(g))
+        if i is None:
+            return ()
+        return self.postings[self.offsets[i]:self.offsets[i + 1]]
+
+    def containing(self, substring):
+        """
+        returns ids of indexed strings containing substring, case insensitive
+        """
+        substring = substring.lower()
+        if len(substring) < self.n:
+            return [i for i in range(len(self.strings)) if substring in self.string(i).lower()]
+        postings = sorted((self.posting(g) for g in self.grams(substring)), key=len)
+        candidates = set(postings[0])
+        for posting in postings[1:]:
+            if not candidates:
+                break
+            candidates &= set(posting)
+        EXACT_CANDIDATES.observe(len(candidates))
+        return [i for i in candidates if substring in self.string(i).lower()]
+
+    def close_matches(self, word, n=3, cutoff=0.6, count=None):
+        """
+        returns ids of strings NgramIndex.close_matches would return
+        count - function returning how many times string of id is repeated in possibilities
+        """
+        candidates = shared_gram_candidates([self.posting(g) for g in self.grams(word)], len(self.strings), len(word), cutoff,
+                                            self.n, self.lengths.__getitem__)
+        FUZZY_CANDIDATES.observe(len(candidates))
+        ids = {self.string(i): i for i in candidates}
+        matches = best_matches(word, ids, n, cutoff, count and (lambda s: count(ids[s])))
+        return [ids[s] for s in matches]
+
+
+class MmapCollectionIndex:
+    """
+    Same read interface as CollectionIndex on top of file written by export_index()
+    """
+    def __init__(self, filename, basedir, version, search_cache=None, shuffle=None):
+        """
+        self.basedir - Path object, track paths are relative to it
+        self.version - number of the snapshot in this process
+        """
+        self.file = Path(filename)
+        self.basedir = Path(basedir)
+        self.version = version
+        self.search_cache = search_cache
+        self.shuffle = shuffle
+        with open(self.file, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, header_size = struct.unpack_from('<8sQ', self.mm)
+        if magic != MAGIC:
+            raise ValueError('%s is not exported collection index' % str(self.file))
+        self.header = json.loads(self.mm[16:16 + header_size].decode('utf-8'))
+        if self.header['export_version'] != EXPORT_VERSION or self.header['byteorder'] != sys.byteorder:
+            raise ValueError('%s is exported in incompatible format' % str(self.file))
+        self.data = memoryview(self.mm)[16 + header_size:]
+        self.sections = {}
+        self.string_offsets = self.section('string_offsets')
+        self.string_data = self.section('string_data')
+        self.hash_keys = self.section('hash_keys')
+        self.hash_tracks = self.section('hash_tracks')
+        self.track_caption = self.section('track_caption')
+        self.track_hash = self.section('track_hash')
+        self.random_pool = self.section('random_pool')
+        self.caption_index = MmapNgramIndex(self, 'caption', self.header['grams']['caption'])
+        self.author_index = MmapNgramIndex(self, 'author', self.header['grams']['author'])
+        self.title_index = MmapNgramIndex(self, 'title', self.header['grams']['title'])
+
+    def section(self, name):
+        """
+        returns memoryview of section, int arrays are cast to their type
+        """
+        if name not in self.sections:
+            offset, size, typecode = self.header['sections'][name]
+            view = self.data[offset:offset + size]
+            self.sections[name] = view if typecode == 'B' else view.cast(typecode)
+        return self.sections[name]
+
+    def raw(self, i):
+        return bytes(self.string_data[self.string_offsets[i]:self.string_offsets[i + 1]])
+
+    def string(self, i):
+        return str(self.string_data[self.string_offsets[i]:self.string_offsets[i + 1]], *ENCODING)
+
+    def find(self, table, key):
+        """
+        returns position of string with utf-8 bytes key in sorted table of string ids or None
+        """
+        lo, hi = 0, len(table)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.raw(table[mid]) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(table) and self.raw(table[lo]) == key:
+            return lo
+        return None
+
+    def track(self, caption):
+        """
+        returns id of track with given caption or None
+        """
+        if caption is None:
+            return None
+        return self.find(self.track_caption, encode(caption))
+
+    def field(self, caption, name):
+        i = self.track(caption)
+        if i is None:
+            return None
+        return self.section('track_' + name)[i]
+
+    def captions(self, track_ids):
+        return [self.string(self.track_caption[i]) for i in track_ids]
+
+    def __len__(self):
+        return len(self.track_caption)
+
+    def __iter__(self):
+        return (self.string(i) for i in self.track_caption)
+
+    def random(self, chat_id=None):
+        """
+        returns random title, parts and chapters are skipped
+        """
+        if not len(self.random_pool):
+            return None
+        if chat_id is None or self.shuffle is None:
+            return self.string(self.track_caption[random.choice(self.random_pool)])
+        return self.string(self.track_caption[self.random_pool[self.shuffle.next(chat_id, self.version, len(self.random_pool))]])
+
+    def path(self, caption):
+        i = self.field(caption, 'path')
+        return None if i is None else self.basedir / self.string(i)
+
+    def filename(self, caption):
+        i = self.field(caption, 'filename')
+        return None if i is None else self.string(i)
+
+    def exists(self, caption):
+        return self.track(caption) is not None
+
+    def get_by_hash(self, hash):
+        key = encode(hash).ljust(HASH_SIZE, b'\0')
+        if len(key) != HASH_SIZE:
+            return None
+        lo, hi = 0, len(self.hash_tracks)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if bytes(self.hash_keys[mid * HASH_SIZE:(mid + 1) * HASH_SIZE]) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(self.hash_tracks) and bytes(self.hash_keys[lo * HASH_SIZE:(lo + 1) * HASH_SIZE]) == key:
+            return self.string(self.track_caption[self.hash_tracks[lo]])
+        return None
+
+    def hash(self, caption):
+        i = self.track(caption)
+        if i is None:
+            return None
+        return str(bytes(self.track_hash[i * HASH_SIZE:(i + 1) * HASH_SIZE]).rstrip(b'\0'), *ENCODING)
+
+    def author(self, caption):
+        i = self.field(caption, 'author')
+        return None if i is None else self.string(i)
+
+    def title(self, caption):
+        i = self.field(caption, 'title')
+        return None if i is None else self.string(i)
+
+    def length(self, caption):
+        length = self.field(caption, 'length')
+        return None if length is None else str(length)
+
+    def search(self, search_string):
+        if len(search_string) < 3:
+            return []
+        if len(search_string) > 100:
+            search_string = search_string[:100]
+        if self.search_cache is not None:
+            found = self.search_cache.get((search_string, self.version))
+            if found is not None:
+                return found
+        found = list(sorted(set(self.search_exact(search_string) + self.search_diff_author(search_string) + self.search_diff_title(search_string) + self.search_diff_caption(search_string))))
+        SEARCH_RESULTS.observe(len(found))
+        if self.search_cache is not None:
+            self.search_cache.set((search_string, self.version), found)
+        return found
+
+    def tracks_of(self, name, ids):
+        """
+        returns captions of tracks having author or title with given ids
+        """
+        offsets = self.section(name + '_offsets')
+        tracks = self.section(name + '_tracks')
+        return self.captions(t for i in ids for t in tracks[offsets[i]:offsets[i + 1]])
+
+    def search_diff_caption(self, search_string):
+        return sorted(self.captions(self.caption_index.close_matches(search_string)))
+
+    def tracks_count(self, name):
+        """
+        returns function of author or title id returning number of its tracks
+        """
+        offsets = self.section(name + '_offsets')
+        return lambda i: offsets[i + 1] - offsets[i]
+
+    def search_diff_title(self, search_string):
+        return sorted(self.tracks_of('title', self.title_index.close_matches(search_string, count=self.tracks_count('title'))))
+
+    def search_diff_author(self, search_string):
+        return sorted(self.tracks_of('author', self.author_index.close_matches(search_string, count=self.tracks_count('author'))))
+
+    def search_exact(self, search_string):
+        return sorted(self.captions(self.caption_index.containing(search_string)))
+
+
+class MmapCollection:
+    """
+    Collection attached to index exported by another process.
+    File is checked every check_interval seconds and reattached when it's replaced.
+    """
+    def __init__(self, filename, basedir, search_cache_size=1024, search_cache_ttl=600, random_shuffle=False, check_interval=5):
+        self.file = Path(filename)
+        self.mds_basedir = Path(basedir)
+        self.check_interval = check_interval
+        self.search_cache = SearchCache(search_cache_size, search_cache_ttl) if search_cache_size else None
+        self.shuffle = ChatShuffle() if random_shuffle else None
+        self.attach_lock = threading.Lock()
+        self.index = None
+        self.file_id = None
+        self.checked = 0
+        self.reindex()
+
+    @property
+    def version(self):
+        return self.index.version
+
+    def snapshot(self):
+        """
+        returns current MmapCollectionIndex, reattaches if exported file was replaced
+        """
+        if time.monotonic() - self.checked > self.check_interval:
+            self.reindex()
+        return self.index
+
+    def reindex(self):
+        """
+        attaches to exported file if it was replaced since last attach
+        """
+        with self.attach_lock:
+            self.checked = time.monotonic()
+            try:
+                st = self.file.stat()
+            except OSError as e:
+                if self.index is None:
+                    raise
+                logger.warning('Can not check %s: %s', str(self.file), e)
+                return
+            if (st.st_ino, st.st_mtime_ns, st.st_size) == self.file_id:
+                return
+            version = self.index.version + 1 if self.index else 1
+            self.index = MmapCollectionIndex(self.file, self.mds_basedir, version, self.search_cache, self.shuffle)
+            self.file_id = (st.st_ino, st.st_mtime_ns, st.st_size)
+            logger.info('Attached index version %d with %d tracks from %s', version, len(self.index), str(self.file))
+
+    def reindex_async(self):
+        """
+        attaching is cheap, so it's done right away
+        """
+        self.reindex()
+        return True
+
+    def random(self, chat_id=None):
+        return self.snapshot().random(chat_id)
+
+    def path(self, caption):
+        return self.snapshot().path(caption)
+
+    def filename(self, caption):
+        return self.snapshot().filename(caption)
+
+    def exists(self, caption):
+        return self.snapshot().exists(caption)
+
+    def get_by_hash(self, hash):
+        return self.snapshot().get_by_hash(hash)
+
+    def hash(self, caption):
+        return self.snapshot().hash(caption)
+
+    def author(self, caption):
+        return self.snapshot().author(caption)
+
+    def title(self, caption):
+        return self.snapshot().title(caption)
+
+    def length(self, caption):
+        return self.snapshot().length(caption)
+
+    def search(self, search_string):
+        return self.snapshot().search(search_string)
@@ -0,0 +1,352 @@
+#!/usr/bin/env python
+"""
+Outbound scheduler of Bot API calls.
+Calls are queued per chat and a chat has one call in flight at a time, so messages to a chat keep their order,
+calls are sent when both global and chat token buckets allow it. Interactive calls go ahead of background ones, queued edit of a message
+is replaced by a newer edit of the same message, calls rejected with retry_after are delayed and repeated.
+"""
+
+import asyncio
+import concurrent.futures
+import itertools
+import logging
+import threading
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+# priority classes, lower is sent first
+INTERACTIVE = 0
+BACKGROUND = 1
+
+
+class TokenBucket:
+    """
+    Allows rate calls per second on average and bursts of up to burst calls
+    """
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.time = time.monotonic()
+        self.blocked_until = 0
+
+    def delay(self, now):
+        """
+        returns seconds to wait for a token
+        """
+        self.tokens = min(self.burst, self.tokens + (now - self.time) * self.rate)
+        self.time = now
+        wait = 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+        return max(wait, self.blocked_until - now)
+
+    def take(self):
+        self.tokens -= 1
+
+    def block(self, now, seconds):
+        """
+        gives no tokens for seconds, used when Bot API asks to retry after
+        """
+        self.blocked_until = max(self.blocked_until, now + seconds)
+
+    def idle(self, now):
+        return self.delay(now) == 0 and self.tokens >= self.burst
+
+
+class OutboundCall:
+    __slots__ = ('func', 'chat_id', 'priority', 'key', 'future', 'seq', 'attempts', 'upload')
+
+    def __init__(self, func, chat_id, priority, key, future, seq, upload=False):
+        self.func = func
+        self.chat_id = chat_id
+        self.priority = priority
+        self.key = key
+        self.future = future
+        self.seq = seq
+        self.attempts = 0
+        self.upload = upload
+
+
+class Outbox:
+    """
+    Queue of outbound calls, subclasses run them on threads or on event loop.
+    Choosing next call scans chats with queued calls, which are few compared to all chats.
+    """
+    def __init__(self, rate=30, burst=30, chat_rate=1, chat_burst=3, max_attempts=5):
+        """
+        self.chats - a python dict chat_id: deque of queued calls
+        self.chat_buckets - a python dict chat_id: TokenBucket, full buckets of idle chats are dropped
+        self.pending_edits - a python dict coalescing key: queued call
+        self.busy_chats - chats with a call in flight, their next calls wait for it
+        """
+        self.global_bucket = TokenBucket(rate, burst)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_attempts = max_attempts
+        self.chats = {}
+        self.chat_buckets = {}
+        self.pending_edits = {}
+        self.busy_chats = set()
+        self.seq = itertools.count()
+        self.lock = threading.Lock()
+        self.sent = 0
+        self.coalesced = 0
+        self.retried = 0
+
+    def chat_bucket(self, chat_id):
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self.chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    def put(self, func, chat_id, priority=INTERACTIVE, key=None, upload=False):
+        """
+        queues func, returns future of its result
+        key - queued call with the same key is not sent, its future gets result of func
+        upload - func is a long file upload, subclasses may run it apart from other calls
+        """
+        with self.lock:
+            call = self.pending_edits.get(key) if key is not None else None
+            if call is not None:
+                call.func = func
+                call.priority = min(call.priority, priority)
+                self.coalesced += 1
+                return call.future
+            call = OutboundCall(func, chat_id, priority, key, self.make_future(), next(self.seq), upload)
+            if key is not None:
+                self.pending_edits[key] = call
+            self.chats.setdefault(chat_id, deque()).append(call)
+        self.notify()
+        return call.future
+
+    def pop(self):
+        """
+        returns (call ready to be sent, None) or (None, seconds to wait or None if queue is empty)
+        """
+        with self.lock:
+            now = time.monotonic()
+            wait = self.global_bucket.delay(now)
+            if wait > 0:
+                return None, wait if self.chats else None
+            best = None
+            wait = None
+            for chat_id, calls in self.chats.items():
+                # waiting for a call in flight, done() wakes the loop
+                if chat_id in self.busy_chats or not self.can_start(calls[0]):
+                    continue
+                delay = self.chat_bucket(chat_id).delay(now)
+                if delay > 0:
+                    wait = delay if wait is None else min(wait, delay)
+                elif best is None or (calls[0].priority, calls[0].seq) < (best.priority, best.seq):
+                    best = calls[0]
+            if best is None:
+                return None, wait
+            calls = self.chats[best.chat_id]
+            calls.popleft()
+            if not calls:
+                del self.chats[best.chat_id]
+            if best.key is not None:
+                del self.pending_edits[best.key]
+            self.global_bucket.take()
+            self.chat_bucket(best.chat_id).take()
+            self.busy_chats.add(best.chat_id)
+            self.started(best)
+            if len(self.chat_buckets) > 10000:
+                self.chat_buckets = {c: b for c, b in self.chat_buckets.items() if c in self.chats or not b.idle(now)}
+            return best, None
+
+    def can_start(self, call):
+        """
+        returns False if call must wait for calls in flight, self.lock is held
+        """
+        return True
+
+    def started(self, call):
+        """
+        called with self.lock held when call is taken to be sent
+        """
+
+    def done(self, call):
+        """
+        should be called when sending of a popped call is finished, after retry() of a failed one
+        """
+        with self.lock:
+            self.busy_chats.discard(call.chat_id)
+            self.finished(call)
+        self.notify()
+
+    def finished(self, call):
+        """
+        called with self.lock held when sending of call is finished
+        """
+
+    def retry(self, call, error):
+        """
+        returns True if call rejected with error is queued again
+        """
+        retry_after = getattr(error, 'retry_after', None)
+        call.attempts += 1
+        if not retry_after or call.attempts >= self.max_attempts:
+            return False
+        logger.warning('Flood limit hit for chat %s, retrying in %s seconds', call.chat_id, retry_after)
+        with self.lock:
+            now = time.monotonic()
+            self.chat_bucket(call.chat_id).block(now, retry_after)
+            # call goes back to the head to keep order of chat messages
+            self.chats.setdefault(call.chat_id, deque()).appendleft(call)
+            if call.key is not None:
+                self.pending_edits.setdefault(call.key, call)
+            self.retried += 1
+        self.notify()
+        return True
+
+    def stats(self):
+        with self.lock:
+            return {'queued': sum(len(calls) for calls in self.chats.values()), 'chats': len(self.chats),
+                    'sent': self.sent, 'coalesced': self.coalesced, 'retried': self.retried}
+
+    def make_future(self):
+        raise NotImplementedError
+
+    def notify(self):
+        raise NotImplementedError
+
+
+class ThreadOutbox(Outbox):
+    """
+    Outbox sending calls with a pool of threads, call() blocks caller until result
+    uploads run on their own pool, so they don't hold threads sending messages, and background calls
+    leave a thread of their pool to interactive ones
+    """
+    def __init__(self, workers=8, upload_workers=4, **limits):
+        """
+        self.running - a python dict (upload, priority): calls in flight
+        """
+        super().__init__(**limits)
+        self.wakeup = threading.Event()
+        self.executor = concurrent.futures.ThreadPoolExecutor(workers, thread_name_prefix='outbox')
+        self.upload_executor = concurrent.futures.ThreadPoolExecutor(upload_workers, thread_name_prefix='outbox-upload')
+        self.background_limits = {False: max(workers - 1, 1), True: max(upload_workers - 1, 1)}
+        self.running = {}
+        self.closed = False
+        self.thread = threading.Thread(target=self.run, name='outbox', daemon=True)
+        self.thread.start()
+
+    def make_future(self):
+        return concurrent.futures.Future()
+
+    def notify(self):
+        self.wakeup.set()
+
+    def call(self, func, chat_id, priority=INTERACTIVE, key=None, upload=False):
+        if self.closed:
+            raise RuntimeError('outbox is closed')
+        return self.put(func, chat_id, priority, key, upload).result()
+
+    def can_start(self, call):
+        if call.priority < BACKGROUND:
+            return True
+        return self.running.get((call.upload, BACKGROUND), 0) < self.background_limits[call.upload]
+
+    def started(self, call):
+        key = (call.upload, call.priority)
+        self.running[key] = self.running.get(key, 0) + 1
+
+    def finished(self, call):
+        self.running[(call.upload, call.priority)] -= 1
+
+    def close(self):
+        """
+        stops sending, waits for calls being sent, calls still queued fail
+        """
+        self.closed = True
+        self.notify()
+        self.thread.join()
+        self.executor.shutdown(wait=True)
+        self.upload_executor.shutdown(wait=True)
+        with self.lock:
+            calls = [call for calls in self.chats.values() for call in calls]
+            self.chats = {}
+            self.pending_edits = {}
+        for call in calls:
+            call.future.set_exception(RuntimeError('outbox is closed'))
+
+    def run(self):
+        while not self.closed:
+            # cleared before pop, so call put after pop wakes the loop
+            self.wakeup.clear()
+            call, wait = self.pop()
+            if call is None:
+                self.wakeup.wait(wait)
+                continue
+            (self.upload_executor if call.upload else self.executor).submit(self.execute, call)
+
+    def execute(self, call):
+        try:
+            result = call.func()
+        except Exception as e:
+            retried = self.retry(call, e)
+            self.done(call)
+            if not retried:
+                call.future.set_exception(e)
+            return
+        with self.lock:
+            self.sent += 1
+        self.done(call)
+        call.future.set_result(result)
+
+
+class AioOutbox(Outbox):
+    """
+    Outbox sending calls as tasks of event loop, func of a call returns coroutine
+    """
+    def __init__(self, **limits):
+        super().__init__(**limits)
+        self.loop = None
+        self.wakeup = None
+
+    def make_future(self):
+        return self.loop.create_future()
+
+    def notify(self):
+        if self.wakeup:
+            self.wakeup.set()
+
+    async def call(self, func, chat_id, priority=INTERACTIVE, key=None):
+        # future may be shared by coalesced calls, so it is shielded from cancellation of one of them
+        return await asyncio.shield(self.put(func, chat_id, priority, key))
+
+    async def run(self):
+        self.loop = asyncio.get_running_loop()
+        self.wakeup = asyncio.Event()
+        tasks = set()
+        while True:
+            self.wakeup.clear()
+            call, wait = self.pop()
+            if call is None:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            task = asyncio.ensure_future(self.execute(call))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+
+    async def execute(self, call):
+        try:
+            result = await call.func()
+        except asyncio.CancelledError:
+            self.done(call)
+            raise
+        except Exception as e:
+            retried = self.retry(call, e)
+            self.done(call)
+            if not retried and not call.future.done():
+                call.future.set_exception(e)
+            return
+        self.sent += 1
+        self.done(call)
+        if not call.future.done():
+            call.future.set_result(result)
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+"""
+Background pre-upload of collection tracks.
+Tracks without telegram file id are uploaded to a storage chat, so users get them as cheap file id resends.
+Progress is kept by TelegramFileId itself - after restart only tracks still missing file ids are uploaded.
+"""
+
+import itertools
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class CollectionPreloader:
+    """
+    Uploads tracks in priority order - rated tracks from most liked, then the rest from newest file,
+    with at most workers uploads at a time. Collection is rescanned every rescan_interval seconds for new tracks.
+    """
+    def __init__(self, collection, bot_files, rates, upload, workers=2, interval=1.0, rescan_interval=600, max_attempts=3, retry_delay=5.0):
+        """
+        upload - callable(index, caption) uploading track to storage chat and returning its file id
+        interval - pause of a worker between uploads
+        max_attempts - track failing that many times in a row is skipped until restart
+        retry_delay - pause before second attempt, doubled before each next one
+        """
+        self.collection = collection
+        self.bot_files = bot_files
+        self.rates = rates
+        self.upload = upload
+        self.workers = workers
+        self.interval = interval
+        self.rescan_interval = rescan_interval
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.failures = {}
+        self.uploaded = 0
+        self.uploaded_bytes = 0
+
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self):
+        """
+        starts uploading in background, returns False if it's already running
+        """
+        if self.running():
+            return False
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.run, name='preload', daemon=True)
+        self.thread.start()
+        return True
+
+    def stop(self):
+        """
+        stops uploading after uploads in progress are finished
+        """
+        self.stop_event.set()
+
+    def status(self):
+        return 'Preloading is %s, uploaded %d tracks (%.1f MB), %d tracks failed' % (
+            'running' if self.running() and not self.stop_event.is_set() else 'stopped',
+            self.uploaded, self.uploaded_bytes / 2 ** 20, len(self.failures))
+
+    def pending(self, index):
+        """
+        yields captions of tracks without file id in upload order
+        """
+        with self.rates.lock:
+            rated = list(self.rates.iter_top())
+        files = getattr(index, 'files', None)
+        if files is None:
+            # attached index doesn't know file times
+            recent = iter(index)
+        else:
+            recent = (caption for _, _, caption in sorted(files.values(), key=lambda f: f[1], reverse=True))
+        seen = set()
+        for caption in itertools.chain(rated, recent):
+            if caption in seen or not index.exists(caption):
+                continue
+            seen.add(caption)
+            if self.failures.get(caption, 0) >= self.max_attempts or self.bot_files.get(index.filename(caption)):
+                continue
+            yield caption
+
+    def run(self):
+        while not self.stop_event.is_set():
+            index = self.collection.snapshot()
+            captions = self.pending(index)
+            logger.info('Preloading tracks of index version %d', index.version)
+            threads = [threading.Thread(target=self.work, args=(index, captions), name='preload-%d' % i, daemon=True) for i in range(self.workers)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            logger.info(self.status())
+            self.stop_event.wait(self.rescan_interval)
+
+    def work(self, index, captions):
+        while not self.stop_event.is_set():
+            # generator is shared by workers
+            with self.lock:
+                caption = next(captions, None)
+            if caption is None:
+                return
+            self.upload_track(index, caption)
+            self.stop_event.wait(self.interval)
+
+    def upload_track(self, index, caption):
+        while not self.stop_event.is_set():
+            start = time.monotonic()
+            try:
+                size = index.path(caption).stat().st_size
+                file_id = self.upload(index, caption)
+            except Exception as e:
+                retry_after = getattr(e, 'retry_after', None)
+                if retry_after:
+                    logger.warning('Flood limit hit while preloading %s, waiting %s seconds', caption, retry_after)
+                    self.stop_event.wait(retry_after)
+                    continue
+                with self.lock:
+                    failures = self.failures[caption] = self.failures.get(caption, 0) + 1
+                if failures >= self.max_attempts:
+                    logger.warning('Can not preload %s, skipping it: %s', caption, e)
+                    return
+                delay = self.retry_delay * 2 ** (failures - 1)
+                logger.warning('Can not preload %s, retrying in %s seconds: %s', caption, delay, e)
+                self.stop_event.wait(delay)
+                continue
+            self.bot_files.set(index.filename(caption), file_id)
+            with self.lock:
+                self.uploaded += 1
+                self.uploaded_bytes += size
+                self.failures.pop(caption, None)
+            logger.info('Preloaded %s (%d bytes) in %.1f s', caption, size, time.monotonic() - start)
+            return
@@ -1,46 +1,685 @@
 #!/usr/bin/env python
+"""
+Loads usage events of Telegram Music bots to MongoDB, a database per bot.
+Any number of bot event files and older bot logs are tailed at once, their lines are buffered and written
+with insert_many once a batch is full or flush interval has passed. Byte offsets of files are saved
+to a checkpoint file after every flush, so a restarted ingester continues where it stopped, also when
+a file was rotated meanwhile. Documents get _id of file inode, offset and line checksum, lines read
+again after a crash between insert and checkpoint are skipped as duplicates.
+Inserted events are also counted to pre-aggregated rollup documents, so usage reports read a few
+documents instead of scanning events. Counts are saved to the checkpoint together with offsets of their events
+before they are written, so a crash neither loses them nor counts events twice.
+"""
 
-import sys, time, os, re, json, ast, pprint
-from pymongo import MongoClient
+import argparse
+import ast
+import glob
+import itertools
+import json
+import logging
+import os
+import re
+import sys
+import time
+import uuid
+import zlib
+from collections import Counter
+from pymongo import MongoClient, UpdateOne
+from pymongo.errors import BulkWriteError, PyMongoError
+from telegram_music_events import read_events
 
-def print_usage():
+logger = logging.getLogger(__name__)
+
+READ_SIZE = 1 << 20
+DUPLICATE_KEY = 11000
+# event type: (rollup kind, event field counted by its value)
+KEYED_ROLLUPS = {'search': ('query', 'query'), 'play': ('play', 'hash'), 'rate': ('like', 'hash')}
+# ids of last batches kept by rollup document, batches pile up only while inserts succeed and rollup writes fail
+APPLIED_BATCHES = 16
+
+
+def rotated_file(path, inode):
 	"""
-	Prints usage.
+	returns path of a rotated copy of path with inode, like path.1, or None
 	"""
-	print("Usage: telegram_music_stats.py logfile")
-	sys.exit()
+	directory = os.path.dirname(path) or '.'
+	name = os.path.basename(path)
+	for entry in os.scandir(directory):
+		if entry.name.startswith(name) and entry.name != name and entry.inode() == inode:
+			return entry.path
+	return None
 
-def follow_log(logfile):
+
+class LogTail:
+	"""
+	Follows file from byte offset, file rotated away is read to its end before the new file is opened
 	"""
+	def __init__(self, path, inode=None, offset=0):
+		"""
+		inode, offset - checkpoint of the file, offset is ignored if inode is None
+		"""
+		self.path = path
+		self.file = None
+		self.inode = None
+		self.offset = 0
+		try:
+			current = os.stat(path).st_ino
+		except FileNotFoundError:
+			return
+		opened = path
+		if inode is None:
+			offset = 0
+		elif inode != current:
+			opened = rotated_file(path, inode)
+			if opened is None:
+				logger.warning('%s was rotated and rotated file is gone, reading new file from start', path)
+				opened, offset = path, 0
+		self.open(opened, offset)
+
+	def open(self, path, offset):
+		self.file = open(path, 'rb')
+		self.inode = os.fstat(self.file.fileno()).st_ino
+		self.offset = offset
+
+	def close(self):
+		if self.file:
+			self.file.close()
+			self.file = None
+
+	def read(self, max_bytes=READ_SIZE):
+		"""
+		returns (inode, list of (offset, line)) of lines after offset in file of inode,
+		last line without newline is left for next read
+		"""
+		if self.file is None:
+			try:
+				self.open(self.path, 0)
+			except FileNotFoundError:
+				return None, []
+		inode = self.inode
+		self.file.seek(self.offset)
+		data = self.file.read(max_bytes)
+		end = data.rfind(b'\n') + 1
+		if not end:
+			if len(data) < max_bytes:
+				return inode, self.check_rotation(data)
+			# line longer than max_bytes is split
+			end = len(data)
+		return inode, self.split(data[:end])
+
+	def split(self, data):
+		lines = []
+		offset = self.offset
+		for line in data.split(b'\n'):
+			if line:
+				lines.append((offset, line))
+			offset += len(line) + 1
+		self.offset = min(offset, self.offset + len(data))
+		return lines
+
+	def check_rotation(self, rest):
+		"""
+		reopens path if it is a new file, rewinds if file was truncated, returns unterminated last line of rotated file
+		"""
+		try:
+			stat = os.stat(self.path)
+		except FileNotFoundError:
+			return []
+		if stat.st_ino != self.inode:
+			# nothing is written to rotated file anymore, so its unterminated line is complete
+			lines = self.split(rest) if rest else []
+			logger.info('%s was rotated, following new file', self.path)
+			self.close()
+			try:
+				self.open(self.path, 0)
+			except FileNotFoundError:
+				pass
+			return lines
+		if stat.st_size < self.offset:
+			logger.info('%s was truncated, reading it from start', self.path)
+			self.offset = 0
+		return []
+
+	def position(self):
+		return {'inode': self.inode, 'offset': self.offset}
 
+
+class Checkpoints:
+	"""
+	Json file of {'files': {path: {inode, offset}}, 'rollups': rollup batches not written yet}, replaced as a whole on save
+	files written by older versions are read as files only
+	"""
+	def __init__(self, filename):
+		self.filename = filename
+		self.positions = {}
+		self.rollups = []
+		if filename and os.path.exists(filename):
+			with open(filename) as f:
+				data = json.load(f)
+			if 'files' in data:
+				self.positions = data['files']
+				self.rollups = data.get('rollups', [])
+			else:
+				self.positions = data
+
+	def get(self, path):
+		return self.positions.get(path)
+
+	def save(self, positions, rollups=()):
+		self.positions = positions
+		self.rollups = list(rollups)
+		if not self.filename:
+			return
+		temp = self.filename + '.tmp'
+		with open(temp, 'w') as f:
+			json.dump({'files': positions, 'rollups': self.rollups}, f, indent=1, sort_keys=True)
+			f.flush()
+			os.fsync(f.fileno())
+		os.replace(temp, self.filename)
+
+
+class MemoryCollection:
+	"""
+	In-memory stand-in of pymongo collection, enough for the ingester
 	"""
-	logfile.seek(0,2)
-	while True:
-		line = logfile.readline()
-		if not line:
-			time.sleep(0.1)
+	ids = itertools.count()
+
+	def __init__(self, name):
+		self.name = name
+		self.documents = {}
+
+	def insert_one(self, document):
+		self.insert_many([document])
+
+	def insert_many(self, documents, ordered=True):
+		errors = []
+		inserted = 0
+		for index, document in enumerate(documents):
+			document.setdefault('_id', next(self.ids))
+			if document['_id'] in self.documents:
+				errors.append({'index': index, 'code': DUPLICATE_KEY, 'errmsg': 'duplicate key %r' % (document['_id'],)})
+				if ordered:
+					break
+				continue
+			self.documents[document['_id']] = dict(document)
+			inserted += 1
+		if errors:
+			raise BulkWriteError({'writeErrors': errors, 'nInserted': inserted})
+
+	def bulk_write(self, requests, ordered=True):
+		# only upserts made by Rollups, UpdateOne keeps its arguments in private attributes
+		errors = []
+		for index, request in enumerate(requests):
+			_id = request._filter['_id']
+			document = self.documents.get(_id)
+			if document is not None and not matches(document, request._filter):
+				# upsert of a document not matching the rest of filter inserts its _id again
+				if request._upsert:
+					errors.append({'index': index, 'code': DUPLICATE_KEY, 'errmsg': 'duplicate key %r' % (_id,)})
+					if ordered:
+						break
+				continue
+			if document is None:
+				if not request._upsert:
+					continue
+				document = self.documents[_id] = {'_id': _id}
+				document.update(request._doc.get('$setOnInsert', {}))
+			for field, value in request._doc.get('$inc', {}).items():
+				parent = document
+				*path, name = field.split('.')
+				for part in path:
+					parent = parent.setdefault(part, {})
+				parent[name] = parent.get(name, 0) + value
+			for field, value in request._doc.get('$push', {}).items():
+				document[field] = (document.get(field, []) + value['$each'])[value['$slice']:]
+		if errors:
+			raise BulkWriteError({'writeErrors': errors, 'nInserted': 0})
+
+	def find(self, filter=None, sort=None, limit=0):
+		"""
+		filter takes values and {'$gte', '$lt', '$in', '$ne'} conditions, sort is [(field, direction)]
+		"""
+		documents = [dict(document) for document in self.documents.values() if matches(document, filter or {})]
+		for field, direction in reversed(sort or []):
+			documents.sort(key=lambda document: document.get(field), reverse=direction < 0)
+		return documents[:limit] if limit else documents
+
+	def count_documents(self, filter):
+		return len(self.find(filter))
+
+	def create_index(self, keys):
+		pass
+
+	def drop(self):
+		self.documents.clear()
+
+
+def matches(document, filter):
+	for field, condition in filter.items():
+		value = document.get(field)
+		if not isinstance(condition, dict):
+			if value != condition:
+				return False
 			continue
-		yield line
-	
-def process_log(line, db):
+		if '$gte' in condition and not (value is not None and value >= condition['$gte']):
+			return False
+		if '$lt' in condition and not (value is not None and value < condition['$lt']):
+			return False
+		if '$in' in condition and value not in condition['$in']:
+			return False
+		if '$ne' in condition and (value == condition['$ne'] or isinstance(value, list) and condition['$ne'] in value):
+			return False
+	return True
+
+
+class MemoryDatabase(dict):
+	def __missing__(self, name):
+		collection = self[name] = MemoryCollection(name)
+		return collection
+
+	def __getattr__(self, name):
+		return self[name]
+
+
+class MemoryClient(dict):
+	"""
+	In-memory stand-in of MongoClient, client['bot'].events is created on first use
+	"""
+	def __missing__(self, name):
+		database = self[name] = MemoryDatabase()
+		return database
+
+
+def parse_line(line):
+	"""
+	returns (collection name, document) of a line, or None if line is neither event nor logged update
+	"""
+	text = line.decode('utf-8', 'replace')
+	if text.startswith('{'):
+		for event in read_events([text]):
+			return 'events', event
+		return None
+	# updates logged by older bots are parsed from their repr
+	match = re.search(r'New update: ({.*})', text.strip())
+	if not match:
+		return None
+	try:
+		update = ast.literal_eval(match.group(1))
+	except (ValueError, SyntaxError):
+		logger.warning('Can not parse update %s', match.group(1)[:100])
+		return None
+	return 'updates', update
+
+
+def day_of(t):
+	return time.strftime('%Y-%m-%d', time.gmtime(t))
+
+
+class Rollups:
+	"""
+	Counts of events in rollups collection of bot database, a document per kind, period and key:
+		minute - event counts by type in a minute, period is unix time of minute start, no key
+		query, play, like - counts of a search query, played hash, liked hash in a day, month and all time,
+			periods are YYYY-MM-DD, YYYY-MM and all
+		chat - events of a chat in a day, active chats of a day are the documents of the day
+	Counts of events added between writes are summed in memory, sealed into a batch with unique id and written
+	with one bulk of upserts. Rollup document keeps ids of its last batches in applied, so a batch written again,
+	e.g. from checkpoint after a crash, skips documents it already reached.
+	"""
+	def __init__(self):
+		"""
+		self.pending - a python dict database name: {_id: (fields set on insert, Counter of increments)}
+		self.batches - a python list of sealed batches [batch id, database name, {_id: [fields, increments]}], oldest first
+		"""
+		self.pending = {}
+		self.batches = []
+		self.indexed = set()
+
+	def add(self, database, events):
+		rollups = self.pending.setdefault(database, {})
+		for event in events:
+			t = event.get('t')
+			type = event.get('type')
+			if not isinstance(t, (int, float)) or not isinstance(type, str) or not type.isidentifier():
+				continue
+			self.count(rollups, 'minute', int(t // 60 * 60), None, 'counts.' + type)
+			day = day_of(t)
+			kind, field = KEYED_ROLLUPS.get(type, (None, None))
+			key = event.get(field) if kind else None
+			if isinstance(key, str):
+				# queries differing only in case and spaces are one query
+				key = ' '.join(key.lower().split())[:100]
+				if key:
+					for period in (day, day[:7], 'all'):
+						self.count(rollups, kind, period, key)
+			if event.get('chat') is not None:
+				self.count(rollups, 'chat', day, event['chat'])
+
+	def count(self, rollups, kind, period, key, field='count'):
+		_id = '%s:%s' % (kind, period) if key is None else '%s:%s:%s' % (kind, period, key)
+		rollup = rollups.get(_id)
+		if rollup is None:
+			rollup = rollups[_id] = ({'kind': kind, 'period': period, 'key': key}, Counter())
+		rollup[1][field] += 1
+
+	def seal(self):
+		"""
+		moves pending counts to new batches, returns self.batches
+		"""
+		for database, rollups in self.pending.items():
+			self.batches.append([uuid.uuid4().hex, database, {_id: [fields, dict(counts)] for _id, (fields, counts) in rollups.items()}])
+		self.pending = {}
+		return self.batches
+
+	def write(self, client, batch_size=1000):
+		"""
+		seals pending counts and upserts batches, batches left after database error are written by next call
+		"""
+		self.seal()
+		while self.batches:
+			batch_id, database, rollups = self.batches[0]
+			collection = client[database].rollups
+			if database not in self.indexed:
+				collection.create_index([('kind', 1), ('period', 1), ('count', -1)])
+				collection.create_index([('key', 1), ('kind', 1)])
+				self.indexed.add(database)
+			ids = list(rollups)
+			for start in range(0, len(ids), batch_size):
+				chunk = ids[start:start + batch_size]
+				self.upsert(collection, batch_id, [(_id, rollups[_id]) for _id in chunk])
+				for _id in chunk:
+					del rollups[_id]
+			del self.batches[0]
+
+	def upsert(self, collection, batch_id, rollups):
+		"""
+		adds counts of batch to documents which don't have it applied yet
+		"""
+		try:
+			collection.bulk_write([UpdateOne({'_id': _id, 'applied': {'$ne': batch_id}},
+											 {'$setOnInsert': fields, '$inc': counts, '$push': {'applied': {'$each': [batch_id], '$slice': -APPLIED_BATCHES}}},
+											 upsert=True)
+								   for _id, (fields, counts) in rollups], ordered=False)
+		except BulkWriteError as e:
+			# document with batch applied doesn't match filter, so upsert tries to insert its _id again
+			if any(error['code'] != DUPLICATE_KEY for error in e.details['writeErrors']):
+				raise
+
+	def rebuild(self, client, database, batch_size=10000):
+		"""
+		counts all events of database again, ingester must not run meanwhile
+		"""
+		client[database].rollups.drop()
+		self.indexed.discard(database)
+		events = []
+		for event in client[database].events.find():
+			events.append(event)
+			if len(events) >= batch_size:
+				self.add(database, events)
+				events = []
+		self.add(database, events)
+		self.write(client)
+
+
+def events_per_minute(db, type='search', minutes=60, now=None):
+	"""
+	returns list of (minute start, events of type) of last minutes, oldest first
+	"""
+	end = int((now or time.time()) // 60 * 60) + 60
+	start = end - minutes * 60
+	counts = {rollup['period']: rollup.get('counts', {}).get(type, 0)
+			  for rollup in db.rollups.find({'kind': 'minute', 'period': {'$gte': start, '$lt': end}})}
+	return [(minute, counts.get(minute, 0)) for minute in range(start, end, 60)]
+
+
+def top(db, kind, period='all', limit=10):
+	"""
+	returns list of (key, count) of most counted keys of query, play, like or chat rollups in period
+	"""
+	return [(rollup['key'], rollup['count'])
+			for rollup in db.rollups.find({'kind': kind, 'period': period}, sort=[('count', -1)], limit=limit)]
+
+
+def track_days(db, hash):
 	"""
+	returns list of (day, plays, likes) of track
 	"""
-	match = re.search(r'New update: ({.*})', line.strip())
-	if match:
-		update_dict=ast.literal_eval(match.group(1))
-		pprint.pprint(update_dict)
-		db.updates.insert_one(update_dict)	
+	days = {}
+	for rollup in db.rollups.find({'key': hash, 'kind': {'$in': ['play', 'like']}}):
+		if len(rollup['period']) == 10:
+			counts = days.setdefault(rollup['period'], [0, 0])
+			counts[rollup['kind'] == 'like'] += rollup['count']
+	return [(day, plays, likes) for day, (plays, likes) in sorted(days.items())]
+
+
+def active_chats(db, days=7, now=None):
+	"""
+	returns list of (day, chats with events) of last days, oldest first
+	"""
+	now = now or time.time()
+	return [(day, db.rollups.count_documents({'kind': 'chat', 'period': day}))
+			for day in (day_of(now - 86400 * i) for i in reversed(range(days)))]
+
+
+class StatsIngester:
+	"""
+	Tails files matching patterns and writes their lines to client[bot name] in batches
+	"""
+	def __init__(self, client, patterns, checkpoint_file=None, batch_size=1000, flush_interval=1.0,
+				 poll_interval=0.2, from_end=False):
+		"""
+		from_end - files without checkpoint are followed from their end instead of start
+		self.tails - a python dict absolute path: LogTail
+		self.buffers - a python dict (database name, collection name): list of documents to insert
+		"""
+		self.client = client
+		self.patterns = patterns
+		self.checkpoints = Checkpoints(checkpoint_file)
+		self.batch_size = batch_size
+		self.flush_interval = flush_interval
+		self.poll_interval = poll_interval
+		self.from_end = from_end
+		self.max_buffered = batch_size * 10
+		self.tails = {}
+		self.buffers = {}
+		self.buffered = 0
+		self.dirty_since = None
+		self.discovered = 0
+		self.inserted = 0
+		self.duplicates = 0
+		self.rejected = 0
+		self.rollups = Rollups()
+		# batches saved by a stopped ingester may be not written yet
+		self.rollups.batches = self.checkpoints.rollups
+		if self.rollups.batches:
+			self.dirty_since = time.monotonic()
+
+	def discover(self):
+		"""
+		starts following new files matching patterns
+		"""
+		for pattern in self.patterns:
+			for path in glob.glob(pattern):
+				path = os.path.abspath(path)
+				if path in self.tails or not os.path.isfile(path):
+					continue
+				checkpoint = self.checkpoints.get(path)
+				if checkpoint:
+					tail = LogTail(path, checkpoint['inode'], checkpoint['offset'])
+				elif self.from_end:
+					tail = LogTail(path, os.stat(path).st_ino, os.path.getsize(path))
+				else:
+					tail = LogTail(path)
+				logger.info('Following %s from offset %d', path, tail.offset)
+				self.tails[path] = tail
+		self.discovered = time.monotonic()
+
+	def poll(self):
+		"""
+		reads new lines of all files and flushes when due, returns number of lines read
+		"""
+		now = time.monotonic()
+		if now - self.discovered > 5:
+			self.discover()
+		read = 0
+		# reading stops while database does not take buffered documents
+		if self.buffered < self.max_buffered:
+			for path, tail in self.tails.items():
+				inode, lines = tail.read()
+				if not lines:
+					continue
+				read += len(lines)
+				if self.dirty_since is None:
+					self.dirty_since = now
+				database = os.path.basename(path).partition('.')[0]
+				for offset, line in lines:
+					parsed = parse_line(line)
+					if parsed is None:
+						continue
+					collection, document = parsed
+					document['_id'] = '%x:%x:%08x' % (inode, offset, zlib.crc32(line))
+					self.buffers.setdefault((database, collection), []).append(document)
+					self.buffered += 1
+		if self.dirty_since is not None and (self.buffered >= self.batch_size or now - self.dirty_since >= self.flush_interval):
+			self.flush()
+		return read
+
+	def flush(self):
+		"""
+		inserts buffered documents and counts their events, saves checkpoints with the counts, then writes rollups,
+		documents not inserted and batches not written are kept on database error
+		"""
+		try:
+			for key in list(self.buffers):
+				database, collection = key
+				documents = self.buffers[key]
+				while documents:
+					batch = documents[:self.batch_size]
+					stored = self.insert(self.client[database][collection], batch)
+					# events after checkpoint are not counted yet, also those inserted before a crash
+					if collection == 'events':
+						self.rollups.add(database, stored)
+					documents = self.buffers[key] = documents[self.batch_size:]
+					self.buffered -= len(batch)
+				del self.buffers[key]
+		except PyMongoError as e:
+			logger.error('Can not insert %d documents, retrying: %s', self.buffered, e)
+			# next flush waits for another interval
+			self.dirty_since = time.monotonic()
+			return False
+		self.checkpoints.save({path: tail.position() for path, tail in self.tails.items() if tail.inode is not None}, self.rollups.seal())
+		self.dirty_since = None
+		try:
+			self.rollups.write(self.client, self.batch_size)
+		except PyMongoError as e:
+			logger.error('Can not write %d rollup batches, retrying: %s', len(self.rollups.batches), e)
+			self.dirty_since = time.monotonic()
+			return False
+		return True
+
+	def insert(self, collection, documents):
+		"""
+		returns documents stored in collection, inserted now or before
+		"""
+		try:
+			collection.insert_many(documents, ordered=False)
+			self.inserted += len(documents)
+			return documents
+		except BulkWriteError as e:
+			# documents inserted before, and documents database never takes, are not retried
+			errors = e.details['writeErrors']
+			self.inserted += e.details['nInserted']
+			for error in errors:
+				if error['code'] == DUPLICATE_KEY:
+					self.duplicates += 1
+				else:
+					self.rejected += 1
+					logger.warning('Document rejected by %s: %s', collection.name, error.get('errmsg'))
+			failed = {error['index'] for error in errors if error['code'] != DUPLICATE_KEY}
+			return [document for index, document in enumerate(documents) if index not in failed]
+
+	def run(self):
+		self.discover()
+		try:
+			while True:
+				if not self.poll():
+					time.sleep(self.poll_interval)
+		except KeyboardInterrupt:
+			pass
+		finally:
+			self.flush()
+			for tail in self.tails.values():
+				tail.close()
+			logger.info('Inserted %d documents, skipped %d duplicates', self.inserted, self.duplicates)
+
+
+def ingest(args):
+	logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+	client = MemoryClient() if args.memory else MongoClient(args.mongo)
+	ingester = StatsIngester(client, args.files, None if args.memory else args.checkpoint, args.batch_size,
+							 args.flush_interval, args.poll_interval, args.from_end)
+	ingester.run()
+	if args.memory:
+		for database, collections in sorted(client.items()):
+			for collection, documents in sorted(collections.items()):
+				print('%s.%s: %d' % (database, collection, len(documents.documents)))
+
+
+def query(args):
+	db = MongoClient(args.mongo)[args.bot]
+	start = time.perf_counter()
+	if args.report == 'searches':
+		rows = [(time.strftime('%Y-%m-%d %H:%M', time.gmtime(minute)), count) for minute, count in events_per_minute(db, args.type, args.minutes)]
+	elif args.report == 'chats':
+		rows = active_chats(db, args.days)
+	elif args.report == 'track':
+		if not args.key:
+			sys.exit('track report needs --key hash')
+		rows = track_days(db, args.key)
+	else:
+		rows = top(db, {'queries': 'query', 'plays': 'play', 'likes': 'like'}[args.report], args.period, args.limit)
+	elapsed = time.perf_counter() - start
+	for row in rows:
+		print('\t'.join(str(value) for value in row))
+	print('%d rows in %.1f ms' % (len(rows), elapsed * 1000), file=sys.stderr)
+
+
+def rebuild(args):
+	logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+	client = MongoClient(args.mongo)
+	Rollups().rebuild(client, args.bot)
+	logger.info('Rollups of %s are rebuilt', args.bot)
+
 
 def main():
-	if len(sys.argv) != 2: print_usage()
-	
-	bot_name = os.path.basename(sys.argv[1]).partition('.')[0]
-	mongo_client = MongoClient()	
-	db = mongo_client[bot_name]
-	
-	logfile = open(sys.argv[1])
-	loglines = follow_log(logfile)
-	for line in loglines:
-		process_log(line,db)
+	parser = argparse.ArgumentParser(description='Usage stats of Telegram Music bots in MongoDB, a database per bot')
+	parser.add_argument('--mongo', default='mongodb://127.0.0.1:27017')
+	subparsers = parser.add_subparsers(dest='command', required=True)
+	ingest_parser = subparsers.add_parser('ingest', help='load bot event files and logs, count events to rollups')
+	ingest_parser.add_argument('files', nargs='*', default=['bots/log/*.events.jsonl'],
+							   help='bot event files or logs, glob patterns are checked for new files while running')
+	ingest_parser.add_argument('--checkpoint', default='bots/log/stats.checkpoint.json', help='file of saved offsets')
+	ingest_parser.add_argument('--batch-size', type=int, default=1000)
+	ingest_parser.add_argument('--flush-interval', type=float, default=1.0, help='seconds a read line may wait for insert')
+	ingest_parser.add_argument('--poll-interval', type=float, default=0.2)
+	ingest_parser.add_argument('--from-end', action='store_true', help='follow files without checkpoint from their end')
+	ingest_parser.add_argument('--memory', action='store_true', help='insert to in-memory database instead of MongoDB, to check files')
+	ingest_parser.set_defaults(func=ingest)
+	query_parser = subparsers.add_parser('query', help='print a report from rollups')
+	query_parser.add_argument('bot')
+	query_parser.add_argument('report', choices=['searches', 'queries', 'plays', 'likes', 'chats', 'track'],
+							  help='searches - events per minute, queries, plays, likes - top of period, chats - active chats per day, track - plays and likes per day')
+	query_parser.add_argument('--type', default='search', help='event type of searches report')
+	query_parser.add_argument('--minutes', type=int, default=60)
+	query_parser.add_argument('--period', default='all', help='YYYY-MM-DD, YYYY-MM or all')
+	query_parser.add_argument('--limit', type=int, default=20)
+	query_parser.add_argument('--days', type=int, default=7)
+	query_parser.add_argument('--key', help='track hash of track report')
+	query_parser.set_defaults(func=query)
+	rebuild_parser = subparsers.add_parser('rebuild', help='count all events of bot to rollups again, ingester must be stopped')
+	rebuild_parser.add_argument('bot')
+	rebuild_parser.set_defaults(func=rebuild)
+	args = parser.parse_args()
+	args.func(args)
 
 if __name__ == '__main__': main()
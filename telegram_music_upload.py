@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+"""
+Streaming audio upload for threaded runtime.
+python-telegram-bot reads whole file into memory before sending it, here multipart body is streamed
+from file in chunks over kept alive connection of the calling thread.
+"""
+
+import http.client
+import json
+import logging
+import os
+import threading
+import time
+import urllib.parse
+import uuid
+from telegram_music_metrics import UPLOAD_BYTES, observe_api_call
+
+logger = logging.getLogger(__name__)
+
+
+class UploadError(Exception):
+    """
+    Bot API rejected upload
+    """
+    def __init__(self, description, error_code=None, retry_after=None):
+        super().__init__(description)
+        self.error_code = error_code
+        self.retry_after = retry_after
+
+
+class StreamingUploader:
+    """
+    Uploads audio files with sendAudio, every thread keeps its own connection open between uploads
+    """
+    def __init__(self, token, base_url='https://api.telegram.org/bot', chunk_size=64 * 1024):
+        url = urllib.parse.urlsplit(base_url + token + '/')
+        self.https = url.scheme == 'https'
+        self.host = url.hostname
+        self.port = url.port
+        self.path = url.path
+        self.chunk_size = chunk_size
+        self.local = threading.local()
+        # connections of all threads, so close() can reach them
+        self.connections = set()
+        self.lock = threading.Lock()
+        self.uploads = 0
+        self.uploaded_bytes = 0
+        self.upload_seconds = 0.0
+
+    def connection(self, timeout):
+        """
+        returns (connection of current thread, True if it was used before)
+        """
+        conn = getattr(self.local, 'connection', None)
+        if conn is None:
+            conn_class = http.client.HTTPSConnection if self.https else http.client.HTTPConnection
+            self.local.connection = conn_class(self.host, self.port, timeout=timeout)
+            with self.lock:
+                self.connections.add(self.local.connection)
+            return self.local.connection, False
+        conn.timeout = timeout
+        if conn.sock:
+            conn.sock.settimeout(timeout)
+        return conn, True
+
+    def drop_connection(self):
+        conn = getattr(self.local, 'connection', None)
+        if conn:
+            conn.close()
+            with self.lock:
+                self.connections.discard(conn)
+        self.local.connection = None
+
+    def close(self):
+        """
+        closes kept alive connections of all threads
+        """
+        with self.lock:
+            connections, self.connections = self.connections, set()
+        for conn in connections:
+            conn.close()
+
+    def chunks(self, head, audio, tail):
+        yield head
+        while True:
+            chunk = audio.read(self.chunk_size)
+            if not chunk:
+                break
+            yield chunk
+        yield tail
+
+    def send_audio(self, chat_id, audio, filename, timeout=60, **params):
+        """
+        uploads audio file object from its start, returns sent message as Bot API json dict
+        """
+        boundary = uuid.uuid4().hex
+        fields = dict(params, chat_id=chat_id)
+        head = b''.join(('--%s\r\nContent-Disposition: form-data; name="%s"\r\n\r\n%s\r\n' % (boundary, name, value)).encode('utf-8')
+                        for name, value in fields.items() if value is not None)
+        head += ('--%s\r\nContent-Disposition: form-data; name="audio"; filename="%s"\r\nContent-Type: audio/mpeg\r\n\r\n'
+                 % (boundary, filename.replace('"', "'"))).encode('utf-8')
+        tail = ('\r\n--%s--\r\n' % boundary).encode('utf-8')
+        size = os.fstat(audio.fileno()).st_size
+        headers = {'Content-Type': 'multipart/form-data; boundary=' + boundary, 'Content-Length': str(len(head) + size + len(tail))}
+        start = time.monotonic()
+        while True:
+            conn, reused = self.connection(timeout)
+            audio.seek(0)
+            try:
+                conn.request('POST', self.path + 'sendAudio', body=self.chunks(head, audio, tail), headers=headers)
+                response = conn.getresponse()
+                result = json.loads(response.read().decode('utf-8'))
+                break
+            except (OSError, http.client.HTTPException):
+                self.drop_connection()
+                # kept alive connection may be already closed by server, upload is repeated once on a new one
+                if not reused:
+                    observe_api_call('sendAudio', time.monotonic() - start, 'network')
+                    raise
+        elapsed = time.monotonic() - start
+        if not result.get('ok'):
+            observe_api_call('sendAudio', elapsed, result.get('error_code'))
+            raise UploadError(result.get('description'), result.get('error_code'), result.get('parameters', {}).get('retry_after'))
+        observe_api_call('sendAudio', elapsed)
+        UPLOAD_BYTES.inc(size)
+        with self.lock:
+            self.uploads += 1
+            self.uploaded_bytes += size
+            self.upload_seconds += elapsed
+        logger.info('Uploaded %s: %d bytes in %.2f s (%.1f MB/s)', filename, size, elapsed, size / 2 ** 20 / max(elapsed, 1e-6))
+        return result['result']
+
+    def stats(self):
+        with self.lock:
+            return {'uploads': self.uploads, 'bytes': self.uploaded_bytes, 'seconds': self.upload_seconds}
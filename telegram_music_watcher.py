@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+"""
+Collection watcher feeds file changes in collection directory into TelegramMusicCollection.
+Uses inotify on linux and falls back to periodic directory scans elsewhere.
+"""
+
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+import sys
+import threading
+import time
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = IN_CLOSE_WRITE | IN_ATTRIB | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+EVENT_HEADER = struct.Struct('iIII')
+
+
+class InotifyWatcher:
+    """
+    Recursive inotify watcher of directory tree
+    """
+    def __init__(self, path):
+        """
+        self.watches - a python dict watch descriptor: watched directory Path
+        raises OSError if inotify is not available
+        """
+        if not sys.platform.startswith('linux'):
+            raise OSError('inotify is available on linux only')
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.path = Path(path)
+        self.watches = {}
+        self.add_tree(self.path)
+
+    def add_tree(self, path):
+        """
+        watches path and all its subdirectories
+        """
+        for directory, _, _ in os.walk(str(path)):
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), WATCH_MASK)
+            if wd < 0:
+                logger.warning('Can not watch %s: %s', directory, os.strerror(ctypes.get_errno()))
+                continue
+            self.watches[wd] = Path(directory)
+
+    def read(self, timeout):
+        """
+        waits up to timeout seconds for events
+        returns set of changed paths or None if events were lost and full rescan is needed
+        """
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return set()
+        data = os.read(self.fd, 64 * 1024)
+        changed = set()
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                return None
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+            directory = self.watches.get(wd)
+            if directory is None:
+                continue
+            p = directory / name if name else directory
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                self.add_tree(p)
+            changed.add(p)
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingWatcher:
+    """
+    Watcher comparing size and mtime of mp3 files between directory scans
+    """
+    def __init__(self, path, interval=30):
+        self.path = Path(path)
+        self.interval = interval
+        self.state = self.scan()
+        self.next_scan = time.monotonic() + interval
+
+    def scan(self):
+        state = {}
+        for directory, _, filenames in os.walk(str(self.path)):
+            for filename in filenames:
+                if filename.endswith('.mp3'):
+                    p = os.path.join(directory, filename)
+                    try:
+                        st = os.stat(p)
+                    except OSError:
+                        continue
+                    state[p] = (st.st_size, st.st_mtime_ns)
+        return state
+
+    def read(self, timeout):
+        """
+        waits up to timeout seconds, returns set of changed paths if scan was due
+        """
+        delay = self.next_scan - time.monotonic()
+        if delay > timeout:
+            time.sleep(timeout)
+            return set()
+        time.sleep(max(delay, 0))
+        self.next_scan = time.monotonic() + self.interval
+        state = self.scan()
+        changed = {Path(p) for p in state.keys() ^ self.state.keys()}
+        changed.update(Path(p) for p in state.keys() & self.state.keys() if state[p] != self.state[p])
+        self.state = state
+        return changed
+
+    def close(self):
+        pass
+
+
+class CollectionWatcher:
+    """
+    Background thread applying debounced file changes to TelegramMusicCollection
+    an applied batch copies only index entries of changed tracks, layered over the previous index,
+    saving and exporting rewrite whole index and are done at most once per persist_interval
+    """
+    def __init__(self, collection, debounce=2.0, max_delay=30.0, poll_interval=30, persist_interval=60.0):
+        """
+        debounce - seconds without new events before changes are applied
+        max_delay - changes are applied after this many seconds even if events keep coming
+        poll_interval - seconds between directory scans when inotify is not available
+        persist_interval - seconds between saving and exporting index after applied changes
+        """
+        self.collection = collection
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.persist_interval = persist_interval
+        # monotonic time of the first applied batch which is not saved yet
+        self.unsaved = None
+        try:
+            self.source = InotifyWatcher(collection.mds_basedir)
+        except OSError as e:
+            logger.warning('inotify is not available (%s), polling %s every %d seconds', e, str(collection.mds_basedir), poll_interval)
+            self.source = PollingWatcher(collection.mds_basedir, poll_interval)
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='collection-watcher', daemon=True)
+
+    def start(self):
+        self.thread.start()
+        logger.info('Watching %s for changes', str(self.collection.mds_basedir))
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread.ident:
+            self.thread.join()
+        self.source.close()
+        self.persist()
+
+    def persist(self):
+        if self.unsaved is None:
+            return
+        try:
+            self.collection.persist()
+        except Exception as e:
+            logger.error('Can not save collection index: %s', e)
+        self.unsaved = None
+
+    def run(self):
+        pending = set()
+        rescan = False
+        first_event = last_event = None
+        while not self.stopped.is_set():
+            try:
+                changed = self.source.read(timeout=min(self.debounce, 1.0))
+            except OSError as e:
+                logger.error('Watcher failed: %s', e)
+                time.sleep(self.debounce)
+                continue
+            now = time.monotonic()
+            if self.unsaved is not None and now - self.unsaved >= self.persist_interval:
+                self.persist()
+            if changed is None:
+                rescan = True
+            elif changed:
+                pending |= changed
+            if changed is None or changed:
+                first_event = first_event or now
+                last_event = now
+            if not (pending or rescan):
+                continue
+            if now - last_event < self.debounce and now - first_event < self.max_delay:
+                continue
+            try:
+                if rescan:
+                    logger.info('Watcher lost events, reindexing whole collection')
+                    self.collection.reindex()
+                else:
+                    logger.info('Applying %d changed paths', len(pending))
+                    self.collection.update_files(pending, persist=False)
+                    self.unsaved = self.unsaved or now
+            except Exception as e:
+                logger.error('Can not apply collection changes: %s', e)
+            pending = set()
+            rescan = False
+            first_event = last_event = None
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+"""
+Embedded webhook server for Telegram Music bots.
+One server per listen address serves any number of bots, updates are routed by url path
+and checked with X-Telegram-Bot-Api-Secret-Token header, then parsed in batches and handed to bot dispatchers.
+"""
+
+import json
+import logging
+import queue
+import threading
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+def set_webhook(token, url, secret=None, base_url='https://api.telegram.org/bot'):
+    """
+    registers webhook url for bot token, returns Bot API result
+    """
+    params = {'url': url, 'allowed_updates': ['message', 'callback_query', 'inline_query']}
+    if secret:
+        params['secret_token'] = secret
+    request = urllib.request.Request(base_url + token + '/setWebhook', data=json.dumps(params).encode('utf-8'),
+                                     headers={'Content-Type': 'application/json'})
+    with urllib.request.urlopen(request, timeout=30) as response:
+        result = json.loads(response.read().decode('utf-8'))
+    if not result.get('ok'):
+        raise RuntimeError('setWebhook failed: %s' % result.get('description'))
+    return result['result']
+
+
+class WebhookRequestHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        route = self.server.webhook.routes.get(self.path)
+        if route is None:
+            self.send_error(404)
+            return
+        if route['secret'] and self.headers.get(SECRET_HEADER) != route['secret']:
+            self.send_error(403)
+            return
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.server.webhook.queue.put((route, body))
+        # telegram waits for response before sending next update, so it is answered before update is handled
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+class WebhookServer:
+    """
+    HTTP server receiving updates for several bots on one port
+    """
+    servers = {}
+    servers_lock = threading.Lock()
+
+    @classmethod
+    def get(cls, listen='0.0.0.0', port=8443):
+        """
+        returns server for listen address, creating and starting it on first use
+        """
+        with cls.servers_lock:
+            server = cls.servers.get((listen, port))
+            if server is None:
+                server = cls.servers[(listen, port)] = WebhookServer(listen, port)
+                server.start()
+            return server
+
+    def __init__(self, listen, port, batch_size=100):
+        """
+        self.routes - a python dict url path: {'secret', 'deliver'}, deliver is called with list of update dicts
+        """
+        self.routes = {}
+        self.queue = queue.Queue()
+        self.batch_size = batch_size
+        self.httpd = ThreadingHTTPServer((listen, port), WebhookRequestHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.webhook = self
+        self.threads = []
+
+    def add_route(self, path, deliver, secret=None):
+        self.routes[path] = {'path': path, 'secret': secret, 'deliver': deliver}
+        logger.info('Webhook route %s registered', path)
+
+    def remove_route(self, path, deliver):
+        """
+        removes route of path unless it was registered again with another deliver
+        """
+        route = self.routes.get(path)
+        if route is not None and route['deliver'] is deliver:
+            del self.routes[path]
+            logger.info('Webhook route %s removed', path)
+
+    def start(self):
+        self.threads = [threading.Thread(target=self.httpd.serve_forever, name='webhook-http', daemon=True),
+                        threading.Thread(target=self.parse, name='webhook-parse', daemon=True)]
+        for thread in self.threads:
+            thread.start()
+        logger.info('Webhook server listening on %s:%d', *self.httpd.server_address[:2])
+
+    def alive(self):
+        """
+        returns False if server stopped receiving or delivering updates
+        """
+        return bool(self.threads) and all(thread.is_alive() for thread in self.threads)
+
+    def parse(self):
+        """
+        takes received bodies in batches, parses them and delivers updates of a batch to bots at once
+        """
+        while True:
+            items = [self.queue.get()]
+            while len(items) < self.batch_size:
+                try:
+                    items.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            batches = {}
+            for route, body in items:
+                try:
+                    batches.setdefault(route['path'], (route, []))[1].append(json.loads(body.decode('utf-8')))
+                except ValueError as e:
+                    logger.warning('Bad update on %s: %s', route['path'], e)
+            for route, updates in batches.values():
+                try:
+                    route['deliver'](updates)
+                except Exception as e:
+                    logger.error('Can not deliver updates to %s: %s', route['path'], e)